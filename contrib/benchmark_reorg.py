@@ -0,0 +1,87 @@
+#!/usr/bin/env python3
+"""
+Time how long the transaction cache takes to apply a reorg, for a synthetic wallet with a large
+number of settled transactions. The cache is given a store that holds nothing, so this measures
+only the work done by the cache.
+
+    python3 contrib/benchmark_reorg.py --transactions 500000 --depth 1
+"""
+
+import argparse
+import os
+import random
+import sys
+import time
+from typing import Any, List, Optional, Tuple
+
+CONTRIB_PATH = os.path.dirname(os.path.realpath(__file__))
+sys.path.insert(0, os.path.dirname(CONTRIB_PATH))
+
+from electrumsv.constants import TxFlags
+from electrumsv.wallet_database import TransactionCache, TxData
+from electrumsv.wallet_database.tables import CompletionCallbackType
+
+
+class SyntheticTransactionStore:
+    """
+    The minimum of a transaction table needed to load a transaction cache with settled
+    transactions, and to apply a reorg to it.
+    """
+
+    def __init__(self, transaction_count: int, tip_height: int, block_count: int) -> None:
+        flags = TxFlags.StateSettled | TxFlags.HasByteData | TxFlags.HasHeight | \
+            TxFlags.HasPosition | TxFlags.HasProofData
+        self._rows: List[Tuple[bytes, TxFlags, TxData]] = []
+        for i in range(transaction_count):
+            # Heights are spread over the most recent blocks and loaded in no particular order.
+            height = random.randint(tip_height - block_count + 1, tip_height)
+            self._rows.append((os.urandom(32), flags,
+                TxData(height=height, position=i % 1000, fee=250, date_added=1, date_updated=1)))
+
+    def _get_current_timestamp(self) -> int:
+        return int(time.time())
+
+    def read_metadata(self, flags: Optional[TxFlags]=None, mask: Optional[TxFlags]=None,
+            tx_hashes: Optional[Any]=None) -> List[Tuple[bytes, TxFlags, TxData]]:
+        return self._rows
+
+    def read(self, *args: Any, **kwargs: Any) -> List[Any]:
+        return []
+
+    def update_metadata(self, entries: List[Any],
+            completion_callback: Optional[CompletionCallbackType]=None) -> None:
+        if completion_callback is not None:
+            completion_callback(None)
+
+
+def main() -> None:
+    parser = argparse.ArgumentParser(description=__doc__.strip().split("\n")[0])
+    parser.add_argument("--transactions", type=int, default=500000)
+    parser.add_argument("--tip-height", type=int, default=650000)
+    parser.add_argument("--blocks", type=int, default=50000,
+        help="the number of blocks below the tip that the transactions are mined in")
+    parser.add_argument("--depth", type=int, default=1, help="the number of blocks reorged")
+    parser.add_argument("--repeat", type=int, default=5)
+    args = parser.parse_args()
+
+    random.seed(1)
+    store = SyntheticTransactionStore(args.transactions, args.tip_height, args.blocks)
+    start_time = time.perf_counter()
+    cache = TransactionCache(store, 0) # type: ignore
+    print(f"loaded {args.transactions:,d} transactions in "
+        f"{time.perf_counter() - start_time:.3f} seconds")
+
+    timings: List[float] = []
+    for i in range(args.repeat):
+        # Each reorg unverifies the transactions it covers, so later reorgs fork lower down.
+        reorg_height = args.tip_height - (i + 1) * args.depth
+        start_time = time.perf_counter()
+        reorg_count, _tx_hashes = cache.apply_reorg(reorg_height)
+        timings.append(time.perf_counter() - start_time)
+        print(f"reorg above {reorg_height:,d} unverified {reorg_count:,d} transactions in "
+            f"{timings[-1] * 1000:.3f} ms")
+    print(f"best {min(timings) * 1000:.3f} ms, worst {max(timings) * 1000:.3f} ms")
+
+
+if __name__ == "__main__":
+    main()
@@ -45,6 +45,7 @@ from .networks import Net
 from .simple_config import SimpleConfig
 from .regtest_support import HeadersRegTestMod, setup_regtest
 from .util import format_satoshis
+from .util.header_timestamps import HeaderTimestamps
 
 logger = logs.get_logger("app_state")
 
@@ -83,6 +84,7 @@ class AppStateProxy(object):
         self.device_manager = DeviceMgr()
         self.fx = None
         self.headers: Optional[Union[Headers, HeadersRegTestMod]] = None
+        self.header_timestamps: Optional[HeaderTimestamps] = None
         # Not entirely sure these are worth caching, but preserving existing method for now
         self.decimal_point = config.get('decimal_point', 8)
         self.num_zeros = config.get('num_zeros', 0)
@@ -102,6 +104,7 @@ class AppStateProxy(object):
             self.headers = setup_regtest(self)
         else:
             self.headers = Headers.from_file(Net.COIN, self.headers_filename(), Net.CHECKPOINT)
+        self.header_timestamps = HeaderTimestamps(self.headers)
         for n, chain in enumerate(self.headers.chains(), start=1):  # type: ignore
             logger.info(f'chain #{n}: {chain.desc()}')
 
@@ -323,6 +323,8 @@ def add_global_options(parser):
                        default=False, help="Use Regression Testnet")
     group.add_argument("--file-logging", action="store_true", dest="file_logging", default=False,
                        help="Redirect logging to log file")
+    group.add_argument("--startup-timeline", dest="startup_timeline", metavar="PATH",
+                       help="Write the timings of each phase of startup to a JSON file")
 
     # REST API
     group.add_argument("--restapi", action="store_true", dest="restapi",
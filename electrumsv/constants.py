@@ -28,7 +28,7 @@ class StorageKind(IntEnum):
 
 DATABASE_EXT = ".sqlite"
 MIGRATION_FIRST = 22
-MIGRATION_CURRENT = 26
+MIGRATION_CURRENT = 28
 
 class TxFlags(IntFlag):
     Unset = 0
@@ -40,6 +40,7 @@ from .network import Network
 from .simple_config import SimpleConfig
 from .storage import WalletStorage
 from .util import json_decode, DaemonThread, to_string, random_integer, get_wallet_name_from_path
+from .util.timeline import timeline
 from .version import PACKAGE_VERSION
 from .wallet import Wallet
 from .restapi_endpoints import DefaultEndpoints
@@ -145,29 +146,32 @@ class Daemon(DaemonThread):
 
     def __init__(self, fd, is_gui: bool) -> None:
         super().__init__('daemon')
-        app_state.daemon = self
-        config = app_state.config
-        self.config = config
-        if config.get('offline'):
-            self.network = None
-            self.fx_task = None
-
-            app_state.read_headers()
-        else:
-            self.network = Network()
-            app_state.fx = FxTask(app_state.config, self.network)
-            self.fx_task = app_state.async_.spawn(app_state.fx.refresh_loop)
-        self.wallets: Dict[str, Wallet] = {}
-        # RPC API - (synchronous)
-        self.init_server(config, fd, is_gui)
-        # self.init_thread_watcher()
-        self.is_gui = is_gui
-
-        # REST API - (asynchronous)
-        self.rest_server = None
-        if app_state.config.get("restapi"):
-            self.init_restapi_server(config, fd)
-            self.configure_restapi_server()
+        with timeline.phase("daemon_start"):
+            app_state.daemon = self
+            config = app_state.config
+            self.config = config
+            if config.get('offline'):
+                self.network = None
+                self.fx_task = None
+
+                with timeline.phase("headers"):
+                    app_state.read_headers()
+            else:
+                with timeline.phase("network"):
+                    self.network = Network()
+                app_state.fx = FxTask(app_state.config, self.network)
+                self.fx_task = app_state.async_.spawn(app_state.fx.refresh_loop)
+            self.wallets: Dict[str, Wallet] = {}
+            # RPC API - (synchronous)
+            self.init_server(config, fd, is_gui)
+            # self.init_thread_watcher()
+            self.is_gui = is_gui
+
+            # REST API - (asynchronous)
+            self.rest_server = None
+            if app_state.config.get("restapi"):
+                self.init_restapi_server(config, fd)
+                self.configure_restapi_server()
 
     def configure_restapi_server(self):
         self.default_api = DefaultEndpoints()
@@ -283,18 +287,22 @@ class Daemon(DaemonThread):
             return wallet
         if not WalletStorage.files_are_matched_by_path(wallet_filepath):
             return None
-        storage = WalletStorage(wallet_filepath)
-        if storage.requires_split():
-            storage.close()
-            logger.debug("Wallet '%s' requires an split", wallet_filepath)
-            return None
-        if storage.requires_upgrade():
-            storage.close()
-            logger.debug("Wallet '%s' requires an upgrade", wallet_filepath)
-            return None
-
-        wallet = Wallet(storage)
-        self.start_wallet(wallet)
+        with timeline.phase("wallet_open"):
+            with timeline.phase("storage"):
+                storage = WalletStorage(wallet_filepath)
+            if storage.requires_split():
+                storage.close()
+                logger.debug("Wallet '%s' requires an split", wallet_filepath)
+                return None
+            if storage.requires_upgrade():
+                storage.close()
+                logger.debug("Wallet '%s' requires an upgrade", wallet_filepath)
+                return None
+
+            with timeline.phase("wallet"):
+                wallet = Wallet(storage)
+            with timeline.phase("wallet_start"):
+                self.start_wallet(wallet)
         return wallet
 
     def get_wallet(self, path: str) -> Optional[Wallet]:
@@ -1,14 +1,17 @@
+from array import array
 from decimal import Decimal
 from concurrent.futures import CancelledError
 import datetime
 import decimal
 import inspect
 import json
+import math
 import os
 import requests
+import struct
 import sys
 import time
-from typing import Dict
+from typing import Dict, Iterable, List, Optional
 
 from aiorpcx import ignore_after, run_in_thread
 
@@ -30,6 +33,102 @@ CCY_PRECISIONS = {'BHD': 3, 'BIF': 0, 'BYR': 0, 'CLF': 4, 'CLP': 0,
                   'RWF': 0, 'TND': 3, 'UGX': 0, 'UYI': 0, 'VND': 0,
                   'VUV': 0, 'XAF': 0, 'XAU': 4, 'XOF': 0, 'XPF': 0}
 
+SECONDS_PER_DAY = 24 * 60 * 60
+EPOCH_ORDINAL = datetime.date(1970, 1, 1).toordinal()
+
+
+class HistoricalRates:
+    """
+    The daily historical rates for a currency, as a dense array indexed by the number of days
+    since the UNIX epoch. Days without a known rate hold NaN.
+    """
+    CACHE_MAGIC = b"FXR1"
+    _header_struct = struct.Struct("<4sii")
+
+    def __init__(self, first_day: int=0, rates: Optional[array]=None) -> None:
+        self.first_day = first_day
+        self.rates = array('d') if rates is None else rates
+
+    @classmethod
+    def from_dict(klass, date_rates: Dict[str, float]) -> 'HistoricalRates':
+        "Create the table from a dictionary of rates keyed by '%Y-%m-%d' date strings."
+        result = klass()
+        result.update(date_rates)
+        return result
+
+    def to_dict(self) -> Dict[str, float]:
+        return { day_to_date_string(self.first_day + i): rate
+            for i, rate in enumerate(self.rates) if not math.isnan(rate) }
+
+    @classmethod
+    def from_bytes(klass, data: bytes) -> 'HistoricalRates':
+        magic, first_day, count = klass._header_struct.unpack_from(data)
+        if magic != klass.CACHE_MAGIC:
+            raise ValueError("invalid historical rates cache")
+        rates = array('d')
+        rates.frombytes(data[klass._header_struct.size:])
+        if len(rates) != count:
+            raise ValueError("truncated historical rates cache")
+        if sys.byteorder != "little":
+            rates.byteswap()
+        return klass(first_day, rates)
+
+    def to_bytes(self) -> bytes:
+        rates = self.rates
+        if sys.byteorder != "little":
+            rates = array('d', rates)
+            rates.byteswap()
+        return self._header_struct.pack(self.CACHE_MAGIC, self.first_day, len(rates)) + \
+            rates.tobytes()
+
+    def __len__(self) -> int:
+        return len(self.rates)
+
+    def last_day(self) -> Optional[int]:
+        "The last day that there is a rate for, if any."
+        if len(self.rates):
+            return self.first_day + len(self.rates) - 1
+        return None
+
+    def update(self, date_rates: Dict[str, float]) -> None:
+        "Add or replace the rates for the given '%Y-%m-%d' date strings."
+        day_rates = { date_string_to_day(date_string): rate
+            for date_string, rate in date_rates.items() if rate is not None }
+        if not day_rates:
+            return
+
+        first_day = min(day_rates)
+        last_day = max(day_rates)
+        if len(self.rates):
+            if first_day < self.first_day:
+                self.rates[0:0] = array('d', [math.nan]) * (self.first_day - first_day)
+                self.first_day = first_day
+            current_last_day = self.first_day + len(self.rates) - 1
+            if last_day > current_last_day:
+                self.rates.extend(array('d', [math.nan]) * (last_day - current_last_day))
+        else:
+            self.first_day = first_day
+            self.rates = array('d', [math.nan]) * (last_day - first_day + 1)
+
+        for day, rate in day_rates.items():
+            self.rates[day - self.first_day] = float(rate)
+
+    def get_rate(self, day: int) -> Optional[float]:
+        index = day - self.first_day
+        if 0 <= index < len(self.rates):
+            rate = self.rates[index]
+            if not math.isnan(rate):
+                return rate
+        return None
+
+
+def date_string_to_day(date_string: str) -> int:
+    "Map a '%Y-%m-%d' date string to the number of days since the UNIX epoch."
+    return datetime.date.fromisoformat(date_string).toordinal() - EPOCH_ORDINAL
+
+def day_to_date_string(day: int) -> str:
+    return datetime.date.fromordinal(day + EPOCH_ORDINAL).isoformat()
+
 
 class ExchangeBase(object):
 
@@ -61,27 +160,52 @@ class ExchangeBase(object):
     def get_rates(self, ccy) -> Dict:
         raise NotImplementedError()
 
-    def read_historical_rates(self, ccy, cache_dir):
-        filename = os.path.join(cache_dir, self.name() + '_'+ ccy)
+    def _get_cache_filename(self, ccy: str, cache_dir: str) -> str:
+        return os.path.join(cache_dir, self.name() + '_'+ ccy)
+
+    def read_historical_rates(self, ccy: str, cache_dir: str) -> Optional[HistoricalRates]:
+        filename = self._get_cache_filename(ccy, cache_dir)
+        # The binary cache is preferred, but older installations only have the JSON cache.
+        try:
+            with open(filename + '.rates', 'rb') as f:
+                return HistoricalRates.from_bytes(f.read())
+        except FileNotFoundError:
+            pass
+        except Exception:
+            logger.exception('unable to read historical FX rates cache %s', filename)
         if os.path.exists(filename):
-            timestamp = os.stat(filename).st_mtime
             try:
                 with open(filename, 'r', encoding='utf-8') as f:
-                    return json.loads(f.read()), timestamp
+                    return HistoricalRates.from_dict(json.loads(f.read()))
             except Exception:
                 pass
-        return None, None
-
-    def _get_historical_rates(self, ccy, cache_dir):
-        h, timestamp = self.read_historical_rates(ccy, cache_dir)
-        if h is None or time.time() - timestamp < 24*3600:
-            logger.debug(f'getting historical FX rates for {ccy}')
-            h = self.request_history(ccy)
+        return None
+
+    def write_historical_rates(self, ccy: str, cache_dir: str, rates: HistoricalRates) -> None:
+        filename = self._get_cache_filename(ccy, cache_dir)
+        with open(filename + '.rates', 'wb') as f:
+            f.write(rates.to_bytes())
+        with open(filename, 'w', encoding='utf-8') as f:
+            f.write(json.dumps(rates.to_dict()))
+
+    def _get_historical_rates(self, ccy: str, cache_dir: str) -> HistoricalRates:
+        rates = self.history.get(ccy)
+        if rates is None:
+            rates = self.read_historical_rates(ccy, cache_dir)
+        today = int(time.time()) // SECONDS_PER_DAY
+        last_day = rates.last_day() if rates is not None else None
+        if last_day is None or last_day < today:
+            # Only the days since the last known rate are requested, including that day as it
+            # may have been a partial day when it was obtained.
+            days = None if last_day is None else today - last_day + 1
+            logger.debug(f'getting historical FX rates for {ccy}, days {days}')
+            date_rates = self.request_history(ccy, days)
             logger.debug(f'received historical FX rates')
-            filename = os.path.join(cache_dir, self.name() + '_' + ccy)
-            with open(filename, 'w', encoding='utf-8') as f:
-                f.write(json.dumps(h))
-        return h
+            if rates is None:
+                rates = HistoricalRates()
+            rates.update(date_rates)
+            self.write_historical_rates(ccy, cache_dir, rates)
+        return rates
 
     async def get_historical_rates(self, ccy, cache_dir):
         try:
@@ -91,7 +215,11 @@ class ExchangeBase(object):
         except Exception:
             logger.exception('exception getting historical FX rates')
 
-    def request_history(self, ccy):
+    def request_history(self, ccy: str, days: Optional[int]=None) -> Dict[str, float]:
+        """
+        Get the daily rates keyed by '%Y-%m-%d' date string. If `days` is given only that many
+        of the most recent days are needed, otherwise all available days.
+        """
         raise NotImplementedError()
 
     def refresh_historical_rates(self, ccy, cache_dir):
@@ -105,7 +233,17 @@ class ExchangeBase(object):
         return []
 
     def historical_rate(self, ccy, d_t):
-        return self.history.get(ccy, {}).get(d_t.strftime('%Y-%m-%d'))
+        rates = self.history.get(ccy)
+        if rates is not None:
+            return rates.get_rate(d_t.toordinal() - EPOCH_ORDINAL)
+        return None
+
+    def historical_rates(self, ccy: str, days: Iterable[int]) -> List[Optional[float]]:
+        rates = self.history.get(ccy)
+        if rates is None:
+            return [ None for day in days ]
+        get_rate = rates.get_rate
+        return [ get_rate(day) for day in days ]
 
     def get_currencies(self):
         rates = self.get_rates('')
@@ -168,8 +306,8 @@ class CoinPaprika(ExchangeBase):
     def history_ccys(self):
         return ['USD']
 
-    def request_history(self, ccy):
-        limit = 1000
+    def request_history(self, ccy, days=None):
+        limit = 1000 if days is None else min(days, 1000)
         end_date = datetime.date.today()
         start_date = end_date - datetime.timedelta(days=limit-1)
         history = self.get_json(
@@ -189,11 +327,12 @@ class CoinCap(ExchangeBase):
     def history_ccys(self):
         return ['USD']
 
-    def request_history(self, ccy):
+    def request_history(self, ccy, days=None):
         # Currently 2000 days is the maximum in 1 API call which needs to be fixed
         # sometime before the year 2023...
+        limit = 2000 if days is None else min(days, 2000)
         history = self.get_json('api.coincap.io',
-                               "/v2/assets/bitcoin-sv/history?interval=d1&limit=2000")
+                               "/v2/assets/bitcoin-sv/history?interval=d1&limit=%d" % limit)
         return dict([(datetime.datetime.utcfromtimestamp(h['time']/1000).strftime('%Y-%m-%d'),
                         h['priceUsd'])
                      for h in history['data']])
@@ -215,10 +354,11 @@ class CoinGecko(ExchangeBase):
                 'PHP', 'PKR', 'PLN', 'RUB', 'SAR', 'SEK', 'SGD', 'THB',
                 'TRY', 'TWD', 'USD', 'VEF', 'XAG', 'XAU', 'XDR', 'ZAR']
 
-    def request_history(self, ccy):
+    def request_history(self, ccy, days=None):
         history = self.get_json(
             'api.coingecko.com',
-            '/api/v3/coins/bitcoin-cash/market_chart?vs_currency=%s&days=max' % ccy)
+            '/api/v3/coins/bitcoin-cash/market_chart?vs_currency=%s&days=%s' %
+                (ccy, 'max' if days is None else f'{days}&interval=daily'))
         return dict([(datetime.datetime.utcfromtimestamp(h[0]/1000).strftime('%Y-%m-%d'), h[1])
                      for h in history['prices']])
 
@@ -426,6 +566,40 @@ class FxTask:
         if rate:
             return Decimal(satoshis) / COIN * Decimal(rate)
 
+    def historical_values(self, amounts: List[Optional[int]], timestamps: List[int]) \
+            -> List[Optional[Decimal]]:
+        """
+        The fiat value of each amount at the UTC day of the matching timestamp. This is the bulk
+        form of `historical_value`, where the rate lookups are integer arithmetic.
+        """
+        today = int(time.time()) // SECONDS_PER_DAY
+        days = [ timestamp // SECONDS_PER_DAY for timestamp in timestamps ]
+        rates = self.exchange.historical_rates(self.ccy, days)
+        spot_rate = self.exchange.quotes.get(self.ccy)
+        values: List[Optional[Decimal]] = []
+        for amount, day, rate in zip(amounts, days, rates):
+            # Frequently there is no rate for today, until tomorrow. Use spot quotes then.
+            if rate is None and today - day <= 2 and spot_rate is not None:
+                rate = spot_rate
+                self.history_used_spot = True
+            if amount is None or rate is None:
+                values.append(None)
+            else:
+                values.append(Decimal(amount) / COIN * Decimal(rate))
+        return values
+
+    def historical_value_strs(self, amounts: List[Optional[int]], timestamps: List[int]) \
+            -> List[str]:
+        results: List[str] = []
+        for amount, value in zip(amounts, self.historical_values(amounts, timestamps)):
+            if amount is None:
+                results.append(_("Unknown"))
+            elif value is None:
+                results.append(_("No data"))
+            else:
+                results.append(self.ccy_amount_str(value, True))
+        return results
+
     def timestamp_rate(self, timestamp):
         from .util import timestamp_to_datetime
         date = timestamp_to_datetime(timestamp)
@@ -42,6 +42,7 @@ from electrumsv.app_state import app_state
 from electrumsv.contacts import ContactEntry, ContactIdentity
 from electrumsv.i18n import _, set_language
 from electrumsv.logs import logs
+from electrumsv.util.timeline import timeline
 from electrumsv.wallet import AbstractAccount, Wallet
 from electrumsv.wallet_database.tables import WalletEventRow
 
@@ -316,7 +317,8 @@ class SVApplication(QApplication):
                     return None
             wallet = app_state.daemon.load_wallet(wallet_path)
             assert wallet is not None
-            w = self._create_window_for_wallet(wallet)
+            with timeline.phase("wallet_window"):
+                w = self._create_window_for_wallet(wallet)
         if uri:
             w.pay_to_URI(uri)
         w.bring_to_top()
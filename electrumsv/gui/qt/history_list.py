@@ -26,15 +26,17 @@
 import enum
 from functools import partial
 import time
-from typing import List, Optional, Union, TYPE_CHECKING
+from typing import Any, Dict, Iterable, List, Optional, Set, Tuple, Union, TYPE_CHECKING
 import weakref
 import webbrowser
 
-from bitcoinx import hash_to_hex_str, MissingHeader
+from bitcoinx import hash_to_hex_str
 
-from PyQt5.QtCore import Qt, QPoint
-from PyQt5.QtGui import QBrush, QIcon, QColor, QFont
-from PyQt5.QtWidgets import QLabel, QMenu, QTreeWidgetItem, QVBoxLayout, QWidget
+from PyQt5.QtCore import (QAbstractItemModel, QModelIndex, QPoint, QSortFilterProxyModel,
+    Qt, QTimer, QVariant)
+from PyQt5.QtGui import QBrush, QColor, QFont, QFontMetrics, QIcon
+from PyQt5.QtWidgets import (QAbstractItemView, QHeaderView, QLabel, QMenu, QTableView,
+    QVBoxLayout, QWidget)
 
 from electrumsv.app_state import app_state
 from electrumsv.bitcoin import COINBASE_MATURITY
@@ -42,13 +44,15 @@ from electrumsv.constants import TxFlags
 from electrumsv.i18n import _
 from electrumsv.logs import logs
 from electrumsv.platform import platform
-from electrumsv.util import timestamp_to_datetime, profiler, format_time
-from electrumsv.wallet import AbstractAccount
+from electrumsv.transaction import Transaction
+from electrumsv.util import profiler, format_time
+from electrumsv.wallet import AbstractAccount, HistoryLine
+from electrumsv.wallet_database.tables import KeyInstanceRow
 import electrumsv.web as web
 
 from .constants import ICON_NAME_INVOICE_PAYMENT
 from .table_widgets import TableTopButtonLayout
-from .util import MyTreeWidget, read_QIcon, MessageBox, SortableTreeWidgetItem
+from .util import get_source_index, MessageBox, read_QIcon
 
 if TYPE_CHECKING:
     from .main_window import ElectrumWindow
@@ -107,218 +111,480 @@ class Columns(enum.IntEnum):
     FIAT_AMOUNT = 6
     FIAT_BALANCE = 7
 
+FIAT_COLUMNS = (Columns.FIAT_AMOUNT, Columns.FIAT_BALANCE)
+
+# How many lines of history are fetched from the account at a time, as rows are displayed.
+PAGE_SIZE = 100
+# The roles that need the line of history for the row to be read.
+ROW_DATA_ROLES = { Qt.DisplayRole, Qt.EditRole, Qt.DecorationRole, Qt.ToolTipRole,
+    Qt.ForegroundRole }
+
+
+class _HistoryRow:
+    """
+    The display data for a line of history. This is only created when the row is displayed.
+    """
+    def __init__(self, view: 'HistoryList', line: HistoryLine, balance: int,
+            block_timestamp: Optional[int]) -> None:
+        self.tx_hash = line.tx_hash
+        self.tx_flags = line.tx_flags
+        self.height = line.height
+        self.value_delta = line.value_delta
+
+        account = view._account
+        self.conf = 0 if line.height <= 0 else \
+            max(account._wallet.get_local_height() - line.height + 1, 0)
+        timestamp: Union[bool, int] = False
+        if line.height > 0:
+            if block_timestamp is None:
+                view._on_missing_header(line.height)
+            else:
+                timestamp = block_timestamp
+        self.status = get_tx_status(account, line.tx_hash, line.height, self.conf, timestamp)
+
+        self.texts: List[Optional[str]] = [ None, hash_to_hex_str(line.tx_hash),
+            get_tx_desc(self.status, timestamp), account._wallet.get_transaction_label(
+                line.tx_hash), app_state.format_amount(line.value_delta, True, whitespaces=True),
+            app_state.format_amount(balance, whitespaces=True), None, None ]
+        self.balance = balance
+        self.fiat_timestamp = int(time.time()) if self.conf <= 0 else int(timestamp)
+
+
+class _ItemModel(QAbstractItemModel):
+    """
+    The history of the account in display order, where only the transaction hashes are held for
+    every line. The display data for a row is fetched and formatted the first time it is shown,
+    a page of lines at a time.
+    """
+    def __init__(self, parent: 'HistoryList', column_names: List[str]) -> None:
+        super().__init__(parent)
+
+        self._view = parent
+        self._column_names = column_names
+        self._tx_hashes: List[bytes] = []
+        self._rows: Dict[int, _HistoryRow] = {}
+        # Whether the history has been found to differ from the transaction hashes, in which
+        # case no more lines are read until the view has been updated.
+        self._is_stale = False
+
+        self._monospace_font = QFont(platform.monospace_font)
+        self._withdrawal_brush = QBrush(QColor("#BC1E1E"))
+        self._invoice_icon = read_QIcon(ICON_NAME_INVOICE_PAYMENT)
+
+    def set_column_names(self, column_names: List[str]) -> None:
+        self._column_names = column_names[:]
+        self.headerDataChanged.emit(Qt.Horizontal, 0, len(self._column_names)-1)
+
+    def get_tx_hash(self, row_index: int) -> bytes:
+        return self._tx_hashes[row_index]
+
+    def get_row(self, row_index: int) -> Optional[_HistoryRow]:
+        """
+        The display data for the row. If the history has changed since the transaction hashes
+        were last updated, the lines that no longer match are not shown and an update of the
+        view is scheduled.
+        """
+        row = self._rows.get(row_index)
+        if row is None and not self._is_stale:
+            page_start = row_index - row_index % PAGE_SIZE
+            lines = self._view._read_lines(page_start, PAGE_SIZE)
+            block_timestamps = app_state.header_timestamps.timestamps_for_heights(
+                [ line.height for line, _balance in lines ])
+            rows = [ _HistoryRow(self._view, line, balance, block_timestamp)
+                for (line, balance), block_timestamp in zip(lines, block_timestamps) ]
+            fx = app_state.fx
+            if fx and fx.show_history():
+                timestamps = [ row.fiat_timestamp for row in rows ]
+                value_texts = fx.historical_value_strs([ row.value_delta for row in rows ],
+                    timestamps)
+                balance_texts = fx.historical_value_strs([ row.balance for row in rows ],
+                    timestamps)
+                for row, value_text, balance_text in zip(rows, value_texts, balance_texts):
+                    row.texts[Columns.FIAT_AMOUNT] = value_text
+                    row.texts[Columns.FIAT_BALANCE] = balance_text
+            for i, page_row in enumerate(rows):
+                if page_start + i < len(self._tx_hashes) and \
+                        page_row.tx_hash == self._tx_hashes[page_start + i]:
+                    self._rows[page_start + i] = page_row
+                else:
+                    self._is_stale = True
+            if self._is_stale:
+                self._view._schedule_update()
+            row = self._rows.get(row_index)
+        return row
+
+    def set_tx_hashes(self, tx_hashes: List[bytes]) -> None:
+        """
+        Apply the difference between the current and the given lines of history, as a removal
+        of the old differing rows and an insertion of the new differing rows. Changes are almost
+        always to the most recent lines, so this is usually a small number of rows.
+        """
+        old_tx_hashes = self._tx_hashes
+        old_count, new_count = len(old_tx_hashes), len(tx_hashes)
+        common_count = min(old_count, new_count)
+        prefix_count = 0
+        while prefix_count < common_count and \
+                old_tx_hashes[prefix_count] == tx_hashes[prefix_count]:
+            prefix_count += 1
+        suffix_count = 0
+        while suffix_count < common_count - prefix_count and \
+                old_tx_hashes[old_count-1-suffix_count] == tx_hashes[new_count-1-suffix_count]:
+            suffix_count += 1
+
+        # Any change to the lines also changes the running balances, so all cached rows go.
+        self._rows.clear()
+        self._is_stale = False
+        if old_count - suffix_count > prefix_count:
+            self.beginRemoveRows(QModelIndex(), prefix_count, old_count - suffix_count - 1)
+            self._tx_hashes = old_tx_hashes[:prefix_count] + \
+                old_tx_hashes[old_count-suffix_count:]
+            self.endRemoveRows()
+        if new_count - suffix_count > prefix_count:
+            self.beginInsertRows(QModelIndex(), prefix_count, new_count - suffix_count - 1)
+            self._tx_hashes = tx_hashes
+            self.endInsertRows()
+        self._tx_hashes = tx_hashes
+
+    def invalidate_rows(self) -> None:
+        self._rows.clear()
+        if len(self._tx_hashes):
+            self.dataChanged.emit(self.createIndex(0, 0),
+                self.createIndex(len(self._tx_hashes)-1, len(self._column_names)-1))
+
+    def invalidate_column(self, column_index: int) -> None:
+        self._rows.clear()
+        if len(self._tx_hashes):
+            self.dataChanged.emit(self.createIndex(0, column_index),
+                self.createIndex(len(self._tx_hashes)-1, column_index))
+
+    # Overridden methods:
+
+    def columnCount(self, model_index: QModelIndex) -> int:
+        return len(self._column_names)
+
+    def data(self, model_index: QModelIndex, role: int) -> Any:
+        if not model_index.isValid():
+            return None
+        row_index = model_index.row()
+        column = model_index.column()
+        if row_index >= len(self._tx_hashes) or column >= len(self._column_names):
+            return None
+
+        if role == Qt.FontRole:
+            if column != Columns.DATE:
+                return self._monospace_font
+            return None
+        elif role == Qt.TextAlignmentRole:
+            if column > Columns.DESCRIPTION:
+                return Qt.AlignRight | Qt.AlignVCenter
+            return Qt.AlignLeft | Qt.AlignVCenter
+        elif role not in ROW_DATA_ROLES:
+            return None
+
+        row = self.get_row(row_index)
+        if row is None:
+            return None
+        if role == Qt.DisplayRole or role == Qt.EditRole:
+            return row.texts[column]
+        elif role == Qt.DecorationRole:
+            if column == Columns.STATUS:
+                return get_tx_icon(row.status)
+            elif column == Columns.DESCRIPTION:
+                if row.tx_flags & TxFlags.PaysInvoice:
+                    return self._invoice_icon
+        elif role == Qt.ToolTipRole:
+            if column == Columns.STATUS:
+                return get_tx_tooltip(row.status, row.conf)
+        elif role == Qt.ForegroundRole:
+            if column in (Columns.DESCRIPTION, Columns.AMOUNT):
+                if row.value_delta < 0:
+                    return self._withdrawal_brush
+        return None
+
+    def flags(self, model_index: QModelIndex) -> int:
+        if model_index.isValid():
+            flags = super().flags(model_index)
+            if model_index.column() == Columns.DESCRIPTION:
+                flags |= Qt.ItemIsEditable
+            return flags
+        return Qt.ItemIsEnabled
+
+    def headerData(self, section: int, orientation: int, role: int) -> Any:
+        if orientation == Qt.Horizontal and role == Qt.DisplayRole:
+            if section < len(self._column_names):
+                return self._column_names[section]
+        return None
 
-class HistoryList(MyTreeWidget):
+    def index(self, row_index: int, column_index: int, parent: Any) -> QModelIndex:
+        if self.hasIndex(row_index, column_index, parent):
+            return self.createIndex(row_index, column_index)
+        return QModelIndex()
+
+    def parent(self, model_index: QModelIndex) -> QModelIndex:
+        return QModelIndex()
+
+    def rowCount(self, model_index: QModelIndex) -> int:
+        if model_index.isValid():
+            return 0
+        return len(self._tx_hashes)
+
+    def setData(self, model_index: QModelIndex, value: QVariant, role: int) -> bool:
+        if model_index.isValid() and role == Qt.EditRole and \
+                model_index.column() == Columns.DESCRIPTION:
+            text = value.strip() or None
+            tx_hash = self._tx_hashes[model_index.row()]
+            self._view._wallet.set_transaction_label(tx_hash, text)
+            self._view._main_window.history_view.update_tx_labels()
+            return True
+        return False
+
+
+class _SortFilterProxyModel(QSortFilterProxyModel):
+    """
+    The history is only displayed in order, as the running balance depends on it. This is only
+    used to filter the displayed lines, which only reads every row if there is a filter.
+    """
+    _filter_match: Optional[str] = None
+
+    def set_filter_match(self, text: Optional[str]) -> None:
+        self._filter_match = text.lower() if text else None
+        self.invalidateFilter()
+
+    def filterAcceptsRow(self, source_row: int, source_parent: QModelIndex) -> bool:
+        match = self._filter_match
+        if match is None:
+            return True
+
+        source_model = self.sourceModel()
+        for column in HistoryList.filter_columns:
+            column_index = source_model.index(source_row, column, source_parent)
+            cell_data = source_model.data(column_index, Qt.DisplayRole)
+            if cell_data and match in cell_data.lower():
+                return True
+        return False
+
+
+class HistoryList(QTableView):
     filter_columns = [ Columns.DATE, Columns.DESCRIPTION, Columns.AMOUNT ]
-    ACCOUNT_ROLE = Qt.UserRole
-    TX_ROLE = Qt.UserRole + 2
 
     def __init__(self, parent: QWidget, main_window: 'ElectrumWindow') -> None:
-        MyTreeWidget.__init__(self, parent, main_window, self.create_menu, [], Columns.DESCRIPTION)
+        super().__init__(parent)
 
         self._main_window = weakref.proxy(main_window)
         self._account_id: Optional[int] = None
         self._account: AbstractAccount = None
         self._wallet = main_window._wallet
+        self.config = main_window.config
+
+        # The lines of history for a domain of keys, if this is not the account history.
+        self._domain_history: List[Tuple[HistoryLine, int]] = []
+        self._missing_header_heights: Set[int] = set()
+
+        self._base_model = _ItemModel(self, self._get_column_names())
+        self._proxy_model = _SortFilterProxyModel()
+        self._proxy_model.setSourceModel(self._base_model)
+        self.setModel(self._proxy_model)
+
+        self.verticalHeader().setVisible(False)
+        self.setAlternatingRowColors(True)
+        self.setShowGrid(False)
+        self.setWordWrap(False)
+        self.setVerticalScrollMode(QAbstractItemView.ScrollPerPixel)
+        self.setSelectionBehavior(QAbstractItemView.SelectRows)
+        self.setSelectionMode(QAbstractItemView.SingleSelection)
+        self.setEditTriggers(QAbstractItemView.EditKeyPressed)
+        self.setColumnHidden(Columns.TX_ID, True)
+        self._set_fiat_columns_enabled()
+
+        # We set the columm widths so that rendering is instant rather than taking a second or two
+        # because ResizeToContents does not scale for thousands of rows.
+        default_font_metrics = QFontMetrics(app_state.app.font())
+        monospace_font_metrics = QFontMetrics(QFont(platform.monospace_font))
+        def mw(s: str) -> int:
+            return monospace_font_metrics.boundingRect(s).width() + 10
+        amount_width = mw(app_state.format_amount(-1234567.12345678, True, whitespaces=True))
+        horizontal_header = self.horizontalHeader()
+        horizontal_header.setMinimumSectionSize(20)
+        horizontal_header.setStretchLastSection(False)
+        horizontal_header.resizeSection(Columns.STATUS, 30)
+        horizontal_header.resizeSection(Columns.DATE,
+            default_font_metrics.boundingRect("2020-12-31 23:59").width() + 20)
+        horizontal_header.setSectionResizeMode(Columns.DESCRIPTION, QHeaderView.Stretch)
+        for column in (Columns.AMOUNT, Columns.BALANCE):
+            horizontal_header.resizeSection(column, amount_width)
+        for column in FIAT_COLUMNS:
+            horizontal_header.resizeSection(column, mw("1,234,567.00"))
+
+        vertical_header = self.verticalHeader()
+        vertical_header.setSectionResizeMode(QHeaderView.Fixed)
+        vertical_header.setDefaultSectionSize(default_font_metrics.height() + 4)
+
+        self.setContextMenuPolicy(Qt.CustomContextMenu)
+        self.customContextMenuRequested.connect(self.create_menu)
+        self.doubleClicked.connect(self._event_double_clicked)
+
+        # The wallet events are coalesced and applied together after a short delay.
+        self._update_timer = QTimer(self)
+        self._update_timer.setSingleShot(True)
+        self._update_timer.setInterval(250)
+        self._update_timer.timeout.connect(self.update)
+        self._backfill_timer = QTimer(self)
+        self._backfill_timer.setSingleShot(True)
+        self._backfill_timer.setInterval(0)
+        self._backfill_timer.timeout.connect(self._backfill_missing_headers)
 
         self._main_window.account_change_signal.connect(self._on_account_change)
+        self._main_window.transaction_state_signal.connect(self._on_transaction_state_change)
+        self._main_window.transaction_added_signal.connect(self._on_transaction_added)
+        self._main_window.transaction_deleted_signal.connect(self._on_transaction_deleted)
+        self._main_window.keys_updated_signal.connect(self._on_keys_updated)
 
-        self.update_tx_headers()
-
-        self.setUniformRowHeights(True)
-        self.setColumnHidden(Columns.TX_ID, True)
-        self.setSortingEnabled(True)
-        self.sortByColumn(Columns.STATUS, Qt.DescendingOrder)
-
-        self.monospace_font = QFont(platform.monospace_font)
-        self.withdrawalBrush = QBrush(QColor("#BC1E1E"))
-        self.invoiceIcon = read_QIcon(ICON_NAME_INVOICE_PAYMENT)
+    def _get_column_names(self) -> List[str]:
+        column_names = ['', '', _('Date'), _('Description') , _('Amount'), _('Balance'), '', '']
+        fx = app_state.fx
+        if fx and fx.show_history():
+            column_names[Columns.FIAT_AMOUNT] = '%s '%fx.ccy + _('Amount')
+            column_names[Columns.FIAT_BALANCE] = '%s '%fx.ccy + _('Balance')
+        return column_names
 
-        # self._delegate = ItemDelegate(None, 50)
-        # self.setItemDelegate(self._delegate)
+    def _set_fiat_columns_enabled(self) -> None:
+        fx = app_state.fx
+        enabled = bool(fx and fx.show_history())
+        for column in FIAT_COLUMNS:
+            self.setColumnHidden(column, not enabled)
 
     def _on_account_change(self, new_account_id: int, new_account: AbstractAccount) -> None:
-        self.clear()
-        old_account_id = self._account_id
         self._account_id = new_account_id
         self._account = new_account
-
-    def on_edited(self, item: QTreeWidgetItem, column: int, prior_text: str) -> None:
-        '''Called only when the text actually changes'''
-        text = item.text(column).strip()
-        if text == "":
-            text = None
-        tx_hash = item.data(Columns.STATUS, self.TX_ROLE)
-        self._main_window._wallet.set_transaction_label(tx_hash, text)
-        self._main_window.history_view.update_tx_labels()
-
-    def update_tx_headers(self) -> None:
-        headers = ['', '', _('Date'), _('Description') , _('Amount'), _('Balance')]
-        fx = app_state.fx
-        if fx and fx.show_history():
-            headers.extend(['%s '%fx.ccy + _('Amount'), '%s '%fx.ccy + _('Balance')])
-        self.update_headers(headers)
+        self._domain_history = []
+        self._base_model.set_tx_hashes([])
+
+    def _validate_account_event(self, account_ids: Set[int]) -> bool:
+        return self._account_id in account_ids
+
+    def _schedule_update(self) -> None:
+        if not self._update_timer.isActive():
+            self._update_timer.start()
+
+    def _on_transaction_state_change(self, account_id: int, tx_hash: bytes, old_state: TxFlags,
+            new_state: TxFlags) -> None:
+        if self._validate_account_event({ account_id }):
+            self._schedule_update()
+
+    def _on_transaction_added(self, tx_hash: bytes, tx: Transaction, account_ids: Set[int]) \
+            -> None:
+        if self._validate_account_event(account_ids):
+            self._schedule_update()
+
+    def _on_transaction_deleted(self, account_id: int, tx_hash: bytes) -> None:
+        if self._validate_account_event({ account_id }):
+            self._schedule_update()
+
+    def _on_keys_updated(self, account_id: int, keys: Iterable[KeyInstanceRow]) -> None:
+        # Key usage changes the value of lines in the history, but not which transactions.
+        if self._validate_account_event({ account_id }):
+            self._schedule_update()
+
+    def _on_missing_header(self, height: int) -> None:
+        self._missing_header_heights.add(height)
+        if not self._backfill_timer.isActive():
+            self._backfill_timer.start()
+
+    def _backfill_missing_headers(self) -> None:
+        network = self._main_window.network
+        heights = self._missing_header_heights
+        self._missing_header_heights = set()
+        if network is None:
+            return
+        server_height = network.get_server_height()
+        backfill_heights = [ height for height in heights if height <= server_height ]
+        for height in heights:
+            if height > server_height:
+                logger.debug("Unable to backfill header at %d (> %d)", height, server_height)
+        if len(backfill_heights):
+            network.backfill_headers_at_heights(backfill_heights)
 
     def get_domain(self) -> Optional[List[int]]:
         '''Replaced in address_dialog.py'''
         return None
 
-    def on_update(self) -> None:
-        self._on_update_history_list()
+    def _read_lines(self, offset: int, count: int) -> List[Tuple[HistoryLine, int]]:
+        if self.get_domain() is None:
+            return self._account.get_history_page(offset, count)
+        return self._domain_history[offset:offset+count]
+
+    def update_tx_headers(self) -> None:
+        self._base_model.set_column_names(self._get_column_names())
+        self._set_fiat_columns_enabled()
 
     @profiler
-    def _on_update_history_list(self) -> None:
-        item = self.currentItem()
-        current_tx_hash = item.data(Columns.STATUS, self.TX_ROLE) if item else None
-        self.clear()
+    def update(self) -> None:
+        self._update_timer.stop()
         if self._account is None:
             return
+
         fx = app_state.fx
         if fx:
             fx.history_used_spot = False
-        local_height = self._wallet.get_local_height()
-        server_height = self._main_window.network.get_server_height() if self._main_window.network \
-            else 0
-        header_at_height = app_state.headers.header_at_height
-        chain = app_state.headers.longest_chain()
-        missing_header_heights = []
-        items = []
-        for line, balance in self._account.get_history(self.get_domain()):
-            tx_id = hash_to_hex_str(line.tx_hash)
-            conf = 0 if line.height <= 0 else max(local_height - line.height + 1, 0)
-            timestamp = False
-            if line.height > 0:
-                try:
-                    timestamp = header_at_height(chain, line.height).timestamp
-                except MissingHeader:
-                    if line.height <= server_height:
-                        missing_header_heights.append(line.height)
-                    else:
-                        logger.debug("Unable to backfill header at %d (> %d)",
-                            line.height, server_height)
-            status = get_tx_status(self._account, line.tx_hash, line.height, conf, timestamp)
-            status_str = get_tx_desc(status, timestamp)
-            v_str = app_state.format_amount(line.value_delta, True, whitespaces=True)
-            balance_str = app_state.format_amount(balance, whitespaces=True)
-            label = self._wallet.get_transaction_label(line.tx_hash)
-            entry = [None, tx_id, status_str, label, v_str, balance_str]
-            if fx and fx.show_history():
-                date = timestamp_to_datetime(time.time() if conf <= 0 else timestamp)
-                for amount in [line.value_delta, balance]:
-                    text = fx.historical_value_str(amount, date)
-                    entry.append(text)
-
-            item = SortableTreeWidgetItem(entry)
-            # If there is no text,
-            item.setIcon(Columns.STATUS, get_tx_icon(status))
-            item.setToolTip(Columns.STATUS, get_tx_tooltip(status, conf))
-            if line.tx_flags & TxFlags.PaysInvoice:
-                item.setIcon(Columns.DESCRIPTION, self.invoiceIcon)
-            for i in range(len(entry)):
-                if i > Columns.DESCRIPTION:
-                    item.setTextAlignment(i, Qt.AlignRight | Qt.AlignVCenter)
-                else:
-                    item.setTextAlignment(i, Qt.AlignLeft | Qt.AlignVCenter)
-                if i != Columns.DATE:
-                    item.setFont(i, self.monospace_font)
-            if line.value_delta and line.value_delta < 0:
-                item.setForeground(Columns.DESCRIPTION, self.withdrawalBrush)
-                item.setForeground(Columns.AMOUNT, self.withdrawalBrush)
-            item.setData(Columns.STATUS, SortableTreeWidgetItem.DataRole, line.sort_key)
-            item.setData(Columns.DATE, SortableTreeWidgetItem.DataRole, line.sort_key)
-            item.setData(Columns.STATUS, self.ACCOUNT_ROLE, self._account_id)
-            item.setData(Columns.STATUS, self.TX_ROLE, line.tx_hash)
-
-            # self.insertTopLevelItem(0, item)
-            if current_tx_hash == line.tx_hash:
-                self.setCurrentItem(item)
-
-            items.append(item)
-
-        self.addTopLevelItems(items)
-
-        if len(missing_header_heights) and self._main_window.network:
-            self._main_window.network.backfill_headers_at_heights(missing_header_heights)
-
-    def on_doubleclick(self, item: QTreeWidgetItem, column: int) -> None:
-        if self.permit_edit(item, column):
-            super(HistoryList, self).on_doubleclick(item, column)
+
+        domain = self.get_domain()
+        if domain is None:
+            tx_hashes = self._account.get_history_tx_hashes()
         else:
-            account_id = item.data(Columns.STATUS, self.ACCOUNT_ROLE)
-            tx_hash = item.data(Columns.STATUS, self.TX_ROLE)
+            self._domain_history = self._account.get_history(set(domain))
+            tx_hashes = [ line.tx_hash for line, _balance in self._domain_history ]
+        self._base_model.set_tx_hashes(tx_hashes)
+        # Only the displayed rows are read again.
+        self._base_model.invalidate_rows()
+        if self._proxy_model._filter_match is not None:
+            self._proxy_model.invalidateFilter()
+
+    def filter(self, text: Optional[str]) -> None:
+        self._proxy_model.set_filter_match(text)
+
+    def _get_source_row(self, model_index: QModelIndex) -> int:
+        return get_source_index(model_index, _ItemModel).row()
+
+    def _event_double_clicked(self, model_index: QModelIndex) -> None:
+        base_index = get_source_index(model_index, _ItemModel)
+        if base_index.column() == Columns.DESCRIPTION:
+            self.edit(model_index)
+            return
 
-            account = self._wallet.get_account(account_id)
-            tx = account.get_transaction(tx_hash)
-            if tx is not None:
-                self._main_window.show_transaction(account, tx)
-            else:
-                MessageBox.show_error(_("The full transaction is not yet present in your wallet."+
-                    " Please try again when it has been obtained from the network."))
+        tx_hash = self._base_model.get_tx_hash(base_index.row())
+        tx = self._account.get_transaction(tx_hash)
+        if tx is not None:
+            self._main_window.show_transaction(self._account, tx)
+        else:
+            MessageBox.show_error(_("The full transaction is not yet present in your wallet."+
+                " Please try again when it has been obtained from the network."))
 
     def update_tx_labels(self) -> None:
-        root = self.invisibleRootItem()
-        child_count = root.childCount()
-        for i in range(child_count):
-            item = root.child(i)
-            tx_hash = item.data(Columns.STATUS, self.TX_ROLE)
-            label = self._wallet.get_transaction_label(tx_hash)
-            item.setText(Columns.DESCRIPTION, label)
+        self._base_model.invalidate_column(Columns.DESCRIPTION)
 
     # From the wallet 'verified' event.
     def update_tx_item(self, tx_hash: bytes, height: int, conf: int, timestamp: int) -> None:
         # External event may be called before the UI element has an account.
         if self._account is None:
             return
-
-        status = get_tx_status(self._account, tx_hash, height, conf, timestamp)
-        tx_id = hash_to_hex_str(tx_hash)
-        items = self.findItems(tx_id, self.TX_ROLE | Qt.MatchContains | Qt.MatchRecursive,
-            column=Columns.TX_ID)
-        if items:
-            item = items[0]
-            item.setIcon(Columns.STATUS, get_tx_icon(status))
-            item.setText(Columns.DATE, get_tx_desc(status, timestamp))
-            item.setToolTip(Columns.STATUS, get_tx_tooltip(status, conf))
-
-            # NOTE: This is a damned if you do and damned if you don't situation.
-            # - If we update the now verified row then it is not guaranteed to be in final order.
-            #   It will have been in order of date added to wallet before the update, and after
-            #   the naive display update above will still be in that order. But on the next list
-            #   update it will be in block order (height, position). CURRENT PROBLEM
-            # - If we update the sorting information without correcting all the balances, then
-            #   the balances will be out of order. WORSE PROBLEM.
-
-            # NOTE: Update the balances and then update the sorting keys and it is correct?
-            #       Manually updating the balances could be painful as we need to preserve the
-            #       value_delta and regenerate the balance, the fiat value (if applicable) and
-            #       the fiat balance (if applicable). And we need to do it in the order of sorting.
-            #       At this point, the painfulness of this, seems to suggest we would be better off
-            #       rewriting this whole thing to be paging based.
-
-            # # Consistent sorting.
-            # metadata = self._wallet._transaction_cache.get_metadata(tx_hash)
-            # sort_key = height, metadata.position
-            # item.setData(Columns.STATUS, SortableTreeWidgetItem.DataRole, sort_key)
-            # item.setData(Columns.DATE, SortableTreeWidgetItem.DataRole, sort_key)
+        # The verified transaction may have moved to its final place in the history, which also
+        # changes the running balances of the lines after it.
+        self._schedule_update()
 
     def create_menu(self, position: QPoint) -> None:
-        self.selectedIndexes()
-        item = self.currentItem()
-        if not item:
-            return
-        column = self.currentColumn()
-        account_id = item.data(Columns.STATUS, self.ACCOUNT_ROLE)
-        tx_hash = item.data(Columns.STATUS, self.TX_ROLE)
-        if account_id is None or tx_hash is None:
+        menu_index = self.indexAt(position)
+        if not menu_index.isValid():
             return
+        base_index = get_source_index(menu_index, _ItemModel)
+        column = base_index.column()
+        account = self._account
+        tx_hash = self._base_model.get_tx_hash(base_index.row())
         if column == 0:
             column_title = "ID"
             column_data = hash_to_hex_str(tx_hash)
         else:
-            column_title = self.headerItem().text(column)
-            column_data = item.text(column).strip()
-
-        account = self._wallet.get_account(account_id)
+            column_title = self._base_model.headerData(column, Qt.Horizontal, Qt.DisplayRole)
+            column_data = (self._base_model.data(base_index, Qt.DisplayRole) or "").strip()
 
         tx_id = hash_to_hex_str(tx_hash)
         tx_URL = web.BE_URL(self.config, 'tx', tx_id)
@@ -330,20 +596,17 @@ class HistoryList(MyTreeWidget):
         menu = QMenu()
         menu.addAction(_("Copy {}").format(column_title),
             lambda: self._main_window.app.clipboard().setText(column_data))
-        if column in self.editable_columns:
-            # We grab a fresh reference to the current item, as it has been deleted in a
-            # reported issue.
-            menu.addAction(_("Edit {}").format(column_title),
-                lambda: self.currentItem() and self.editItem(self.currentItem(), column))
+        if column == Columns.DESCRIPTION:
+            menu.addAction(_("Edit {}").format(column_title), lambda: self.edit(menu_index))
         menu.addAction(_("Details"), lambda: self._main_window.show_transaction(account, tx))
         if is_unconfirmed and tx:
             child_tx = account.cpfp(tx, 0)
             if child_tx:
                 menu.addAction(_("Child pays for parent"),
                     lambda: self._main_window.cpfp(account, tx, child_tx))
-        entry = self._account.get_transaction_entry(tx_hash)
+        entry = account.get_transaction_entry(tx_hash)
         if entry.flags & TxFlags.PaysInvoice:
-            invoice_row = self._account.invoices.get_invoice_for_tx_hash(tx_hash)
+            invoice_row = account.invoices.get_invoice_for_tx_hash(tx_hash)
             invoice_id = invoice_row.invoice_id if invoice_row is not None else None
             action = menu.addAction(read_QIcon(ICON_NAME_INVOICE_PAYMENT), _("View invoice"),
                     partial(self._show_invoice_window, invoice_id))
@@ -2051,18 +2051,39 @@ class ElectrumWindow(QMainWindow, MessageBoxMixin):
         if filename_ext not in (".csv", ".json"):
             return
 
-        try:
-            self._do_export_history(self._account, export_filename, filename_ext == ".csv")
-        except (IOError, os.error) as reason:
-            export_error_label = _("ElectrumSV was unable to produce a transaction export.")
-            self.show_critical(export_error_label + "\n" + str(reason),
-                               title=_("Unable to export history"))
-            return
+        account = self._account
+        def export_history(update_cb: WaitingUpdateCallback) -> List[Dict[str, Any]]:
+            # non-GUI thread
+            # This may wait for the headers of the exported lines to be fetched.
+            history = account.export_history()
+            update_cb(False, _("Done."))
+            return history
+
+        def on_done(future: concurrent.futures.Future) -> None:
+            # GUI thread
+            try:
+                history = future.result()
+            except concurrent.futures.CancelledError:
+                return
+            except Exception as exc:
+                self.on_exception(exc)
+                return
+
+            try:
+                self._do_export_history(history, export_filename, filename_ext == ".csv")
+            except (IOError, os.error) as reason:
+                export_error_label = _("ElectrumSV was unable to produce a transaction export.")
+                self.show_critical(export_error_label + "\n" + str(reason),
+                                   title=_("Unable to export history"))
+                return
+
+            self.show_message(_("Your wallet history has been successfully exported."))
 
-        self.show_message(_("Your wallet history has been successfully exported."))
+        WaitingDialog(self, _('Exporting history...'), export_history, on_done=on_done,
+            title=_("Export history"))
 
-    def _do_export_history(self, account: AbstractAccount, fileName: str, is_csv: bool) -> None:
-        history = account.export_history()
+    def _do_export_history(self, history: List[Dict[str, Any]], fileName: str,
+            is_csv: bool) -> None:
         lines = []
         for item in history:
             if is_csv:
@@ -68,7 +68,7 @@ class NetworkDialog(QDialog):
         vbox.addLayout(buttons_layout)
 
         self.network_updated_signal.connect(self.on_update)
-        network.register_callback(self.on_network, ['updated', 'sessions'])
+        network.register_callback(self.on_network, ['updated', 'sessions', 'header_sync'])
 
     def on_network(self, event, *args):
         ''' This may run in network thread '''
@@ -382,6 +382,10 @@ class NetworkChoiceLayout(object):
         self.enable_set_server()
 
         height_str = "%d "%(self.network.get_local_height()) + _('blocks')
+        if self.network.header_sync_progress is not None:
+            sync_height, sync_target_height = self.network.header_sync_progress
+            height_str += " " + _("(downloading headers {:,d} of {:,d})").format(
+                sync_height, sync_target_height)
         self.height_label.setText(height_str)
         n = len(self.network.sessions)
         status = _("Connected to {:d} servers.").format(n) if n else _("Not connected")
@@ -40,7 +40,7 @@ from PyQt5.QtGui import QBrush, QCursor, QFont
 from PyQt5.QtWidgets import (QDialog, QLabel, QMenu, QPushButton, QHBoxLayout,
     QToolTip, QTreeWidgetItem, QVBoxLayout, QWidget)
 
-from bitcoinx import hash_to_hex_str, MissingHeader, Unknown_Output
+from bitcoinx import hash_to_hex_str, Unknown_Output
 
 from electrumsv.app_state import app_state
 from electrumsv.bitcoin import base_encode, script_bytes_to_asm
@@ -731,12 +731,7 @@ class TxDialog(QDialog, MessageBoxMixin):
                 fee = metadata.fee
 
                 if metadata.height is not None and metadata.height > 0:
-                    chain = app_state.headers.longest_chain()
-                    try:
-                        header = app_state.headers.header_at_height(chain, metadata.height)
-                        date_mined = header.timestamp
-                    except MissingHeader:
-                        pass
+                    date_mined = app_state.header_timestamps.timestamp_at_height(metadata.height)
 
                 label = wallet.get_transaction_label(self._tx_hash)
 
@@ -22,6 +22,7 @@
 # SOFTWARE.
 
 from collections import defaultdict
+from concurrent.futures import Executor
 import hashlib
 import json
 from typing import Any, cast, Dict, List, Optional, Sequence, Tuple, Union
@@ -30,8 +31,9 @@ from unicodedata import normalize
 from bitcoinx import (
     PrivateKey, PublicKey, BIP32PrivateKey, BIP32PublicKey,
     int_to_be_bytes, be_bytes_to_int, CURVE_ORDER,
-    bip32_key_from_string, bip32_decompose_chain_string, Base58Error, hash160
+    bip32_key_from_string, bip32_decompose_chain_string, Base58Error, hash160, pack_be_uint32
 )
+from bitcoinx.hashes import hmac_sha512_halves
 
 from .i18n import _
 from .app_state import app_state
@@ -48,6 +50,37 @@ from .wallet_database.tables import KeyInstanceRow, MasterKeyRow
 
 logger = logs.get_logger("keystore")
 
+# The number of child keys derived by each task when bulk derivation is spread over an executor.
+DERIVATION_CHUNK_SIZE = 500
+
+
+def derive_child_pubkeys(parent_key: BIP32PublicKey, first_index: int, count: int) \
+        -> List[PublicKey]:
+    """
+    Derive the public keys for a contiguous range of child indexes of the given parent. This
+    gives the same keys as `child_safe` but the parent is only serialised once, and the
+    children are plain public keys without the BIP32 metadata that would need to be
+    calculated for them.
+    """
+    parent_bytes = parent_key.to_bytes()
+    chain_code = parent_key.derivation().chain_code
+    public_keys: List[PublicKey] = []
+    for n in range(first_index, first_index + count):
+        L, _R = hmac_sha512_halves(chain_code, parent_bytes + pack_be_uint32(n))
+        try:
+            public_keys.append(parent_key.add(L))
+        except ValueError:
+            # The vanishingly rare invalid child, which `child_safe` knows how to skip.
+            public_keys.append(parent_key.child_safe(n))
+    return public_keys
+
+
+def _derive_child_pubkey_bytes(parent_xpub: str, first_index: int, count: int) -> List[bytes]:
+    # Executor tasks exchange only picklable built-in types.
+    parent_key = bip32_key_from_string(parent_xpub)
+    return [ public_key.to_bytes() for public_key
+        in derive_child_pubkeys(parent_key, first_index, count) ]
+
 class KeyStore:
     derivation_type = DerivationType.NONE
     label: Optional[str] = None
@@ -364,7 +397,7 @@ class DerivablePaths:
 class Xpub(DerivablePaths):
     def __init__(self) -> None:
         self.xpub: Optional[str] = None
-        self._child_xpubs: Dict[Sequence[int], str] = {}
+        self._child_xpubs: Dict[Sequence[int], BIP32PublicKey] = {}
 
     def get_master_public_key(self) -> Optional[str]:
         return self.xpub
@@ -372,16 +405,36 @@ class Xpub(DerivablePaths):
     def get_fingerprint(self) -> bytes:
         return bip32_key_from_string(self.xpub).fingerprint()
 
-    def derive_pubkey(self, derivation_path: Sequence[int]) -> PublicKey:
-        parent_path = derivation_path[:-1]
-        xpub = self._child_xpubs.get(parent_path)
-        if xpub is None:
+    def _get_parent_key(self, parent_path: Sequence[int]) -> BIP32PublicKey:
+        parent_path = tuple(parent_path)
+        xpubkey = self._child_xpubs.get(parent_path)
+        if xpubkey is None:
             xpubkey = bip32_key_from_string(self.xpub)
             for n in parent_path:
                 xpubkey = xpubkey.child_safe(n)
-            xpub = xpubkey.to_extended_key_string()
-            self._child_xpubs[parent_path] = xpub
-        return self.get_pubkey_from_xpub(xpub, derivation_path[-1:])
+            self._child_xpubs[parent_path] = xpubkey
+        return xpubkey
+
+    def derive_pubkey(self, derivation_path: Sequence[int]) -> PublicKey:
+        return self._get_parent_key(derivation_path[:-1]).child_safe(derivation_path[-1])
+
+    def derive_pubkeys(self, parent_path: Sequence[int], first_index: int, count: int,
+            executor: Optional[Executor]=None) -> List[PublicKey]:
+        """
+        Derive the public keys for the `count` child indexes of the parent path starting with
+        `first_index`. If an executor is given, like a `ProcessPoolExecutor`, the work is split
+        into chunks and spread over it.
+        """
+        parent_key = self._get_parent_key(parent_path)
+        if executor is None or count <= DERIVATION_CHUNK_SIZE:
+            return derive_child_pubkeys(parent_key, first_index, count)
+
+        parent_xpub = parent_key.to_extended_key_string()
+        futures = [ executor.submit(_derive_child_pubkey_bytes, parent_xpub, index,
+                min(DERIVATION_CHUNK_SIZE, first_index + count - index))
+            for index in range(first_index, first_index + count, DERIVATION_CHUNK_SIZE) ]
+        return [ PublicKey.from_bytes(public_key_bytes) for future in futures
+            for public_key_bytes in future.result() ]
 
     @classmethod
     def get_pubkey_from_xpub(self, xpub: str, sequence: Sequence[int]) -> PublicKey:
@@ -597,6 +650,13 @@ class Old_KeyStore(DerivablePaths, Deterministic_KeyStore):
         assert len(derivation_path) == 2
         return self.get_pubkey_from_mpk(self.mpk, derivation_path)
 
+    def derive_pubkeys(self, parent_path: Sequence[int], first_index: int, count: int,
+            executor: Optional[Executor]=None) -> List[PublicKey]:
+        # Each key is only a hash and a point addition away from the master public key.
+        parent_path = tuple(parent_path)
+        return [ self.derive_pubkey(parent_path + (n,))
+            for n in range(first_index, first_index + count) ]
+
     def get_private_key_from_stretched_exponent(self, derivation_path: Sequence[int],
             secexp) -> bytes:
         assert len(derivation_path) == 2
@@ -47,6 +47,7 @@ from electrumsv.simple_config import SimpleConfig
 from electrumsv import startup
 from electrumsv.storage import WalletStorage
 from electrumsv.util import json_encode, json_decode, setup_thread_excepthook
+from electrumsv.util.timeline import timeline
 from electrumsv.wallet import Wallet
 
 
@@ -356,6 +357,8 @@ def main():
 
     config_options = get_config_options()
     logs.set_level(config_options['verbose'])
+    if config_options.get('startup_timeline'):
+        timeline.enable(config_options['startup_timeline'])
 
     if config_options.get('server'):
         config_options['auto_connect'] = False
@@ -23,21 +23,24 @@
 # SOFTWARE.
 import asyncio
 from collections import defaultdict
+import concurrent.futures
 from contextlib import suppress
 from enum import IntEnum
 from functools import partial
+import heapq
+import itertools
 import os
 import random
 import re
 import ssl
 import stat
 import time
-from typing import Any, Dict, List, Optional, TYPE_CHECKING, Tuple
+from typing import Any, Callable, Dict, Iterable, List, Optional, Set, TYPE_CHECKING, Tuple
 
 import certifi
 from aiorpcx import (
     connect_rs, RPCSession, Notification, BatchError, RPCError, CancelledError, SOCKSError,
-    TaskTimeout, TaskGroup, handler_invocation, sleep, ignore_after, timeout_after,
+    TaskTimeout, TaskGroup, handler_invocation, run_in_thread, sleep, ignore_after, timeout_after,
     SOCKS4a, SOCKS5, SOCKSProxy, SOCKSUserAuth, NewlineFramer
 )
 from bitcoinx import (
@@ -46,7 +49,7 @@ from bitcoinx import (
 )
 
 from .app_state import app_state
-from .bitcoin import scripthash_hex
+from .bitcoin import scripthash_bytes
 from .constants import ScriptType, TxFlags
 from .i18n import _
 from .logs import logs
@@ -69,6 +72,37 @@ REQUEST_MERKLE_PROOF = 'blockchain.transaction.get_merkle'
 SCRIPTHASH_HISTORY = 'blockchain.scripthash.get_history'
 SCRIPTHASH_SUBSCRIBE = 'blockchain.scripthash.subscribe'
 SCRIPTHASH_UNSUBSCRIBE = 'blockchain.scripthash.unsubscribe'
+# Missing transactions are fetched in batches of this many, with this many batches in flight.
+TX_FETCH_BATCH_SIZE = 50
+TX_FETCH_WINDOW = 4
+# Transactions that could not be fetched are retried, with a doubling delay between attempts.
+TX_FETCH_MAXIMUM_ATTEMPTS = 3
+TX_FETCH_RETRY_DELAY = 2.0
+# Merkle proofs are fetched in batches of this many, with this many batches in flight.
+PROOF_FETCH_BATCH_SIZE = 100
+PROOF_FETCH_WINDOW = 4
+# When the 'sync_sharding' config option is enabled, script hash subscriptions and transaction and
+# proof fetches are spread over up to this many healthy sessions following the main chain.
+SHARD_MAXIMUM_SESSIONS = 4
+# Histories obtained from a session other than the main session are cross-checked against the
+# main session at this interval. Sessions with too many histories that do not match are dropped
+# from the shards.
+SHARD_CROSS_CHECK_INTERVAL = 10
+SHARD_MAXIMUM_MISMATCHES = 3
+# Script hashes are subscribed and unsubscribed in batches of this many, with this many batches in
+# flight.
+SUBSCRIBE_BATCH_SIZE = 100
+SUBSCRIBE_WINDOW = 4
+# The scripts of large ranges of keys to subscribe to, like those of a restored account, are
+# derived over this many processes. Zero derives them in a thread instead.
+SUBSCRIBE_DERIVATION_PROCESSES = 2
+# Headers are downloaded in chunks of this many, with this many chunks in flight on each of up to
+# this many sessions. Chunks are connected in order, and at most this many chunks are buffered
+# ahead of the next chunk to connect.
+HEADER_CHUNK_SIZE = 2016
+HEADER_SYNC_WINDOW = 2
+HEADER_SYNC_MAXIMUM_SESSIONS = 4
+HEADER_SYNC_REORDER_CHUNKS = 16
 BROADCAST_TX_MSG_LIST = (
     ('dust', _('very small "dust" payments')),
     (('Missing inputs', 'Inputs unavailable', 'bad-txns-inputs-spent'),
@@ -124,10 +158,10 @@ def _require_string(obj):
     return obj
 
 
-def _history_status(history) -> Optional[str]:
+def _history_status(history: List[Tuple[bytes, int]]) -> Optional[str]:
     if not history:
         return None
-    status = ''.join(f'{tx_id}:{tx_height}:' for tx_id, tx_height in history)
+    status = ''.join(f'{hash_to_hex_str(tx_hash)}:{tx_height}:' for tx_hash, tx_height in history)
     return sha256(status.encode()).hex()
 
 
@@ -144,6 +178,54 @@ def _root_from_proof(hash, branch, index):
     return hash
 
 
+def _verify_block_proofs(merkle_root: bytes,
+        proofs: List[Tuple[bytes, List[bytes], int]]) -> List[bool]:
+    '''Verify the (tx_hash, branch, index) proofs for transactions in the same block.
+
+    Once a proof is verified, every node on its path and every sibling it was hashed with is known
+    to be in the tree. Later proofs stop hashing as soon as they reach one of these nodes, and
+    only need to compare the rest of their branch against the known siblings. This way the
+    upper branch nodes shared by transactions in the block are only hashed once.
+
+    Every branch in a block is the same length, so a branch of any other length is hashed all
+    the way up. A truncated branch would otherwise be accepted by reaching a known node, even
+    though it does not hash to the merkle root on its own.
+    '''
+    # (depth, position) -> node hash, where the leaves are at depth zero.
+    proven_nodes: Dict[Tuple[int, int], bytes] = {}
+    proven_branch_length: Optional[int] = None
+    results: List[bool] = []
+    for tx_hash, branch, index in proofs:
+        node = tx_hash
+        path: List[Tuple[Tuple[int, int], bytes]] = []
+        can_use_proven_nodes = len(branch) == proven_branch_length
+        for depth, elt in enumerate(branch):
+            if can_use_proven_nodes and proven_nodes.get((depth, index)) == node:
+                # The remaining branch must be exactly the proven siblings on the way up.
+                for upper_depth in range(depth, len(branch)):
+                    if proven_nodes.get((upper_depth, index ^ 1)) != branch[upper_depth]:
+                        break
+                    index >>= 1
+                else:
+                    node = merkle_root
+                break
+            path.append(((depth, index), node))
+            path.append(((depth, index ^ 1), elt))
+            if index & 1:
+                node = double_sha256(elt + node)
+            else:
+                node = double_sha256(node + elt)
+            index >>= 1
+
+        is_valid = index == 0 and node == merkle_root
+        if is_valid:
+            if proven_branch_length is None:
+                proven_branch_length = len(branch)
+            proven_nodes.update(path)
+        results.append(is_valid)
+    return results
+
+
 class DisconnectSessionError(Exception):
 
     def __init__(self, reason, *, blacklist=False):
@@ -340,9 +422,11 @@ class SVSession(RPCSession):
     _connecting_tips: Dict[bytes, asyncio.Event] = {}
     _need_checkpoint_headers = True
     # account -> list of script hashes.  Also acts as a list of registered accounts
-    _subs_by_account: Dict['AbstractAccount', List[str]] = {}
+    _subs_by_account: Dict['AbstractAccount', List[bytes]] = {}
     # script_hash -> (keyinstance_id, script_type)
-    _keyinstance_map: Dict[str, Tuple[int, ScriptType]] = {}
+    _keyinstance_map: Dict[bytes, Tuple[int, ScriptType]] = {}
+    # script_hash -> the session the subscription was made through
+    _subscription_sessions: Dict[bytes, 'SVSession'] = {}
 
     def __init__(self, network, server, logger, *args, **kwargs):
         super().__init__(*args, **kwargs)
@@ -472,9 +556,9 @@ class SVSession(RPCSession):
             logger.info(f'{count:,d} checkpoint headers needed')
             await self._request_chunk(start_height, count)
 
-    async def _request_chunk(self, height, count):
-        '''Returns the greatest height successfully connected (might be lower than expected
-        because of a small server response).
+    async def _fetch_chunk(self, height, count):
+        '''Returns the raw headers the server has from the given height, which might be fewer
+        than requested. Chunks before the checkpoint have their proof checked.
 
         Raises: RPCError, TaskTimeout, DisconnectSessionError'''
         self.logger.info(f'requesting {count:,d} headers from height {height:,d}')
@@ -497,11 +581,22 @@ class SVSession(RPCSession):
                 hex_root = result['root']
                 branch = [hex_str_to_hash(item) for item in result['branch']]
                 self._check_header_proof(hex_root, branch, raw_chunk[-HEADER_SIZE:], last_height)
+        except (AssertionError, KeyError, TypeError, ValueError) as e:
+            raise DisconnectSessionError(f'{method} failed: {e}', blacklist=True)
+        return raw_chunk
 
+    async def _request_chunk(self, height, count):
+        '''Returns the greatest height successfully connected (might be lower than expected
+        because of a small server response).
+
+        Raises: RPCError, TaskTimeout, DisconnectSessionError'''
+        raw_chunk = await self._fetch_chunk(height, count)
+        rec_count = len(raw_chunk) // HEADER_SIZE
+        last_height = height + rec_count - 1
+        try:
             self.chain = self._connect_chunk(height, raw_chunk)
-        except (AssertionError, KeyError, TypeError, ValueError,
-                IncorrectBits, InsufficientPoW, MissingHeader) as e:
-            raise DisconnectSessionError(f'{method} failed: {e}', blacklist=True)
+        except (IncorrectBits, InsufficientPoW, MissingHeader) as e:
+            raise DisconnectSessionError(f'blockchain.block.headers failed: {e}', blacklist=True)
 
         self.logger.info(f'connected {rec_count:,d} headers up to height {last_height:,d}')
         return last_height
@@ -597,20 +692,63 @@ class SVSession(RPCSession):
         height = await self._request_headers_at_heights(heights)
         # Catch up
         while height < tip.height:
-            height = await self._request_chunk(height + 1, 2016)
+            height = await HeaderChunkSync(self, height + 1, tip.height).run()
 
-    async def _subscribe_to_script_hash(self, script_hash: str) -> None:
-        '''Raises: RPCError, TaskTimeout'''
-        status = await self.send_request(SCRIPTHASH_SUBSCRIBE, [script_hash])
-        await self._on_queue_status_changed(script_hash, status)
+    async def _subscribe_to_script_hashes(self, script_hashes: List[bytes]) -> None:
+        '''Subscribe to the script hashes in one batch, queueing the initial statuses.
+
+        Raises: RPCError, TaskTimeout'''
+        async with self.send_batch(raise_errors=False) as batch:
+            for script_hash in script_hashes:
+                batch.add_request(SCRIPTHASH_SUBSCRIBE, [hash_to_hex_str(script_hash)])
+        first_error: Optional[Exception] = None
+        for script_hash, result in zip(script_hashes, batch.results):
+            if isinstance(result, Exception):
+                first_error = first_error or result
+            else:
+                self._network._on_status_queue.put_nowait((script_hash, result))
+        if first_error is not None:
+            raise first_error
 
-    async def _unsubscribe_from_script_hash(self, script_hash: str) -> bool:
-        return await self.send_request(SCRIPTHASH_UNSUBSCRIBE, [script_hash])
+    async def _unsubscribe_from_script_hashes(self, script_hashes: List[bytes]) -> None:
+        '''Unsubscribe from the script hashes in one batch. The server indicates whether each
+        script hash was subscribed, but no action is required either way.
+
+        Raises: TaskTimeout'''
+        async with self.send_batch(raise_errors=False) as batch:
+            for script_hash in script_hashes:
+                batch.add_request(SCRIPTHASH_UNSUBSCRIBE, [hash_to_hex_str(script_hash)])
+
+    async def _send_script_hash_batches(self, send_batch, script_hashes: List[bytes],
+            on_batch_done: Optional[Callable[[int], None]]=None) -> None:
+        '''Send the script hashes in batches, with a bounded number of batches in flight.
+
+        Raises: RPCError, TaskTimeout'''
+        batch_size = max(1, app_state.config.get('subscribe_batch_size', SUBSCRIBE_BATCH_SIZE))
+        window_size = max(1, app_state.config.get('subscribe_window', SUBSCRIBE_WINDOW))
+        batches = chunks(script_hashes, batch_size)
+        async with TaskGroup() as group:
+            tasks = {}
+            for batch_script_hashes in itertools.islice(batches, window_size):
+                tasks[await group.spawn(send_batch(batch_script_hashes))] = batch_script_hashes
 
-    async def _on_status_changed(self, script_hash: str, status: str) -> None:
+            while tasks:
+                task = await group.next_done()
+                batch_script_hashes = tasks.pop(task)
+                # Keep the window full.
+                next_script_hashes = next(batches, None)
+                if next_script_hashes is not None:
+                    tasks[await group.spawn(send_batch(next_script_hashes))] = next_script_hashes
+                # Any error is raised, and that cancels the remaining batches.
+                task.result()
+                if on_batch_done is not None:
+                    on_batch_done(len(batch_script_hashes))
+
+    async def _on_status_changed(self, script_hash: bytes, status: str) -> None:
         keydata = self._keyinstance_map.get(script_hash)
         if keydata is None:
-            self.logger.error(f'received status notification for unsubscribed {script_hash}')
+            self.logger.error('received status notification for unsubscribed %s',
+                hash_to_hex_str(script_hash))
             return
         keyinstance_id, script_type = keydata
 
@@ -622,15 +760,16 @@ class SVSession(RPCSession):
             return
 
         # Status has changed; get history
-        result = await self.request_history(script_hash)
+        result = await self._network._request_history(self, script_hash)
         self.logger.debug(f'received history of {keyinstance_id} length {len(result)}')
         try:
-            history = [(item['tx_hash'], item['height']) for item in result]
-            tx_fees = {item['tx_hash']: item['fee'] for item in result if 'fee' in item}
+            history = [(hex_str_to_hash(item['tx_hash']), item['height']) for item in result]
+            tx_fees = {hex_str_to_hash(item['tx_hash']): item['fee'] for item in result
+                if 'fee' in item}
             # Check that txids are unique
             assert len(set(tx_hash for tx_hash, tx_height in history)) == len(history), \
                 f'server history for {keyinstance_id} has duplicate transactions'
-        except (AssertionError, KeyError) as e:
+        except (AssertionError, KeyError, ValueError) as e:
             self._network._on_status_queue.put_nowait((script_hash, status))  # re-queue
             raise DisconnectSessionError(f'bad history returned: {e}')
 
@@ -756,27 +895,33 @@ class SVSession(RPCSession):
         '''
         # Negotiate the protocol before doing anything else
         await self._negotiate_protocol()
-        # Checkpoint headers are essential to attempting tip connection
-        await self._get_checkpoint_headers()
-        # Then subscribe headers and connect the server's tip
-        await self._subscribe_headers()
-        # Only once the tip is connected to our set of chains do we consider the
-        # session good and add it to the network's session list.  The network and
-        # other client code can assume a session 'tip' and 'chain' set.
-        is_main_server = await self._network.session_established(self)
+        # From now on the session can serve headers to any other session catching up.
+        self._network._header_sessions.add(self)
         try:
-            self.server.state.retry_delay = 0
-            async with TaskGroup() as group:
-                if is_main_server:
-                    self.logger.info('using as main server')
-                    await group.spawn(self._main_server_batch)
-                # This raises a TaskTimeout but it gets discarded as it also seems to trigger
-                # the closed event which cancels the ping exception before that gets raised up.
-                await group.spawn(self._ping_loop)
-                await self._closed_event.wait()
-                await group.cancel_remaining()
+            # Checkpoint headers are essential to attempting tip connection
+            await self._get_checkpoint_headers()
+            # Then subscribe headers and connect the server's tip
+            await self._subscribe_headers()
+            # Only once the tip is connected to our set of chains do we consider the
+            # session good and add it to the network's session list.  The network and
+            # other client code can assume a session 'tip' and 'chain' set.
+            is_main_server = await self._network.session_established(self)
+            try:
+                self.server.state.retry_delay = 0
+                async with TaskGroup() as group:
+                    if is_main_server:
+                        self.logger.info('using as main server')
+                        await group.spawn(self._main_server_batch)
+                    # This raises a TaskTimeout but it gets discarded as it also seems to
+                    # trigger the closed event which cancels the ping exception before that
+                    # gets raised up.
+                    await group.spawn(self._ping_loop)
+                    await self._closed_event.wait()
+                    await group.cancel_remaining()
+            finally:
+                await self._network.session_closed(self)
         finally:
-            await self._network.session_closed(self)
+            self._network._header_sessions.discard(self)
 
     async def headers_at_heights(self, heights):
         '''Raises: MissingHeader, DisconnectSessionError, BatchError, TaskTimeout'''
@@ -801,16 +946,37 @@ class SVSession(RPCSession):
         '''Raises: RPCError, TaskTimeout'''
         return await self.send_request('blockchain.transaction.get', [tx_id])
 
+    async def request_txs(self, tx_hashes: List[bytes]) -> Tuple[Any, ...]:
+        '''Request the given transactions in one batch. The result for any transaction the server
+        could not provide is the exception.
+
+        Raises: TaskTimeout'''
+        async with self.send_batch(raise_errors=False) as batch:
+            for tx_hash in tx_hashes:
+                batch.add_request('blockchain.transaction.get', [hash_to_hex_str(tx_hash)])
+        return batch.results
+
     async def request_proof(self, *args):
         '''Raises: RPCError, TaskTimeout'''
         return await self.send_request(REQUEST_MERKLE_PROOF, args)
 
-    async def request_history(self, script_hash):
+    async def request_proofs(self, entries: List[Tuple[bytes, int]]) -> Tuple[Any, ...]:
+        '''Request the proofs for the given (tx_hash, height) pairs in one batch. The result for
+        any proof the server could not provide is the exception.
+
+        Raises: TaskTimeout'''
+        async with self.send_batch(raise_errors=False) as batch:
+            for tx_hash, tx_height in entries:
+                batch.add_request(REQUEST_MERKLE_PROOF, [hash_to_hex_str(tx_hash), tx_height])
+        return batch.results
+
+    async def request_history(self, script_hash: bytes):
         '''Raises: RPCError, TaskTimeout'''
-        return await self.send_request(SCRIPTHASH_HISTORY, [script_hash])
+        return await self.send_request(SCRIPTHASH_HISTORY, [hash_to_hex_str(script_hash)])
 
-    async def _on_queue_status_changed(self, script_hash: str, status: str) -> None:
-        item = (script_hash, status)
+    async def _on_queue_status_changed(self, script_hash_hex: str, status: str) -> None:
+        # The protocol identifies script hashes in hex, we only use them in binary form.
+        item = (hex_str_to_hash(script_hash_hex), status)
         self._network._on_status_queue.put_nowait(item)
 
     async def subscribe_to_triples(self, account: 'AbstractAccount', triples) -> None:
@@ -823,21 +989,25 @@ class SVSession(RPCSession):
             self._subs_by_account[account] = []
         # Take reference so account can be unsubscribed asynchronously without conflict
         subs = self._subs_by_account[account]
-        async with TaskGroup() as group:
-            for keyinstance_id, script_type, script_hash in triples:
-                subs.append(script_hash)
-                # Send request even if already subscribed, as our user expects a response
-                # to trigger other actions and won't get one if we swallow it.
-                self._keyinstance_map[script_hash] = keyinstance_id, script_type
-                await group.spawn(self._subscribe_to_script_hash(script_hash))
-
-            # ensure GUI doesn't keep showing synchronizing...(100/101) when there are only 100 subs
-            account.request_count += len(set(triples) - set(subs))
+        script_hashes: List[bytes] = []
+        for keyinstance_id, script_type, script_hash in triples:
+            subs.append(script_hash)
+            # Send request even if already subscribed, as our user expects a response
+            # to trigger other actions and won't get one if we swallow it.
+            self._keyinstance_map[script_hash] = keyinstance_id, script_type
+            self._subscription_sessions[script_hash] = self
+            script_hashes.append(script_hash)
+
+        # ensure GUI doesn't keep showing synchronizing...(100/101) when there are only 100 subs
+        account.request_count += len(script_hashes)
+        account._wallet.progress_event.set()
+
+        def on_batch_done(count: int) -> None:
+            account.response_count += count
             account._wallet.progress_event.set()
 
-            while await group.next_done():
-                account.response_count += 1
-                account._wallet.progress_event.set()
+        await self._send_script_hash_batches(self._subscribe_to_script_hashes, script_hashes,
+            on_batch_done)
 
         assert len(set(subs)) == len(subs), "account subscribed to the same keys twice"
 
@@ -847,19 +1017,20 @@ class SVSession(RPCSession):
         Raises: RPCError, TaskTimeout'''
         subs = self._subs_by_account[account]
         exclusive_subs = self._get_exclusive_set(account, subs)
-        async with TaskGroup() as group:
-            for keyinstance_id, script_type, script_hash in pairs:
-                if script_hash not in exclusive_subs:
-                    continue
-                # Blocking on each removal allows for race conditions.
-                if script_hash not in subs:
-                    continue
-                subs.remove(script_hash)
-                del self._keyinstance_map[script_hash]
-                await group.spawn(self._unsubscribe_from_script_hash(script_hash))
+        script_hashes: List[bytes] = []
+        for keyinstance_id, script_type, script_hash in pairs:
+            if script_hash not in exclusive_subs:
+                continue
+            # Blocking on each removal allows for race conditions.
+            if script_hash not in subs:
+                continue
+            subs.remove(script_hash)
+            del self._keyinstance_map[script_hash]
+            script_hashes.append(script_hash)
+        await self._unsubscribe_script_hashes(script_hashes, self)
 
     @classmethod
-    def _get_exclusive_set(cls, account: 'AbstractAccount', subs: List[str]) -> set:
+    def _get_exclusive_set(cls, account: 'AbstractAccount', subs: List[bytes]) -> Set[bytes]:
         # This returns the script hashes the given account is subscribed to, that no other
         # account is also subscribed to. This ensures that when we unsubscribe script hashes for
         # the given account, as the server subscription is shared between wallets, we only
@@ -886,11 +1057,201 @@ class SVSession(RPCSession):
             logger.debug("negotiated protocol does not support unsubscribing")
             return
         logger.debug(f"unsubscribing {len(exclusive_subs)} subscriptions for {account}")
-        async with TaskGroup() as group:
-            for script_hash in exclusive_subs:
-                await group.spawn(session._unsubscribe_from_script_hash(script_hash))
+        await cls._unsubscribe_script_hashes(list(exclusive_subs), session)
         logger.debug(f"unsubscribed {len(exclusive_subs)} subscriptions for {account}")
 
+    @classmethod
+    async def drop_account_subscriptions(cls, account: 'AbstractAccount',
+            main_session: Optional['SVSession']) -> None:
+        '''Forget the subscriptions of an account whose maintenance is restarting, so that it
+        can resubscribe from scratch. Those made through other sessions that are still open are
+        unsubscribed, otherwise they would keep sending notifications even when the script hash
+        is resubscribed through a different session.'''
+        subs = cls._subs_by_account.pop(account, None)
+        if not subs:
+            return
+        sessions: Dict['SVSession', List[bytes]] = defaultdict(list)
+        for script_hash in cls._get_exclusive_set(account, subs):
+            session = cls._subscription_sessions.pop(script_hash, None)
+            if session is None or session is main_session or session.is_closing():
+                continue
+            if session.ptuple >= (1, 4, 2):
+                sessions[session].append(script_hash)
+        if not sessions:
+            return
+        logger.debug("unsubscribing %d shard subscriptions for %s",
+            sum(len(session_script_hashes) for session_script_hashes in sessions.values()),
+            account)
+        try:
+            async with TaskGroup() as group:
+                for session, session_script_hashes in sessions.items():
+                    await group.spawn(session._send_script_hash_batches(
+                        session._unsubscribe_from_script_hashes, session_script_hashes))
+        except (RPCError, TaskTimeout) as e:
+            logger.error("failed unsubscribing shard subscriptions for %s: %s", account, e)
+
+    @classmethod
+    async def _unsubscribe_script_hashes(cls, script_hashes: List[bytes],
+            default_session: 'SVSession') -> None:
+        # The subscriptions may have been made through other sessions.
+        sessions: Dict['SVSession', List[bytes]] = defaultdict(list)
+        for script_hash in script_hashes:
+            session = cls._subscription_sessions.pop(script_hash, default_session)
+            if not session.is_closing():
+                sessions[session].append(script_hash)
+        async with TaskGroup() as group:
+            for session, session_script_hashes in sessions.items():
+                await group.spawn(session._send_script_hash_batches(
+                    session._unsubscribe_from_script_hashes, session_script_hashes))
+
+    async def resubscribe(self, script_hashes: List[bytes]) -> None:
+        '''Move the subscriptions for the given script hashes to this session.
+
+        Raises: RPCError, TaskTimeout'''
+        self._handlers[SCRIPTHASH_SUBSCRIBE] = self._on_queue_status_changed
+        script_hashes = [ script_hash for script_hash in script_hashes
+            if script_hash in self._keyinstance_map ]
+        for script_hash in script_hashes:
+            self._subscription_sessions[script_hash] = self
+        await self._send_script_hash_batches(self._subscribe_to_script_hashes, script_hashes)
+
+
+class HeaderChunkSync:
+    '''Downloads and connects the headers from `start_height` up to `end_height`.
+
+    Several chunks are requested at once, spread over the session catching up and any other
+    sessions that have negotiated their protocol, and as chunks can arrive in any order they are
+    held in a reorder buffer until they can be connected in height order. A chunk that another
+    session fails to provide, or that does not connect, is requested again and that session is
+    not used for the rest of the download. The session catching up is responsible for the
+    download, and a failure of its own is raised as before.
+    '''
+
+    def __init__(self, session: 'SVSession', start_height: int, end_height: int) -> None:
+        self._session = session
+        self._network = session._network
+        self._start_height = start_height
+        self._end_height = end_height
+        # The next height to connect, and the next height that has not yet been requested.
+        self._connect_height = start_height
+        self._request_height = start_height
+        # (height, count) ranges that need to be requested again, lowest height first.
+        self._retry_ranges: List[Tuple[int, int]] = []
+        # height -> (raw chunk, session it came from)
+        self._buffer: Dict[int, Tuple[bytes, 'SVSession']] = {}
+        self._excluded_sessions: Set['SVSession'] = set()
+        self._requests_in_flight: Dict['SVSession', int] = defaultdict(int)
+
+        config = app_state.config
+        self._maximum_sessions = max(1, config.get('header_sync_sessions',
+            HEADER_SYNC_MAXIMUM_SESSIONS))
+        self._session_window = max(1, config.get('header_sync_window', HEADER_SYNC_WINDOW))
+
+    def _get_sessions(self) -> List['SVSession']:
+        other_sessions = [ session for session in self._network._header_sessions
+            if session is not self._session and not session.is_closing() and
+                session not in self._excluded_sessions ]
+        other_sessions.sort(key=lambda session: str(session.server))
+        return [ self._session ] + other_sessions[:self._maximum_sessions-1]
+
+    def _next_session(self) -> Optional['SVSession']:
+        sessions = [ session for session in self._get_sessions()
+            if self._requests_in_flight[session] < self._session_window ]
+        if not sessions:
+            return None
+        return min(sessions, key=lambda session: self._requests_in_flight[session])
+
+    def _next_range(self) -> Optional[Tuple[int, int]]:
+        if self._retry_ranges:
+            return heapq.heappop(self._retry_ranges)
+        if self._request_height > self._end_height:
+            return None
+        # Bound the reorder buffer, so a slow chunk does not leave the rest piling up behind it.
+        if self._request_height - self._connect_height >= \
+                HEADER_CHUNK_SIZE * HEADER_SYNC_REORDER_CHUNKS:
+            return None
+        height = self._request_height
+        count = min(HEADER_CHUNK_SIZE, self._end_height - height + 1)
+        self._request_height += count
+        return height, count
+
+    def _exclude_session(self, session: 'SVSession', height: int, count: int,
+            reason: Any) -> None:
+        if session is self._session:
+            raise DisconnectSessionError(f'blockchain.block.headers failed: {reason}',
+                blacklist=True)
+        session.logger.info(f'not using for header sync: {reason}')
+        self._excluded_sessions.add(session)
+        heapq.heappush(self._retry_ranges, (height, count))
+
+    def _on_chunk(self, session: 'SVSession', height: int, count: int,
+            raw_chunk: bytes) -> None:
+        rec_count = len(raw_chunk) // HEADER_SIZE
+        if rec_count == 0:
+            self._exclude_session(session, height, count, 'no headers returned')
+            return
+        if rec_count < count:
+            # The server may be behind the tip we are catching up to.
+            heapq.heappush(self._retry_ranges, (height + rec_count, count - rec_count))
+        self._buffer[height] = (raw_chunk, session)
+
+        while self._connect_height in self._buffer:
+            height = self._connect_height
+            raw_chunk, session = self._buffer.pop(height)
+            try:
+                self._session.chain = self._session._connect_chunk(height, raw_chunk)
+            except (IncorrectBits, InsufficientPoW, MissingHeader) as e:
+                self._exclude_session(session, height, len(raw_chunk) // HEADER_SIZE, e)
+                break
+            self._connect_height += len(raw_chunk) // HEADER_SIZE
+            self._network._set_header_sync_progress(self._connect_height - 1, self._end_height)
+
+    async def run(self) -> int:
+        '''Returns the greatest height connected.
+
+        Raises: RPCError, TaskTimeout, DisconnectSessionError'''
+        self._session.logger.info(f'syncing headers from height {self._start_height:,d} to '
+            f'{self._end_height:,d}')
+        self._network._set_header_sync_progress(self._start_height - 1, self._end_height)
+        try:
+            async with TaskGroup() as group:
+                tasks: Dict[Any, Tuple['SVSession', int, int]] = {}
+
+                async def fill_window() -> None:
+                    while True:
+                        session = self._next_session()
+                        if session is None:
+                            break
+                        next_range = self._next_range()
+                        if next_range is None:
+                            break
+                        height, count = next_range
+                        self._requests_in_flight[session] += 1
+                        task = await group.spawn(session._fetch_chunk(height, count))
+                        tasks[task] = (session, height, count)
+
+                await fill_window()
+                while tasks:
+                    task = await group.next_done()
+                    session, height, count = tasks.pop(task)
+                    self._requests_in_flight[session] -= 1
+                    try:
+                        raw_chunk = task.result()
+                    except (RPCError, TaskTimeout, DisconnectSessionError) as e:
+                        # Any error from the session catching up cancels the remaining chunks.
+                        if session is self._session:
+                            raise
+                        self._exclude_session(session, height, count, e)
+                    else:
+                        self._on_chunk(session, height, count, raw_chunk)
+                    await fill_window()
+        finally:
+            self._network._set_header_sync_progress(None)
+
+        self._session.logger.info(f'connected headers up to height '
+            f'{self._connect_height - 1:,d}')
+        return self._connect_height - 1
+
 
 class Network(TriggeredCallbacks):
     '''Manages a set of connections to remote ElectrumX servers.  All operations are
@@ -922,6 +1283,24 @@ class Network(TriggeredCallbacks):
         # Feed pub-sub notifications to currently active SVSession for processing
         self._on_status_queue = app_state.async_.queue()
 
+        # height -> (merkle_root, timestamp) for the main chain blocks that proofs have been
+        # verified against. Entries above the height of any reorg are discarded.
+        self._verified_block_roots: Dict[int, Tuple[bytes, int]] = {}
+
+        # The sessions that have negotiated their protocol, and can be asked for headers by any
+        # session that is catching up. These do not need to have connected their own tip.
+        self._header_sessions: Set[SVSession] = set()
+        # (connected height, target height) while a header download is in progress.
+        self.header_sync_progress: Optional[Tuple[int, int]] = None
+
+        # State for sharding synchronisation over several sessions.
+        self._shard_history_count = 0
+        self._shard_mismatches: Dict[SVServer, int] = defaultdict(int)
+        self._shard_excluded_servers: Set[SVServer] = set()
+
+        # Created when first needed, to derive the scripts of keys to subscribe to.
+        self._derivation_executor: Optional[concurrent.futures.ProcessPoolExecutor] = None
+
         dir_path = app_state.config.file_path('certs')
         if not os.path.exists(dir_path):
             os.mkdir(dir_path)
@@ -938,6 +1317,9 @@ class Network(TriggeredCallbacks):
                 await group.spawn(self._monitor_accounts, group)
                 await group.spawn(self._monitor_wallets, group)
         finally:
+            if self._derivation_executor is not None:
+                self._derivation_executor.shutdown(wait=False)
+                self._derivation_executor = None
             self.shutdown_complete_event.set()
             app_state.config.set_key('servers', list(SVServer.all_servers.values()), True)
 
@@ -1060,6 +1442,8 @@ class Network(TriggeredCallbacks):
                 _chain, above_height = main_chain.common_chain_and_height(new_main_chain)
                 logger.info(f'main chain updated; undoing wallet verifications '
                             f'above height {above_height:,d}')
+                for height in [ h for h in self._verified_block_roots if h > above_height ]:
+                    del self._verified_block_roots[height]
                 await self._wallet_jobs.put(('undo_verifications', above_height))
             # It has been observed that we may receive headers after all the history events that
             # relate to the height of those headers. Queueing a check here will cover those new
@@ -1114,37 +1498,117 @@ class Network(TriggeredCallbacks):
         logger.info(f'main server: {main_server}; proxy: {proxy}')
         return main_server, proxy
 
-    async def _request_transactions(self, wallet, missing_hashes: List[bytes]) -> bool:
+    async def _request_transactions(self, wallet: 'Wallet', missing_hashes: List[bytes]) -> bool:
+        """
+        Fetch the given transactions in batched requests, keeping a bounded number of batches
+        in flight. Transactions that are not obtained are retried with a backoff delay, and
+        those that are are added to the wallet a batch at a time.
+        """
+        batch_size = max(1, app_state.config.get('tx_fetch_batch_size', TX_FETCH_BATCH_SIZE))
+        window_size = max(1, app_state.config.get('tx_fetch_window', TX_FETCH_WINDOW))
+
         wallet.request_count += len(missing_hashes)
         wallet.progress_event.set()
         had_timeout = False
-        session = await self._main_session()
-        session.logger.debug(f'requesting {len(missing_hashes)} missing transactions')
-        async with TaskGroup() as group:
-            tasks = {}
-            for tx_hash in missing_hashes:
-                tx_id = hash_to_hex_str(tx_hash)
-                tasks[await group.spawn(session.request_tx(tx_id))] = tx_hash
+        start_time = time.monotonic()
+        received_count = 0
+
+        pending_hashes = list(missing_hashes)
+        for attempt in range(TX_FETCH_MAXIMUM_ATTEMPTS):
+            if attempt > 0:
+                await sleep(TX_FETCH_RETRY_DELAY * 2 ** (attempt - 1))
+            sessions = await self._sync_sessions()
+            sessions[0].logger.debug(f'requesting {len(pending_hashes)} missing transactions '
+                f'from {len(sessions)} sessions (attempt {attempt+1})')
+            # The batches are spread over the sessions, each with its own window.
+            requests_in_flight: Dict[SVSession, int] = defaultdict(int)
+
+            failed_hashes: List[bytes] = []
+            batches = chunks(pending_hashes, batch_size)
+            async with TaskGroup() as group:
+                tasks: Dict[Any, Tuple[SVSession, List[bytes]]] = {}
+
+                async def fill_window() -> None:
+                    while True:
+                        fetch_session = self._next_fetch_session(sessions,
+                            requests_in_flight, window_size)
+                        if fetch_session is None:
+                            break
+                        next_hashes = next(batches, None)
+                        if next_hashes is None:
+                            break
+                        requests_in_flight[fetch_session] += 1
+                        tasks[await group.spawn(fetch_session.request_txs(next_hashes))] = \
+                            (fetch_session, next_hashes)
+
+                await fill_window()
+                while tasks:
+                    task = await group.next_done()
+                    fetch_session, batch_hashes = tasks.pop(task)
+                    requests_in_flight[fetch_session] -= 1
+                    # Keep the window of the session that is now free full.
+                    await fill_window()
 
-            while tasks:
-                task = await group.next_done()
-                wallet.response_count += 1
-                wallet.progress_event.set()
-                tx_hash = tasks.pop(task)
-                tx_id = hash_to_hex_str(tx_hash)
-                try:
-                    tx_hex = task.result()
-                    tx = Transaction.from_hex(tx_hex)
-                    session.logger.debug(f'received tx {tx_id} bytes: {len(tx_hex)//2}')
-                except CancelledError:
-                    had_timeout = True
-                except Exception as default_error:
-                    logger.exception("fetching transaction %s", tx_id, exc_info=default_error)
-                else:
-                    wallet.add_transaction(tx_hash, tx, TxFlags.StateCleared | TxFlags.HasByteData,
-                        True)
+                    try:
+                        results = task.result()
+                    except CancelledError:
+                        had_timeout = True
+                        failed_hashes.extend(batch_hashes)
+                        continue
+                    except Exception as batch_error:
+                        logger.error("fetching %d transactions: %s", len(batch_hashes),
+                            batch_error)
+                        failed_hashes.extend(batch_hashes)
+                        continue
+
+                    received: List[Tuple[bytes, Transaction]] = []
+                    for tx_hash, result in zip(batch_hashes, results):
+                        tx_id = hash_to_hex_str(tx_hash)
+                        try:
+                            if isinstance(result, Exception):
+                                raise result
+                            tx = Transaction.from_hex(result)
+                            if tx.hash() != tx_hash:
+                                raise ValueError(f"received transaction {tx.txid()}")
+                        except Exception as tx_error:
+                            logger.error("fetching transaction %s: %s", tx_id, tx_error)
+                            failed_hashes.append(tx_hash)
+                        else:
+                            received.append((tx_hash, tx))
+
+                    if received:
+                        await wallet.add_transactions_async(received,
+                            TxFlags.StateCleared | TxFlags.HasByteData, True)
+                        received_count += len(received)
+                        wallet.response_count += len(received)
+                        wallet.progress_event.set()
+
+            pending_hashes = failed_hashes
+            if not pending_hashes:
+                break
+
+        # Give up on what remains for now, the hashes will be wanted again on the next pass.
+        if pending_hashes:
+            wallet.response_count += len(pending_hashes)
+            wallet.progress_event.set()
+
+        elapsed_time = time.monotonic() - start_time
+        logger.debug("received %d of %d transactions in %.2f seconds (%.1f tx/s)",
+            received_count, len(missing_hashes), elapsed_time,
+            received_count / elapsed_time if elapsed_time > 0 else 0.0)
         return had_timeout
 
+    @staticmethod
+    def _next_fetch_session(sessions: List[SVSession], requests_in_flight: Dict[SVSession, int],
+            window_size: int) -> Optional[SVSession]:
+        '''Returns the least busy of the sessions that has room in its window for another
+        request, if any do.'''
+        available_sessions = [ session for session in sessions
+            if requests_in_flight[session] < window_size ]
+        if not available_sessions:
+            return None
+        return min(available_sessions, key=lambda session: requests_in_flight[session])
+
     def _available_servers(self, protocol):
         now = time.time()
         unchosen = set(SVServer.all_servers.values()).difference(self.chosen_servers)
@@ -1162,42 +1626,95 @@ class Network(TriggeredCallbacks):
                 return server
             await sleep(10)
 
-    async def _request_proofs(self, wallet: 'Wallet', wanted_map) -> bool:
+    async def _request_proofs(self, wallet: 'Wallet', wanted_map: Dict[bytes, int]) -> bool:
+        """
+        Fetch the merkle proofs for the given transactions in batched requests, and verify them
+        a block at a time so that the proofs for transactions in the same block share the work
+        of hashing their common branch nodes.
+        """
         had_timeout = False
-        session = await self._main_session()
-        session.logger.debug(f'requesting {len(wanted_map)} proofs')
+        sessions = await self._sync_sessions()
+        # Headers are always obtained through the main session, as they define the main chain.
+        session = sessions[0]
+        session.logger.debug(f'requesting {len(wanted_map)} proofs from {len(sessions)} sessions')
+        # The batches are spread over the sessions, each with its own window.
+        requests_in_flight: Dict[SVSession, int] = defaultdict(int)
+
+        # Order the requests by height, so that each batch of results covers few blocks.
+        wanted_entries = sorted(wanted_map.items(), key=lambda t: t[1])
+        proofs_by_height: Dict[int, List[Tuple[bytes, List[bytes], int]]] = defaultdict(list)
         async with TaskGroup() as group:
-            tasks = {}
-            for tx_hash, tx_height in wanted_map.items():
-                tx_id = hash_to_hex_str(tx_hash)
-                tasks[await group.spawn(session.request_proof(tx_id, tx_height))] = (tx_hash,
-                    tx_id)
-            headers = await session.headers_at_heights(wanted_map.values())
+            tasks: Dict[Any, Tuple[SVSession, List[Tuple[bytes, int]]]] = {}
+            batches = chunks(wanted_entries, PROOF_FETCH_BATCH_SIZE)
+
+            async def fill_window() -> None:
+                while True:
+                    fetch_session = self._next_fetch_session(sessions, requests_in_flight,
+                        PROOF_FETCH_WINDOW)
+                    if fetch_session is None:
+                        break
+                    next_entries = next(batches, None)
+                    if next_entries is None:
+                        break
+                    requests_in_flight[fetch_session] += 1
+                    tasks[await group.spawn(fetch_session.request_proofs(next_entries))] = \
+                        (fetch_session, next_entries)
+
+            await fill_window()
+
+            # Blocks that we have already verified proofs against do not need their headers.
+            block_roots = { height: self._verified_block_roots[height]
+                for height in set(wanted_map.values()) if height in self._verified_block_roots }
+            missing_heights = set(wanted_map.values()) - set(block_roots)
+            if missing_heights:
+                headers = await session.headers_at_heights(missing_heights)
+                for height, header in headers.items():
+                    block_roots[height] = (header.merkle_root, header.timestamp)
 
             while tasks:
                 task = await group.next_done()
-                tx_hash, tx_id = tasks.pop(task)
-                tx_height = wanted_map[tx_hash]
+                fetch_session, batch_entries = tasks.pop(task)
+                requests_in_flight[fetch_session] -= 1
+                # Keep the window of the session that is now free full.
+                await fill_window()
+
                 try:
-                    result = task.result()
-                    branch = [hex_str_to_hash(item) for item in result['merkle']]
-                    tx_pos = result['pos']
-                    proven_root = _root_from_proof(tx_hash, branch, tx_pos)
-                    header = headers[wanted_map[tx_hash]]
+                    results = task.result()
                 except CancelledError:
                     had_timeout = True
-                except Exception as e:
-                    logger.error(f'getting proof for {tx_id}: {e}')
-                else:
-                    if header.merkle_root == proven_root:
-                        logger.debug(f'received valid proof for {tx_id}')
-                        wallet.add_transaction_proof(tx_hash, tx_height, header.timestamp, tx_pos,
-                            tx_pos, branch)
+                    continue
+                except Exception as batch_error:
+                    logger.error("getting %d proofs: %s", len(batch_entries), batch_error)
+                    continue
+
+                for (tx_hash, tx_height), result in zip(batch_entries, results):
+                    try:
+                        if isinstance(result, Exception):
+                            raise result
+                        branch = [hex_str_to_hash(item) for item in result['merkle']]
+                        tx_pos = result['pos']
+                        assert isinstance(tx_pos, int) and tx_pos >= 0, f'bad pos {tx_pos}'
+                    except Exception as e:
+                        logger.error(f'getting proof for {hash_to_hex_str(tx_hash)}: {e!r}')
                     else:
-                        hhts = hash_to_hex_str
-                        logger.error(f'invalid proof for tx {tx_id} in block '
-                                     f'{hhts(header.hash)}; got {hhts(proven_root)} expected '
-                                     f'{hhts(header.merkle_root)}')
+                        proofs_by_height[tx_height].append((tx_hash, branch, tx_pos))
+
+        for tx_height, proofs in sorted(proofs_by_height.items()):
+            merkle_root, timestamp = block_roots[tx_height]
+            is_block_verified = False
+            for (tx_hash, branch, tx_pos), is_valid in zip(proofs,
+                    _verify_block_proofs(merkle_root, proofs)):
+                tx_id = hash_to_hex_str(tx_hash)
+                if is_valid:
+                    logger.debug(f'received valid proof for {tx_id}')
+                    await wallet.add_transaction_proof(tx_hash, tx_height, timestamp, tx_pos,
+                        tx_pos, branch)
+                    is_block_verified = True
+                else:
+                    logger.error(f'invalid proof for tx {tx_id} in block at height '
+                        f'{tx_height:,d}; expected {hash_to_hex_str(merkle_root)}')
+            if is_block_verified:
+                self._verified_block_roots[tx_height] = (merkle_root, timestamp)
         return had_timeout
 
     async def _monitor_on_status(self, group):
@@ -1243,14 +1760,30 @@ class Network(TriggeredCallbacks):
         additional_keys = set(account.existing_active_keys())
         while True:
             session.logger.info(f'subscribing to {len(additional_keys):,d} new keys for {account}')
+            triples = await self._get_subscription_triples(account, additional_keys)
             # Do in reverse to require fewer account re-sync loops
-            pairs = [ (k, script_type, scripthash_hex(script)) for k in additional_keys
-                for script_type, script in account.get_possible_scripts_for_id(k) ]
-            pairs.reverse()
-            await session.subscribe_to_triples(account, pairs)
+            triples.reverse()
+            await self._subscribe_to_triples(account, triples)
             additional_keys = await account.new_activated_keys()
             session = await self._main_session()
 
+    async def _get_subscription_triples(self, account: 'AbstractAccount',
+            keyinstance_ids: Iterable[int]) -> List[Tuple[int, ScriptType, bytes]]:
+        # Deriving the scripts of a restored account's keys takes a while, so it is done outside
+        # the event loop.
+        return await run_in_thread(account.get_subscription_triples, keyinstance_ids,
+            self._get_derivation_executor())
+
+    def _get_derivation_executor(self) -> Optional[concurrent.futures.Executor]:
+        process_count = app_state.config.get('subscribe_derivation_processes',
+            SUBSCRIBE_DERIVATION_PROCESSES)
+        if process_count <= 0:
+            return None
+        if self._derivation_executor is None:
+            self._derivation_executor = concurrent.futures.ProcessPoolExecutor(
+                max_workers=process_count)
+        return self._derivation_executor
+
     async def _monitor_inactive_keys(self, account) -> None:
         '''Raises: RPCError, TaskTimeout'''
         while True:
@@ -1258,7 +1791,7 @@ class Network(TriggeredCallbacks):
             session = await self._main_session()
             session.logger.info(f'unsubscribing from {len(keys):,d} '+
                 f'deactivated keys for {account}')
-            pairs = [ (k, script_type, scripthash_hex(script)) for k in keys
+            pairs = [ (k, script_type, scripthash_bytes(script)) for k in keys
                 for script_type, script in account.get_possible_scripts_for_id(k) ]
             await session.unsubscribe_from_pairs(account, pairs)
 
@@ -1302,7 +1835,7 @@ class Network(TriggeredCallbacks):
                     if session:
                         await session.disconnect(str(error), blacklist=blacklist)
                 if account in SVSession._subs_by_account:
-                    del SVSession._subs_by_account[account]
+                    await SVSession.drop_account_subscriptions(account, self.main_session())
                     account.request_count = 0
                     account.response_count = 0
                     wallet = account.get_wallet()
@@ -1319,6 +1852,111 @@ class Network(TriggeredCallbacks):
                 return session
             await self.sessions_changed_event.wait()
 
+    def _is_sharding_enabled(self) -> bool:
+        return app_state.config.get('sync_sharding', False)
+
+    def sync_sessions(self) -> List[SVSession]:
+        '''Returns the sessions that synchronisation work can be spread over, main session first.
+
+        Without sharding enabled, this is only ever the main session.'''
+        main_session = self.main_session()
+        if main_session is None:
+            return []
+        if not self._is_sharding_enabled() or main_session.chain is None:
+            return [ main_session ]
+
+        maximum_sessions = max(1, app_state.config.get('sync_shard_sessions',
+            SHARD_MAXIMUM_SESSIONS))
+        now = time.time()
+        other_sessions = [ session for session in self.sessions
+            if session is not main_session and not session.is_closing() and
+                session.chain == main_session.chain and
+                session.server.state.last_good > now - 60 and
+                session.server not in self._shard_excluded_servers ]
+        # Select consistently, so that the shards do not move while the sessions are unchanged.
+        other_sessions.sort(key=lambda session: str(session.server))
+        return [ main_session ] + other_sessions[:maximum_sessions-1]
+
+    async def _sync_sessions(self) -> List[SVSession]:
+        while True:
+            sessions = self.sync_sessions()
+            if sessions:
+                return sessions
+            await self.sessions_changed_event.wait()
+
+    @staticmethod
+    def _shard_session(script_hash: bytes, sessions: List[SVSession]) -> SVSession:
+        # Rendezvous hashing, so that adding or removing a session only moves the subscriptions
+        # that it is or would be responsible for.
+        return max(sessions, key=lambda session: hash((script_hash, str(session.server))))
+
+    async def _subscribe_to_triples(self, account: 'AbstractAccount', triples) -> None:
+        '''Raises: RPCError, TaskTimeout'''
+        sessions = await self._sync_sessions()
+        if len(sessions) == 1:
+            await sessions[0].subscribe_to_triples(account, triples)
+            return
+
+        shards: Dict[SVSession, List[Tuple[int, ScriptType, bytes]]] = defaultdict(list)
+        for triple in triples:
+            shards[self._shard_session(triple[2], sessions)].append(triple)
+        async with TaskGroup() as group:
+            for session, shard_triples in shards.items():
+                await group.spawn(session.subscribe_to_triples(account, shard_triples))
+
+    async def _rebalance_subscriptions(self, closed_session: SVSession) -> None:
+        '''Move the subscriptions made through a session that is no longer used for sharding.'''
+        script_hashes = [ script_hash for script_hash, session
+            in SVSession._subscription_sessions.items() if session is closed_session ]
+        if not script_hashes:
+            return
+        main_session = self.main_session()
+        if closed_session is main_session or main_session is None:
+            # Losing the main session restarts the account maintenance, which unsubscribes
+            # the shards of the other sessions before resubscribing.
+            return
+
+        sessions = [ session for session in self.sync_sessions() if session is not closed_session ]
+        shards: Dict[SVSession, List[bytes]] = defaultdict(list)
+        for script_hash in script_hashes:
+            shards[self._shard_session(script_hash, sessions)].append(script_hash)
+        logger.info("moving %d subscriptions from %s to %d sessions", len(script_hashes),
+            closed_session.server, len(shards))
+        try:
+            async with TaskGroup() as group:
+                for session, shard_script_hashes in shards.items():
+                    await group.spawn(session.resubscribe(shard_script_hashes))
+        except (RPCError, TaskTimeout) as e:
+            logger.error("failed moving subscriptions from %s: %s", closed_session.server, e)
+
+    async def _request_history(self, main_session: SVSession, script_hash: bytes):
+        '''Obtain the history through the session the script hash is subscribed through, and
+        periodically cross-check it with the main session.
+
+        Raises: RPCError, TaskTimeout'''
+        session = SVSession._subscription_sessions.get(script_hash, main_session)
+        if session is main_session or session.is_closing():
+            return await main_session.request_history(script_hash)
+
+        result = await session.request_history(script_hash)
+        self._shard_history_count += 1
+        if self._shard_history_count % SHARD_CROSS_CHECK_INTERVAL == 0:
+            main_result = await main_session.request_history(script_hash)
+            if main_result != result:
+                # A mismatch can happen legitimately, when a transaction reaches the servers at
+                # different times. But too many are a sign the server cannot be relied upon.
+                server = session.server
+                self._shard_mismatches[server] += 1
+                session.logger.warning("history differs from main server (%d mismatches)",
+                    self._shard_mismatches[server])
+                if self._shard_mismatches[server] >= SHARD_MAXIMUM_MISMATCHES and \
+                        server not in self._shard_excluded_servers:
+                    session.logger.warning("no longer sharding synchronisation to server")
+                    self._shard_excluded_servers.add(server)
+                    app_state.async_.spawn(self._rebalance_subscriptions, session)
+                return main_result
+        return result
+
     async def _random_session(self):
         while not self.sessions:
             logger.info('waiting for new session')
@@ -1343,6 +1981,8 @@ class Network(TriggeredCallbacks):
         self.sessions.remove(session)
         self.sessions_changed_event.set()
         self.sessions_changed_event.clear()
+        if self._is_sharding_enabled():
+            app_state.async_.spawn(self._rebalance_subscriptions, session)
         if session.server is self.main_server:
             self.trigger_callback('status')
         self.trigger_callback('sessions')
@@ -1402,9 +2042,28 @@ class Network(TriggeredCallbacks):
             return main_session.tip.height
         return 0
 
+    def _set_header_sync_progress(self, height: Optional[int], target_height: int=0) -> None:
+        self.header_sync_progress = None if height is None else (height, target_height)
+        self.trigger_callback('header_sync', self.header_sync_progress)
+
     def backfill_headers_at_heights(self, heights: List[int]) -> None:
         app_state.async_.spawn(self._backfill_headers_at_heights, heights)
 
+    def backfill_headers_at_heights_and_wait(self, heights: List[int],
+            timeout: Optional[float]=None) -> bool:
+        """
+        Fetch the headers at the given heights, waiting at most `timeout` seconds. Returns
+        whether the wait completed. Headers can only be fetched from a main server that has them,
+        and any that were not fetched in time may still be added later.
+        """
+        try:
+            app_state.async_.spawn_and_wait(self._backfill_headers_at_heights, heights,
+                timeout=timeout)
+        except concurrent.futures.TimeoutError:
+            logger.debug("timed out fetching %d headers", len(heights))
+            return False
+        return True
+
     async def _backfill_headers_at_heights(self, heights: List[int]) -> None:
         main_session = self.main_session()
         if main_session:
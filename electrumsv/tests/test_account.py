@@ -1,13 +1,20 @@
-from typing import List, NamedTuple, Optional, Tuple
+from functools import partial
+import threading
+from typing import List, NamedTuple, Optional, Set, Tuple
 import unittest
 
 from bitcoinx import Script
 
 from electrumsv.app_state import app_state
 from electrumsv.bitcoin import ScriptTemplate
-from electrumsv.constants import DerivationType, KeyInstanceFlag, ScriptType, TransactionOutputFlag
-from electrumsv.wallet import AbstractAccount
-from electrumsv.wallet_database.tables import AccountRow, KeyInstanceRow, TransactionOutputRow
+from electrumsv.constants import (DerivationType, KeyInstanceFlag, ScriptType,
+    TransactionOutputFlag, TxFlags)
+from electrumsv.types import TxoKeyType
+from electrumsv.wallet import (AbstractAccount, EXPORT_HEADER_FETCH_TIMEOUT, HistoryIndex,
+    HistoryLine, KeyInstanceStore, SyncState)
+from electrumsv.wallet_database import TxData
+from electrumsv.wallet_database.tables import (AccountRow, KeyInstanceRow,
+    TransactionDeltaHistoryRow, TransactionOutputRow)
 
 
 class CustomAccount(AbstractAccount):
@@ -35,6 +42,7 @@ class MockScriptTemplate:
 class MockWallet:
     def __init__(self) -> None:
         self._transaction_cache = unittest.mock.Mock()
+        self._transaction_cache.get_metadata.return_value = None
         self._db_context = unittest.mock.Mock()
         self._storage = unittest.mock.Mock()
 
@@ -185,3 +193,400 @@ def test_remove_transaction(mocker) -> None:
     ]
     account._remove_transaction(TX_HASH_2)
 
+
+
+def test_txo_spender_index(mocker) -> None:
+    state = MockAppState()
+    # Mocked out startup junk for AbstractAccount initialization.
+    mocker.patch.object(state, "async_", return_value=NotImplemented)
+    mocker.patch("electrumsv.wallet_database.tables.PaymentRequestTable.read").return_value = []
+
+    account_row = AccountRow(ACCOUNT_ID, MASTERKEY_ID, ScriptType.P2PKH, "ACCOUNT 1")
+    keyinstance_rows = [
+        KeyInstanceRow(KEYINSTANCE_ID+1, ACCOUNT_ID, MASTERKEY_ID, DerivationType.BIP32,
+            b'111', ScriptType.P2PKH, KeyInstanceFlag.IS_ACTIVE, None),
+    ]
+
+    wallet = MockWallet()
+    account = CustomAccount(wallet, account_row, keyinstance_rows, [])
+    account._sync_state = SyncState()
+
+    # The spending transaction is only known through the key history, as it would be if it
+    # were processed in an earlier session. The history also has the funding transactions.
+    FUNDING_TX_HASH_1 = b'1' * 32
+    FUNDING_TX_HASH_2 = b'2' * 32
+    TX_HASH_3 = b'3' * 32
+    FOREIGN_TX_HASH = b'4' * 32
+    account._sync_state.set_key_history(KEYINSTANCE_ID+1, [ (FUNDING_TX_HASH_1, 1),
+        (FUNDING_TX_HASH_2, 1), (TX_HASH_3, 1) ])
+    spend_tx = unittest.mock.Mock()
+    spend_tx.inputs = [ FakeTxin(FUNDING_TX_HASH_1, 1), FakeTxin(FUNDING_TX_HASH_2, 0),
+        FakeTxin(FOREIGN_TX_HASH, 0) ]
+    def fake_get_transaction(tx_hash: bytes):
+        if tx_hash == TX_HASH_3:
+            return spend_tx
+        return unittest.mock.Mock(inputs=[])
+    get_transaction = unittest.mock.Mock(side_effect=fake_get_transaction)
+    wallet._transaction_cache.get_transaction = get_transaction
+
+    assert account._get_txo_spender(TxoKeyType(FUNDING_TX_HASH_1, 1), KEYINSTANCE_ID+1) == \
+        TX_HASH_3
+    assert account._get_txo_spender(TxoKeyType(FUNDING_TX_HASH_2, 0), KEYINSTANCE_ID+1) == \
+        TX_HASH_3
+    assert account._get_txo_spender(TxoKeyType(FUNDING_TX_HASH_1, 2), KEYINSTANCE_ID+1) is None
+    # Each history transaction is only parsed the once.
+    assert get_transaction.call_count == 3
+    # The spends of outputs of transactions unrelated to the account are not recorded.
+    assert TxoKeyType(FOREIGN_TX_HASH, 0) not in account._txo_spenders
+
+    account._unindex_transaction_spends(TX_HASH_3, spend_tx)
+    assert TxoKeyType(FUNDING_TX_HASH_1, 1) not in account._txo_spenders
+    assert TX_HASH_3 not in account._spend_indexed_tx_hashes
+
+
+def test_sync_state() -> None:
+    # The history entries are stored as fixed size hashes.
+    TX_HASH_1, TX_HASH_2, TX_HASH_3 = b'1' * 32, b'2' * 32, b'3' * 32
+    sync_state = SyncState()
+    assert sync_state.get_key_history(1) == []
+
+    history = [ (TX_HASH_1, 100), (TX_HASH_2, 0), (TX_HASH_3, -1) ]
+    assert sync_state.set_key_history(1, history) == (set(), { TX_HASH_1, TX_HASH_2, TX_HASH_3 })
+    assert sync_state.set_key_history(2, history[:1]) == (set(), { TX_HASH_1 })
+    assert sync_state.get_key_history(1) == history
+    assert sync_state.get_key_tx_hashes(1) == [ TX_HASH_1, TX_HASH_2, TX_HASH_3 ]
+    assert sync_state.get_transaction_key_ids(TX_HASH_1) == { 1, 2 }
+    assert sync_state.get_transaction_key_ids(TX_HASH_3) == { 1 }
+
+    # Replacing the history reports what changed and drops transactions no key relates to.
+    assert sync_state.set_key_history(1, [ (TX_HASH_2, 101) ]) == ({ TX_HASH_1, TX_HASH_3 },
+        set())
+    assert sync_state.get_key_history(1) == [ (TX_HASH_2, 101) ]
+    assert sync_state.get_transaction_key_ids(TX_HASH_1) == { 2 }
+    assert sync_state.get_transaction_key_ids(TX_HASH_3) == set()
+    assert TX_HASH_3 not in sync_state._tx_keys
+
+    assert sync_state.set_key_history(2, []) == ({ TX_HASH_1 }, set())
+    assert sync_state.get_key_history(2) == []
+    assert sync_state.get_transaction_key_ids(TX_HASH_1) == set()
+
+
+def test_balance_aggregates(mocker) -> None:
+    state = MockAppState()
+    # Mocked out startup junk for AbstractAccount initialization.
+    mocker.patch.object(state, "async_", return_value=NotImplemented)
+    mocker.patch("electrumsv.wallet_database.tables.PaymentRequestTable.read").return_value = []
+
+    account_row = AccountRow(ACCOUNT_ID, MASTERKEY_ID, ScriptType.P2PKH, "ACCOUNT 1")
+    keyinstance_rows = [
+        KeyInstanceRow(KEYINSTANCE_ID+1, ACCOUNT_ID, MASTERKEY_ID, DerivationType.BIP32,
+            b'111', ScriptType.P2PKH, KeyInstanceFlag.IS_ACTIVE, None),
+    ]
+    TX_HASH_3 = b'3' * 32
+    heights = { TX_HASH_1: 100, TX_HASH_2: 0, TX_HASH_3: 150 }
+    transactionoutput_rows = [
+        TransactionOutputRow(TX_HASH_1, 0, 1000, KEYINSTANCE_ID+1, TransactionOutputFlag.NONE),
+        TransactionOutputRow(TX_HASH_1, 1, 2000, KEYINSTANCE_ID+1,
+            TransactionOutputFlag.IS_FROZEN),
+        TransactionOutputRow(TX_HASH_2, 0, 400, KEYINSTANCE_ID+1, TransactionOutputFlag.NONE),
+        TransactionOutputRow(TX_HASH_3, 0, 50, KEYINSTANCE_ID+1,
+            TransactionOutputFlag.IS_COINBASE),
+    ]
+
+    wallet = MockWallet()
+    wallet._transaction_cache.get_metadata = lambda tx_hash: TxData(height=heights[tx_hash])
+    wallet.get_local_height = lambda: 200
+    wallet.update_transactionoutput_flags = unittest.mock.Mock()
+    mocker.patch("electrumsv.wallet.DEBUG_BALANCE_AGGREGATES", True)
+    account = CustomAccount(wallet, account_row, keyinstance_rows, transactionoutput_rows)
+
+    assert account.get_balance() == (3000, 400, 50)
+    assert account.get_balance(exclude_frozen_coins=True) == (1000, 400, 50)
+    assert account.get_frozen_balance() == (2000, 0, 0)
+
+    # The coinbase coin matures as the chain grows.
+    wallet.get_local_height = lambda: 250
+    assert account.get_balance() == (3050, 400, 0)
+
+    # A reorg or a confirmation moves all the coins of the transaction.
+    heights[TX_HASH_1] = 0
+    heights[TX_HASH_2] = 201
+    account.update_transaction_heights([ TX_HASH_1, TX_HASH_2 ])
+    assert account.get_balance() == (450, 3000, 0)
+    assert account.get_frozen_balance() == (0, 2000, 0)
+
+    utxo = account.get_utxo(TX_HASH_1, 0)
+    account.set_frozen_coin_state([ utxo ], True)
+    assert account.get_frozen_balance() == (0, 3000, 0)
+    account.set_frozen_coin_state([ utxo ], False)
+    assert account.get_frozen_balance() == (0, 2000, 0)
+
+    # Spending a frozen coin also removes it from the frozen balance.
+    account.set_utxo_spent(TX_HASH_1, 1)
+    assert account.get_balance() == (450, 1000, 0)
+    assert account.get_frozen_balance() == (0, 0, 0)
+    account.set_utxo_spent(TX_HASH_1, 0)
+    assert not account._utxo_index.has_transaction(TX_HASH_1)
+    assert account.get_balance() == (450, 0, 0)
+
+    # An explicit domain is calculated from the coins.
+    assert account.get_balance({ TxoKeyType(TX_HASH_2, 0) }) == (400, 0, 0)
+
+
+
+def test_utxo_index(mocker) -> None:
+    state = MockAppState()
+    # Mocked out startup junk for AbstractAccount initialization.
+    mocker.patch.object(state, "async_", return_value=NotImplemented)
+    mocker.patch("electrumsv.wallet_database.tables.PaymentRequestTable.read").return_value = []
+
+    account_row = AccountRow(ACCOUNT_ID, MASTERKEY_ID, ScriptType.P2PKH, "ACCOUNT 1")
+    keyinstance_rows = [
+        KeyInstanceRow(KEYINSTANCE_ID+1, ACCOUNT_ID, MASTERKEY_ID, DerivationType.BIP32,
+            b'111', ScriptType.P2PKH, KeyInstanceFlag.IS_ACTIVE, None),
+        KeyInstanceRow(KEYINSTANCE_ID+2, ACCOUNT_ID, MASTERKEY_ID, DerivationType.BIP32,
+            b'111', ScriptType.P2PKH, KeyInstanceFlag.IS_ACTIVE, None),
+    ]
+    TX_HASH_3 = b'3' * 32
+    heights = { TX_HASH_1: 100, TX_HASH_2: 0, TX_HASH_3: 150 }
+    transactionoutput_rows = [
+        TransactionOutputRow(TX_HASH_1, 0, 1000, KEYINSTANCE_ID+1, TransactionOutputFlag.NONE),
+        TransactionOutputRow(TX_HASH_1, 1, 2000, KEYINSTANCE_ID+2,
+            TransactionOutputFlag.IS_FROZEN),
+        TransactionOutputRow(TX_HASH_2, 0, 400, KEYINSTANCE_ID+2, TransactionOutputFlag.NONE),
+        TransactionOutputRow(TX_HASH_3, 0, 50, KEYINSTANCE_ID+1,
+            TransactionOutputFlag.IS_COINBASE),
+    ]
+
+    wallet = MockWallet()
+    wallet._transaction_cache.get_metadata = lambda tx_hash: TxData(height=heights[tx_hash])
+    wallet.get_local_height = lambda: 200
+    account = CustomAccount(wallet, account_row, keyinstance_rows, transactionoutput_rows)
+
+    def get_utxo_keys(**kwargs) -> Set[TxoKeyType]:
+        return set(utxo.key() for utxo in account.get_utxos(**kwargs))
+
+    COIN_1_0, COIN_1_1 = TxoKeyType(TX_HASH_1, 0), TxoKeyType(TX_HASH_1, 1)
+    COIN_2_0, COIN_3_0 = TxoKeyType(TX_HASH_2, 0), TxoKeyType(TX_HASH_3, 0)
+    assert get_utxo_keys() == { COIN_1_0, COIN_1_1, COIN_2_0, COIN_3_0 }
+    assert get_utxo_keys(exclude_frozen=True) == { COIN_1_0, COIN_2_0, COIN_3_0 }
+    assert get_utxo_keys(mature=True) == { COIN_1_0, COIN_1_1, COIN_2_0 }
+    assert get_utxo_keys(confirmed_only=True) == { COIN_1_0, COIN_1_1, COIN_3_0 }
+    assert get_utxo_keys(key_ids=[ KEYINSTANCE_ID+2 ]) == { COIN_1_1, COIN_2_0 }
+    assert get_utxo_keys(exclude_frozen=True, key_ids=[ KEYINSTANCE_ID+2 ]) == { COIN_2_0 }
+    assert get_utxo_keys(mature=True, key_ids=[ KEYINSTANCE_ID+1 ]) == { COIN_1_0 }
+
+    # The coinbase coin is spendable in the block after it matures.
+    wallet.get_local_height = lambda: 249
+    assert get_utxo_keys(mature=True, key_ids=[ KEYINSTANCE_ID+1 ]) == { COIN_1_0, COIN_3_0 }
+
+    heights[TX_HASH_2] = 201
+    account.update_transaction_heights([ TX_HASH_2 ])
+    assert get_utxo_keys(confirmed_only=True, exclude_frozen=True) == \
+        { COIN_1_0, COIN_2_0, COIN_3_0 }
+
+    spendable_coins = account.get_spendable_coins([ KEYINSTANCE_ID+2 ], {})
+    assert [ utxo.key() for utxo in spendable_coins ] == [ COIN_2_0 ]
+    assert set(account.get_key_txokeys({ KEYINSTANCE_ID+1 })[0]) == { COIN_1_0, COIN_3_0 }
+
+
+def test_history_index() -> None:
+    history_index = HistoryIndex(checkpoint_interval=2)
+    metadatas = {
+        b'1' * 32: TxData(height=10, position=1, date_added=1),
+        b'2' * 32: TxData(height=10, position=0, date_added=2),
+        b'3' * 32: TxData(height=12, position=5, date_added=3),
+        b'4' * 32: TxData(height=0, date_added=4),
+        b'5' * 32: TxData(height=15, position=1, date_added=5),
+    }
+    values = { b'1' * 32: 100, b'2' * 32: 50, b'3' * 32: -30, b'4' * 32: 7, b'5' * 32: -20 }
+    for tx_hash, value in values.items():
+        history_index.update(tx_hash, metadatas[tx_hash], value)
+
+    def check_lines(expected_order: List[bytes]) -> None:
+        assert len(history_index) == len(expected_order)
+        balance = 0
+        expected_lines = []
+        for tx_hash in expected_order:
+            balance += values[tx_hash]
+            expected_lines.append((tx_hash, metadatas[tx_hash].height, values[tx_hash], balance))
+        assert history_index.get_lines(0, len(expected_order)) == expected_lines
+        for start in range(len(expected_order)):
+            assert history_index.get_lines(start, start + 2) == expected_lines[start:start+2]
+
+    check_lines([ b'2' * 32, b'1' * 32, b'3' * 32, b'5' * 32, b'4' * 32 ])
+    assert history_index.find_height(11) == 2
+    assert history_index.find_height(13) == 3
+    assert history_index.find_height(16) == 4
+
+    # Confirming a transaction moves it into place.
+    metadatas[b'4' * 32] = TxData(height=11, position=3, date_added=4)
+    history_index.update(b'4' * 32, metadatas[b'4' * 32])
+    check_lines([ b'2' * 32, b'1' * 32, b'4' * 32, b'3' * 32, b'5' * 32 ])
+
+    # A reorg moves it back to the end.
+    metadatas[b'4' * 32] = TxData(height=0, date_added=4)
+    history_index.update(b'4' * 32, metadatas[b'4' * 32])
+    check_lines([ b'2' * 32, b'1' * 32, b'3' * 32, b'5' * 32, b'4' * 32 ])
+
+    # Further key usage changes the value in place.
+    values[b'1' * 32] += 25
+    history_index.update(b'1' * 32, metadatas[b'1' * 32], 25)
+    check_lines([ b'2' * 32, b'1' * 32, b'3' * 32, b'5' * 32, b'4' * 32 ])
+
+    # Transactions without a height are tracked, but not included until they have one.
+    values[b'6' * 32] = 1000
+    metadatas[b'6' * 32] = TxData(date_added=6)
+    history_index.update(b'6' * 32, metadatas[b'6' * 32], 1000)
+    check_lines([ b'2' * 32, b'1' * 32, b'3' * 32, b'5' * 32, b'4' * 32 ])
+    metadatas[b'6' * 32] = TxData(height=0, date_added=6)
+    history_index.update(b'6' * 32, metadatas[b'6' * 32])
+    check_lines([ b'2' * 32, b'1' * 32, b'3' * 32, b'5' * 32, b'4' * 32, b'6' * 32 ])
+
+    history_index.remove(b'2' * 32)
+    check_lines([ b'1' * 32, b'3' * 32, b'5' * 32, b'4' * 32, b'6' * 32 ])
+    assert not history_index.has_transaction(b'2' * 32)
+    assert history_index.get_tx_hashes() == [ b'1' * 32, b'3' * 32, b'5' * 32, b'4' * 32,
+        b'6' * 32 ]
+
+
+def test_history_index_read(mocker) -> None:
+    state = MockAppState()
+    # Mocked out startup junk for AbstractAccount initialization.
+    mocker.patch.object(state, "async_", return_value=NotImplemented)
+    mocker.patch("electrumsv.wallet_database.tables.PaymentRequestTable.read").return_value = []
+
+    account_row = AccountRow(ACCOUNT_ID, MASTERKEY_ID, ScriptType.P2PKH, "ACCOUNT 1")
+    TX_HASH_3 = b'3' * 32
+    metadatas = {
+        TX_HASH_1: TxData(height=100, position=1, date_added=1),
+        TX_HASH_2: TxData(height=0, date_added=2),
+        TX_HASH_3: TxData(height=0, date_added=3),
+    }
+    wallet = MockWallet()
+    wallet._transaction_cache.get_metadata = lambda tx_hash: metadatas[tx_hash]
+    account = CustomAccount(wallet, account_row, [], [])
+
+    queued_writes = []
+    write_queued = threading.Event()
+    def queue_write(write_callback, completion_callback) -> None:
+        queued_writes.append((write_callback, completion_callback))
+        write_queued.set()
+    wallet._db_context.queue_write = queue_write
+    mocker.patch("electrumsv.wallet_database.tables.TransactionDeltaTable."
+        "read_history_with_connection").return_value = [
+            TransactionDeltaHistoryRow(TX_HASH_1, TxFlags.StateSettled, 100),
+            TransactionDeltaHistoryRow(TX_HASH_2, TxFlags.StateCleared, 50),
+        ]
+
+    # The history is read by a queued write, without holding the transaction lock.
+    history_counts = []
+    thread = threading.Thread(target=lambda: history_counts.append(account.get_history_count()))
+    thread.start()
+    assert write_queued.wait(5)
+    assert account.transaction_lock.acquire(timeout=5)
+    account.transaction_lock.release()
+
+    # Changes made before the read completes are applied to the index once it is read.
+    metadatas[TX_HASH_2] = TxData(height=101, position=0, date_added=2)
+    account.update_transaction_heights([ TX_HASH_2 ])
+    with account._history_lock:
+        account._update_history_index(partial(account._add_history_value, TX_HASH_3, 20))
+        account._update_history_index(partial(account._remove_history_line, TX_HASH_1))
+
+    write_callback, completion_callback = queued_writes[0]
+    write_callback(None)
+    completion_callback(None)
+    thread.join(5)
+    assert history_counts == [ 2 ]
+    assert [ (line.tx_hash, balance) for line, balance in account.get_history() ] == \
+        [ (TX_HASH_3, 70), (TX_HASH_2, 50) ]
+    assert account._history_index_updates is None
+
+
+def test_export_history_missing_headers(mocker) -> None:
+    state = MockAppState()
+    # Mocked out startup junk for AbstractAccount initialization.
+    mocker.patch.object(state, "async_", return_value=NotImplemented)
+    mocker.patch("electrumsv.wallet_database.tables.PaymentRequestTable.read").return_value = []
+
+    account_row = AccountRow(ACCOUNT_ID, MASTERKEY_ID, ScriptType.P2PKH, "ACCOUNT 1")
+    wallet = MockWallet()
+    wallet.get_transaction_label = lambda tx_hash: None
+    account = CustomAccount(wallet, account_row, [], [])
+    mocker.patch.object(account, "get_history_for_timestamps").return_value = [
+        (HistoryLine((0, 2), TX_HASH_2, TxFlags.StateCleared, 0, 20), 120),
+        (HistoryLine((100, 1), TX_HASH_1, TxFlags.StateSettled, 100, 100), 100),
+    ]
+    state.fx = None
+    state.headers = unittest.mock.Mock()
+    state.header_timestamps = unittest.mock.Mock()
+    state.header_timestamps.timestamps_for_heights.return_value = [ None, None ]
+
+    # Without a network the header cannot be fetched, and the line has no timestamp.
+    state.daemon = unittest.mock.Mock(network=None)
+    history = account.export_history()
+    assert [ item['height'] for item in history ] == [ 0, 100 ]
+    assert history[0]['timestamp'] is not None
+    assert history[1]['timestamp'] is None
+
+    # Neither does it if the network does not fetch it in time.
+    network = state.daemon.network = unittest.mock.Mock()
+    network.get_server_height.return_value = 200
+    network.backfill_headers_at_heights_and_wait.return_value = False
+    history = account.export_history()
+    network.backfill_headers_at_heights_and_wait.assert_called_once_with([ 100 ],
+        EXPORT_HEADER_FETCH_TIMEOUT)
+    assert history[1]['timestamp'] is None
+
+
+def test_keyinstance_store() -> None:
+    def make_row(key_id: int, description: Optional[str]=None) -> KeyInstanceRow:
+        return KeyInstanceRow(key_id, 1, None if key_id % 2 else 7,
+            DerivationType.BIP32_SUBPATH, b'{"subpath": [0, %d]}' % key_id, ScriptType.P2PKH,
+            KeyInstanceFlag.IS_ACTIVE, description)
+
+    rows = [ make_row(key_id) for key_id in range(10, 0, -1) ]
+    store = KeyInstanceStore(rows)
+    assert len(store) == 10
+    assert list(store) == list(range(1, 11))
+    assert all(store[row.keyinstance_id] == row for row in rows)
+    assert store.get(11) is None
+    assert store.get_script_type(3) == ScriptType.P2PKH
+
+    # Replacing values, including with derivation data of a different length.
+    store[3] = make_row(3, "label")._replace(derivation_data=b"{}", flags=KeyInstanceFlag.NONE)
+    assert store[3].description == "label"
+    assert store[3].derivation_data == b"{}"
+    assert store.get_flags(3) == KeyInstanceFlag.NONE
+    assert store[4] == make_row(4)
+
+    for key_id in range(1, 11):
+        store.paths[key_id] = (0, key_id)
+    store.paths[2] = (1, 2)
+    assert store.paths.get_child_key_ids((0,)) == [ 1 ] + list(range(3, 11))
+    assert store.paths.get_child_key_ids((1,)) == [ 2 ]
+
+    # Removed keys lose their path, and come back without it.
+    del store[5]
+    assert 5 not in store
+    assert 5 not in store.paths
+    assert len(store.paths) == 9
+    assert store.paths.get_child_key_ids((0,)) == [ 1, 3, 4 ] + list(range(6, 11))
+    store[5] = make_row(5)
+    assert store[5] == make_row(5)
+    assert 5 not in store.paths
+    del store.paths[2]
+    assert store.paths.get_child_key_ids((1,)) == []
+
+    # Enough removals compact the columns.
+    store = KeyInstanceStore(make_row(key_id) for key_id in range(1, 3001))
+    for key_id in range(1, 3001):
+        store.paths[key_id] = (0, key_id)
+    for key_id in range(1, 2500):
+        del store[key_id]
+    assert len(store._ids) < 3000
+    assert list(store) == list(range(2500, 3001))
+    assert all(store[key_id] == make_row(key_id) for key_id in range(2500, 3001))
+    assert store.paths[2500] == (0, 2500)
+    assert store.paths.get_child_key_ids((0,)) == list(range(2500, 3001))
@@ -0,0 +1,92 @@
+from decimal import Decimal
+from unittest.mock import MagicMock
+
+import pytest
+
+from electrumsv.bitcoin import COIN
+from electrumsv.exchange_rate import (date_string_to_day, day_to_date_string, ExchangeBase,
+    FxTask, HistoricalRates, SECONDS_PER_DAY)
+
+
+def test_date_string_day_mapping() -> None:
+    assert date_string_to_day("1970-01-01") == 0
+    assert date_string_to_day("2020-01-01") == 18262
+    assert day_to_date_string(18262) == "2020-01-01"
+
+
+def test_historical_rates_update() -> None:
+    rates = HistoricalRates.from_dict({ "2020-01-03": 3.0, "2020-01-05": 5.0 })
+    assert rates.first_day == date_string_to_day("2020-01-03")
+    assert len(rates) == 3
+    assert rates.get_rate(rates.first_day) == 3.0
+    assert rates.get_rate(rates.first_day + 1) is None
+    assert rates.get_rate(rates.first_day + 2) == 5.0
+    assert rates.get_rate(rates.first_day + 3) is None
+    assert rates.get_rate(rates.first_day - 1) is None
+
+    # Both extending before the first day and after the last day, and replacing a rate.
+    rates.update({ "2020-01-01": 1.0, "2020-01-05": 5.5, "2020-01-07": 7.0, "2020-01-08": None })
+    assert rates.first_day == date_string_to_day("2020-01-01")
+    assert rates.last_day() == date_string_to_day("2020-01-07")
+    assert rates.to_dict() == { "2020-01-01": 1.0, "2020-01-03": 3.0, "2020-01-05": 5.5,
+        "2020-01-07": 7.0 }
+
+
+def test_historical_rates_bytes() -> None:
+    rates = HistoricalRates.from_dict({ "2020-01-03": 3.0, "2020-01-05": 5.0 })
+    rates2 = HistoricalRates.from_bytes(rates.to_bytes())
+    assert rates2.first_day == rates.first_day
+    assert rates2.to_dict() == rates.to_dict()
+
+    with pytest.raises(ValueError):
+        HistoricalRates.from_bytes(b"XXXX" + rates.to_bytes()[4:])
+    with pytest.raises(ValueError):
+        HistoricalRates.from_bytes(rates.to_bytes()[:-1])
+
+
+class _Exchange(ExchangeBase):
+    def __init__(self, date_rates) -> None:
+        super().__init__()
+        self.date_rates = date_rates
+        self.requested_days = []
+
+    def request_history(self, ccy, days=None):
+        self.requested_days.append(days)
+        return self.date_rates
+
+
+def test_get_historical_rates_incremental(tmp_path, monkeypatch) -> None:
+    today = date_string_to_day("2020-01-10")
+    monkeypatch.setattr("time.time", lambda: today * SECONDS_PER_DAY + 100)
+
+    exchange = _Exchange({ "2020-01-01": 1.0, "2020-01-08": 8.0 })
+    rates = exchange._get_historical_rates("USD", str(tmp_path))
+    assert exchange.requested_days == [ None ]
+    assert rates.last_day() == date_string_to_day("2020-01-08")
+
+    # A new exchange object picks up the binary cache, and only asks for the missing days.
+    exchange = _Exchange({ "2020-01-10": 10.0 })
+    rates = exchange._get_historical_rates("USD", str(tmp_path))
+    assert exchange.requested_days == [ 3 ]
+    assert rates.to_dict() == { "2020-01-01": 1.0, "2020-01-08": 8.0, "2020-01-10": 10.0 }
+
+    exchange.history["USD"] = rates
+    exchange._get_historical_rates("USD", str(tmp_path))
+    assert exchange.requested_days == [ 3 ]
+
+
+def test_historical_values() -> None:
+    fx = FxTask.__new__(FxTask)
+    fx.ccy = "USD"
+    fx.history_used_spot = False
+    fx.exchange = _Exchange({})
+    fx.exchange.history["USD"] = HistoricalRates.from_dict({ "2020-01-01": 2.0 })
+    fx.exchange.quotes = {}
+    fx.config = MagicMock()
+
+    day = date_string_to_day("2020-01-01")
+    values = fx.historical_values([ COIN, -COIN, None, COIN ],
+        [ day * SECONDS_PER_DAY, day * SECONDS_PER_DAY + 5, day * SECONDS_PER_DAY,
+          (day + 1) * SECONDS_PER_DAY ])
+    assert values == [ Decimal(2), Decimal(-2), None, None ]
+    assert not fx.history_used_spot
@@ -1,3 +1,5 @@
+from concurrent.futures import ProcessPoolExecutor
+
 import pytest
 
 from bitcoinx import PublicKey, PrivateKey
@@ -279,6 +281,22 @@ class TestXPub:
         pubkey = keystore.derive_pubkey((for_change, n))
         assert pubkey == XPublicKey.from_hex(pubkey_hex).to_public_key()
 
+    @pytest.mark.parametrize("use_executor", (False, True))
+    def test_derive_pubkeys(self, use_executor, monkeypatch):
+        xpub = ('xpub661MyMwAqRbcH1RHYeZc1zgwYLJ1dNozE8npCe81pnNYtN6e5KsF6cmt17Fv8w'
+                'GvJrRiv6Kewm8ggBG6N3XajhoioH3stUmLRi53tk46CiA')
+        keystore = BIP32_KeyStore({'xpub': xpub})
+        if use_executor:
+            # Force the range to be split over several tasks.
+            monkeypatch.setattr("electrumsv.keystore.DERIVATION_CHUNK_SIZE", 3)
+            with ProcessPoolExecutor(max_workers=2) as executor:
+                pubkeys = keystore.derive_pubkeys([ 1 ], 2, 8, executor)
+        else:
+            pubkeys = keystore.derive_pubkeys([ 1 ], 2, 8)
+        assert pubkeys == [ keystore.derive_pubkey((1, n)) for n in range(2, 10) ]
+        assert pubkeys[3] == XPublicKey.from_hex(
+            '033177256871768b5ee8e031647f3727e63d1b62c8d776d9b422a367fd8e721bd3').to_public_key()
+
     def test_xpubkey(self):
         xpub = ('xpub661MyMwAqRbcH1RHYeZc1zgwYLJ1dNozE8npCe81pnNYtN6e5KsF6cmt17Fv8w'
                 'GvJrRiv6Kewm8ggBG6N3XajhoioH3stUmLRi53tk46CiA')
@@ -0,0 +1,343 @@
+import asyncio
+import contextlib
+import logging
+import os
+import random
+from types import SimpleNamespace
+import unittest.mock
+
+from aiorpcx import RPCError
+from bitcoinx import double_sha256, hash_to_hex_str, MissingHeader
+import pytest
+
+from electrumsv import network as network_module
+from electrumsv.network import (HEADER_CHUNK_SIZE, HEADER_SIZE, HeaderChunkSync, Network,
+    SCRIPTHASH_SUBSCRIBE, SVSession, _root_from_proof, _verify_block_proofs)
+
+
+def _run(coro):
+    loop = asyncio.new_event_loop()
+    try:
+        return loop.run_until_complete(coro)
+    finally:
+        loop.close()
+
+
+def _merkle_tree(leaves):
+    # Each level of the tree, with the leaves first and the root last.
+    levels = [ list(leaves) ]
+    while len(levels[-1]) > 1:
+        level = levels[-1]
+        if len(level) & 1:
+            level = level + [ level[-1] ]
+        levels.append([ double_sha256(level[i] + level[i+1]) for i in range(0, len(level), 2) ])
+    return levels
+
+def _merkle_branch(levels, index):
+    branch = []
+    for level in levels[:-1]:
+        sibling_index = index ^ 1
+        branch.append(level[sibling_index] if sibling_index < len(level) else level[index])
+        index >>= 1
+    return branch
+
+
+def test_verify_block_proofs() -> None:
+    leaves = [ os.urandom(32) for i in range(11) ]
+    levels = _merkle_tree(leaves)
+    merkle_root = levels[-1][0]
+    proofs = [ (leaves[i], _merkle_branch(levels, i), i) for i in range(len(leaves)) ]
+    for tx_hash, branch, index in proofs:
+        assert _root_from_proof(tx_hash, branch, index) == merkle_root
+
+    assert _verify_block_proofs(merkle_root, proofs) == [ True ] * len(leaves)
+    # The order the proofs are verified in does not matter.
+    assert _verify_block_proofs(merkle_root, proofs[::-1]) == [ True ] * len(leaves)
+
+    bad_proofs = [
+        # A transaction that is not in the block.
+        (os.urandom(32), proofs[2][1], 2),
+        # A transaction placed at the wrong position.
+        (leaves[3], proofs[3][1], 2),
+        # A proof with a corrupted branch.
+        (leaves[4], proofs[4][1][:-1] + [ os.urandom(32) ], 4),
+        # A position that is out of range for the branch.
+        (leaves[5], proofs[5][1], 5 + (1 << len(proofs[5][1]))),
+    ]
+    # Invalid proofs fail both on their own, and when the shared nodes are already proven.
+    assert _verify_block_proofs(merkle_root, bad_proofs) == [ False ] * len(bad_proofs)
+    assert _verify_block_proofs(merkle_root, proofs + bad_proofs) == \
+        [ True ] * len(proofs) + [ False ] * len(bad_proofs)
+    assert _verify_block_proofs(os.urandom(32), proofs) == [ False ] * len(proofs)
+
+    # A truncated branch that reaches a proven node does not hash to the root on its own.
+    truncated_proofs = [ (leaves[0], proofs[0][1][:1], 0), (leaves[2], proofs[2][1][:2], 2) ]
+    assert _verify_block_proofs(merkle_root, proofs[1:2] + truncated_proofs) == \
+        [ True, False, False ]
+    assert _verify_block_proofs(merkle_root, proofs + truncated_proofs) == \
+        [ True ] * len(proofs) + [ False ] * len(truncated_proofs)
+
+
+def test_shard_session_assignment() -> None:
+    sessions = [ unittest.mock.Mock(server=f"server{i}") for i in range(4) ]
+    script_hashes = [ os.urandom(32) for i in range(200) ]
+
+    assignments = { script_hash: Network._shard_session(script_hash, sessions)
+        for script_hash in script_hashes }
+    # Every session is given a share.
+    assert set(assignments.values()) == set(sessions)
+    # The assignment does not depend on the order of the sessions.
+    assert all(Network._shard_session(script_hash, sessions[::-1]) is session
+        for script_hash, session in assignments.items())
+
+    # Removing a session only moves the script hashes that were assigned to it.
+    remaining_sessions = sessions[:2] + sessions[3:]
+    for script_hash, session in assignments.items():
+        new_session = Network._shard_session(script_hash, remaining_sessions)
+        if session is sessions[2]:
+            assert new_session in remaining_sessions
+        else:
+            assert new_session is session
+
+
+class _HeaderSession:
+    def __init__(self, network, name: str, server_height: int, corrupt: bool=False) -> None:
+        self._network = network
+        self.server = name
+        self.logger = logging.getLogger(name)
+        self.server_height = server_height
+        self.corrupt = corrupt
+        self.requests = []
+        self.connected = []
+        self.chain = None
+
+    def is_closing(self) -> bool:
+        return False
+
+    async def _fetch_chunk(self, height: int, count: int) -> bytes:
+        self.requests.append((height, count))
+        # Responses arrive out of order.
+        await asyncio.sleep(random.random() * 0.01)
+        last_height = min(height + count - 1, self.server_height)
+        fill = b"X" if self.corrupt else b"\0"
+        return b"".join(h.to_bytes(4, "little") + fill * (HEADER_SIZE - 4)
+            for h in range(height, last_height + 1))
+
+    def _connect_chunk(self, start_height: int, raw_chunk: bytes) -> str:
+        for i in range(len(raw_chunk) // HEADER_SIZE):
+            raw_header = raw_chunk[i * HEADER_SIZE:(i+1) * HEADER_SIZE]
+            if int.from_bytes(raw_header[:4], "little") != start_height + i or \
+                    raw_header[4:] != bytes(HEADER_SIZE - 4):
+                raise MissingHeader("prev_hash does not connect")
+        self.connected.append((start_height, len(raw_chunk) // HEADER_SIZE))
+        return "chain"
+
+
+def test_header_chunk_sync(monkeypatch) -> None:
+    monkeypatch.setattr(network_module, "app_state", SimpleNamespace(config={}))
+    progress = []
+    network = SimpleNamespace(_header_sessions=set(),
+        _set_header_sync_progress=lambda *args: progress.append(args))
+
+    end_height = 20 * HEADER_CHUNK_SIZE + 100
+    session = _HeaderSession(network, "main", end_height)
+    # A session that is behind, and one that returns headers that do not connect.
+    lagging_session = _HeaderSession(network, "lagging", HEADER_CHUNK_SIZE // 2)
+    corrupt_session = _HeaderSession(network, "corrupt", end_height, corrupt=True)
+    other_session = _HeaderSession(network, "other", end_height)
+    network._header_sessions.update([ session, lagging_session, corrupt_session,
+        other_session ])
+
+    sync = HeaderChunkSync(session, 1, end_height)
+    assert _run(sync.run()) == end_height
+
+    # Every header was connected once, in order, by the session that is catching up.
+    connected_height = 1
+    for start_height, count in session.connected:
+        assert start_height == connected_height
+        connected_height += count
+    assert connected_height == end_height + 1
+    assert session.chain == "chain"
+    # The work was spread over the other sessions, and those that failed were dropped.
+    assert len(other_session.requests) > 1
+    assert corrupt_session in sync._excluded_sessions
+    assert lagging_session in sync._excluded_sessions
+    assert progress[0] == (0, end_height)
+    assert progress[-2] == (end_height, end_height)
+    assert progress[-1] == (None,)
+
+
+class _FetchSession:
+    def __init__(self, name: str, delay: float) -> None:
+        self.server = name
+        self.logger = logging.getLogger(name)
+        self.delay = delay
+        self.in_flight = 0
+        self.maximum_in_flight = 0
+        self.batch_count = 0
+
+    async def request_txs(self, tx_hashes):
+        self.in_flight += 1
+        self.maximum_in_flight = max(self.maximum_in_flight, self.in_flight)
+        self.batch_count += 1
+        await asyncio.sleep(self.delay)
+        self.in_flight -= 1
+        return [ _RAW_TXS[tx_hash] for tx_hash in tx_hashes ]
+
+
+def _make_raw_tx(locktime: int) -> str:
+    # A transaction with no inputs and no outputs, distinguished by its lock time.
+    return (1).to_bytes(4, "little").hex() + "0000" + locktime.to_bytes(4, "little").hex()
+
+_RAW_TXS = { double_sha256(bytes.fromhex(_make_raw_tx(i))): _make_raw_tx(i)
+    for i in range(200) }
+
+
+def test_request_transactions_session_windows(monkeypatch) -> None:
+    monkeypatch.setattr(network_module, "app_state", SimpleNamespace(config={
+        "tx_fetch_batch_size": 5, "tx_fetch_window": 2 }))
+    fast_session = _FetchSession("fast", 0.001)
+    slow_session = _FetchSession("slow", 0.05)
+
+    async def _sync_sessions():
+        return [ slow_session, fast_session ]
+    network = SimpleNamespace(_sync_sessions=_sync_sessions,
+        _next_fetch_session=Network._next_fetch_session)
+
+    added_hashes = []
+    async def add_transactions_async(tx_entries, flags, external):
+        added_hashes.extend(tx_hash for tx_hash, tx in tx_entries)
+    wallet = SimpleNamespace(request_count=0, response_count=0,
+        progress_event=asyncio.Event(), add_transactions_async=add_transactions_async)
+
+    tx_hashes = list(_RAW_TXS)
+    had_timeout = _run(Network._request_transactions(network, wallet, tx_hashes))
+    assert not had_timeout
+    assert sorted(added_hashes) == sorted(tx_hashes)
+    assert wallet.response_count == len(tx_hashes)
+    # No session ever has more than its window of requests in flight, and the freed slots of
+    # the fast session are refilled rather than queuing more requests behind the slow session.
+    assert fast_session.maximum_in_flight == 2
+    assert slow_session.maximum_in_flight == 2
+    assert fast_session.batch_count + slow_session.batch_count == len(tx_hashes) // 5
+    assert slow_session.batch_count < fast_session.batch_count
+
+
+def test_send_script_hash_batches(monkeypatch) -> None:
+    monkeypatch.setattr(network_module, "app_state", SimpleNamespace(config={
+        "subscribe_batch_size": 3, "subscribe_window": 2 }))
+    script_hashes = [ os.urandom(32) for i in range(10) ]
+    sent_batches = []
+    in_flight = []
+    maximum_in_flight = 0
+
+    async def send_batch(batch_script_hashes):
+        nonlocal maximum_in_flight
+        sent_batches.append(batch_script_hashes)
+        in_flight.append(batch_script_hashes)
+        maximum_in_flight = max(maximum_in_flight, len(in_flight))
+        await asyncio.sleep(random.random() * 0.01)
+        in_flight.remove(batch_script_hashes)
+
+    done_counts = []
+    _run(SVSession._send_script_hash_batches(None, send_batch, script_hashes,
+        done_counts.append))
+    # The script hashes are sent in batches of the configured size, in order.
+    assert [ len(batch) for batch in sent_batches ] == [ 3, 3, 3, 1 ]
+    assert [ script_hash for batch in sent_batches for script_hash in batch ] == script_hashes
+    # No more than the window of batches are in flight at once.
+    assert maximum_in_flight == 2
+    assert sorted(done_counts) == [ 1, 3, 3, 3 ]
+
+
+def test_send_script_hash_batches_error(monkeypatch) -> None:
+    monkeypatch.setattr(network_module, "app_state", SimpleNamespace(config={
+        "subscribe_batch_size": 2, "subscribe_window": 2 }))
+    script_hashes = [ os.urandom(32) for i in range(20) ]
+    sent_batches = []
+
+    async def send_batch(batch_script_hashes):
+        sent_batches.append(batch_script_hashes)
+        if batch_script_hashes[0] == script_hashes[2]:
+            raise RPCError(1, "bad request")
+        await asyncio.sleep(0.01)
+
+    done_counts = []
+    with pytest.raises(RPCError):
+        _run(SVSession._send_script_hash_batches(None, send_batch, script_hashes,
+            done_counts.append))
+    # The error cancels the batches that have not been sent yet.
+    assert len(sent_batches) < len(script_hashes) // 2
+    assert sum(done_counts) < len(script_hashes)
+
+
+class _SubscribeBatch:
+    def __init__(self, results) -> None:
+        self.requests = []
+        self.results = results
+
+    def add_request(self, method, args) -> None:
+        self.requests.append((method, args))
+
+
+def test_subscribe_to_script_hashes() -> None:
+    script_hashes = [ os.urandom(32) for i in range(4) ]
+    batch_error = RPCError(1, "unknown script hash")
+    batch = _SubscribeBatch([ "status0", None, batch_error, "status3" ])
+
+    @contextlib.asynccontextmanager
+    async def send_batch(raise_errors):
+        assert not raise_errors
+        yield batch
+
+    status_queue = asyncio.Queue()
+    session = SimpleNamespace(send_batch=send_batch,
+        _network=SimpleNamespace(_on_status_queue=status_queue))
+    with pytest.raises(RPCError) as e:
+        _run(SVSession._subscribe_to_script_hashes(session, script_hashes))
+    assert e.value is batch_error
+    assert batch.requests == [ (SCRIPTHASH_SUBSCRIBE, [ hash_to_hex_str(script_hash) ])
+        for script_hash in script_hashes ]
+    # The statuses of the script hashes that were subscribed are still queued.
+    queued = [ status_queue.get_nowait() for i in range(status_queue.qsize()) ]
+    assert queued == [ (script_hashes[0], "status0"), (script_hashes[1], None),
+        (script_hashes[3], "status3") ]
+
+
+class _ShardSession:
+    def __init__(self, name: str, closing: bool=False) -> None:
+        self.server = name
+        self.ptuple = (1, 4, 2)
+        self.closing = closing
+        self.unsubscribed = []
+
+    def is_closing(self) -> bool:
+        return self.closing
+
+    async def _send_script_hash_batches(self, send_batch, script_hashes) -> None:
+        await send_batch(script_hashes)
+
+    async def _unsubscribe_from_script_hashes(self, script_hashes) -> None:
+        self.unsubscribed.extend(script_hashes)
+
+
+def test_drop_account_subscriptions(monkeypatch) -> None:
+    account, other_account = object(), object()
+    closed_session = _ShardSession("closed", closing=True)
+    main_session = _ShardSession("main")
+    shard_session = _ShardSession("shard")
+    script_hashes = [ os.urandom(32) for i in range(5) ]
+    monkeypatch.setattr(SVSession, "_subs_by_account", {
+        account: list(script_hashes), other_account: [ script_hashes[4] ] })
+    monkeypatch.setattr(SVSession, "_subscription_sessions", {
+        script_hashes[0]: closed_session, script_hashes[1]: main_session,
+        script_hashes[2]: shard_session, script_hashes[3]: shard_session,
+        script_hashes[4]: shard_session })
+
+    _run(SVSession.drop_account_subscriptions(account, main_session))
+    assert list(SVSession._subs_by_account) == [ other_account ]
+    # Only the shard subscriptions that are not shared with another account are unsubscribed,
+    # and they are no longer attributed to the session so the account can resubscribe anywhere.
+    assert sorted(shard_session.unsubscribed) == sorted(script_hashes[2:4])
+    assert not closed_session.unsubscribed and not main_session.unsubscribed
+    assert SVSession._subscription_sessions == { script_hashes[4]: shard_session }
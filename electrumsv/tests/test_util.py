@@ -1,8 +1,15 @@
+import json
 import pytest
+import struct
+import tracemalloc
 import unittest
 
+from bitcoinx import MissingHeader
+
 from electrumsv.util import format_satoshis, get_identified_release_signers
 from electrumsv.util.cache import LRUCache
+from electrumsv.util.header_timestamps import HeaderTimestamps
+from electrumsv.util.timeline import Timeline
 
 from .conftest import get_tx_datacarrier_size, get_tx_small_size
 
@@ -250,3 +257,105 @@ def test_lrucache_add_past_limit_lru_ordering(max_count: int, max_size: int, tes
     added, removals = cache.set(b'6', test_tx_small)
     assert added
     assert removals == [(b'4', test_tx_small)]
+
+
+def test_timeline_disabled() -> None:
+    timeline = Timeline()
+    with timeline.phase("a") as phase:
+        phase.set_count("rows", 1)
+    assert timeline.to_dict()["phases"] == []
+
+def test_timeline_nested_phases(tmp_path) -> None:
+    path = tmp_path / "timeline.json"
+    timeline = Timeline()
+    was_tracing = tracemalloc.is_tracing()
+    try:
+        timeline.enable(str(path))
+        with timeline.phase("a") as phase_a:
+            with timeline.phase("b") as phase_b:
+                phase_b.set_count("rows", 2)
+                data = [ bytes(1000) for i in range(100) ]
+            with timeline.phase("c"):
+                pass
+            phase_a.set_count("rows", 3)
+            # The timeline is only written out when an outermost phase ends.
+            assert not path.exists()
+        del data
+    finally:
+        if not was_tracing:
+            tracemalloc.stop()
+
+    result = json.loads(path.read_text())
+    assert result["version"] == 1
+    assert len(result["phases"]) == 1
+    phase = result["phases"][0]
+    assert phase["name"] == "a"
+    assert phase["counts"] == { "rows": 3 }
+    assert [ child["name"] for child in phase["children"] ] == [ "b", "c" ]
+    assert phase["children"][0]["counts"] == { "rows": 2 }
+    assert phase["children"][0]["peak_memory"] >= 100 * 1000
+    assert phase["peak_memory"] >= phase["children"][0]["peak_memory"]
+    assert phase["duration"] >= phase["children"][0]["duration"]
+
+def test_timeline_failed_phase(tmp_path) -> None:
+    timeline = Timeline()
+    was_tracing = tracemalloc.is_tracing()
+    try:
+        timeline.enable(str(tmp_path / "timeline.json"))
+        with pytest.raises(ValueError):
+            with timeline.phase("a"):
+                raise ValueError
+    finally:
+        if not was_tracing:
+            tracemalloc.stop()
+    assert timeline.to_dict()["phases"][0]["counts"] == { "failed": 1 }
+
+
+class _TimestampChain:
+    def __init__(self, parent, first_height: int, height: int) -> None:
+        self.parent = parent
+        self.first_height = first_height
+        self.height = height
+
+
+class _TimestampHeaders:
+    def __init__(self, chain) -> None:
+        self.chain = chain
+        # (chain first height, height) -> timestamp
+        self.timestamps = {}
+        self.reads = 0
+
+    def longest_chain(self):
+        return self.chain
+
+    def raw_header_at_height(self, chain, height: int) -> bytes:
+        self.reads += 1
+        timestamp = self.timestamps.get((chain.first_height, height))
+        if timestamp is None:
+            raise MissingHeader(f"no header at height {height}")
+        return bytes(68) + struct.pack("<I", timestamp) + bytes(8)
+
+
+def test_header_timestamps() -> None:
+    base_chain = _TimestampChain(None, 100, 200)
+    fork_chain = _TimestampChain(base_chain, 150, 160)
+    headers = _TimestampHeaders(base_chain)
+    # The base chain is missing the headers before 50, as if not yet backfilled.
+    headers.timestamps.update({ (100, height): 1000 + height for height in range(50, 201) })
+    headers.timestamps.update({ (150, height): 5000 + height for height in range(150, 161) })
+    header_timestamps = HeaderTimestamps(headers)
+
+    assert header_timestamps.timestamps_for_heights([ 120, 10, 200, 201, -1 ]) == \
+        [ 1120, None, 1200, None, None ]
+    # The fork shares the headers of the base chain before it forks.
+    assert header_timestamps.timestamps_for_heights([ 149, 150, 160, 170 ], fork_chain) == \
+        [ 1149, 5150, 5160, None ]
+    assert header_timestamps.timestamp_at_height(150) == 1150
+
+    # Timestamps are only read from the headers once, except where they are missing.
+    reads = headers.reads
+    assert header_timestamps.timestamps_for_heights([ 120, 200, 149 ]) == [ 1120, 1200, 1149 ]
+    assert headers.reads == reads
+    headers.timestamps[(100, 10)] = 1010
+    assert header_timestamps.timestamp_at_height(10) == 1010
+    assert headers.reads == reads + 1
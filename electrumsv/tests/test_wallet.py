@@ -6,11 +6,13 @@ import shutil
 import sys
 import tempfile
 import threading
-from typing import Dict, Optional, List, Set
+from types import SimpleNamespace
+from typing import Dict, Optional, List, Set, Tuple
 import unittest
 
 import pytest
 
+from electrumsv.bitcoin import scripthash_bytes
 from electrumsv.constants import (DATABASE_EXT, DerivationType, KeystoreTextType, ScriptType,
     StorageKind, CHANGE_SUBPATH, RECEIVING_SUBPATH, KeyInstanceFlag)
 from electrumsv.crypto import pw_decode
@@ -258,6 +260,24 @@ def check_create_keys(wallet: Wallet, account_script_type: ScriptType) -> None:
         assert len(keyinstance_ids) == len(keyinstances)
         assert [] == account.get_existing_fresh_keys(RECEIVING_SUBPATH)
 
+    first_index = account.get_derivation_path(keyinstances[0].keyinstance_id)[-1]
+    derived_scripts = account.derive_scripts(RECEIVING_SUBPATH, first_index, len(keyinstances))
+    for keyinstance, derived_script in zip(keyinstances, derived_scripts):
+        key_id = keyinstance.keyinstance_id
+        assert derived_script.derivation_path == account.get_derivation_path(key_id)
+        assert derived_script.script == account.get_script_for_id(key_id)
+        assert derived_script.script_type == account_script_type
+        assert derived_script.scripthash == scripthash_bytes(derived_script.script)
+        assert (account_script_type, derived_script.script) in \
+            account.get_possible_scripts_for_id(key_id)
+
+    # The scripts subscribed to are derived in bulk for each range of keys, including those that
+    # are not contiguous, and are the same as those of the individual keys.
+    subscribed_key_ids = [ keyinstance.keyinstance_id for keyinstance in keyinstances ]
+    del subscribed_key_ids[2]
+    assert sorted(account.get_subscription_triples(subscribed_key_ids)) == \
+        sorted(AbstractAccount.get_subscription_triples(account, subscribed_key_ids))
+
     for count in (0, 1, 5):
         last_row = keyinstances[-1]
         last_index = account.get_derivation_path(last_row.keyinstance_id)[-1]
@@ -527,6 +547,67 @@ def test_detect_used_keys(mocker):
     assert account._keyinstances[3].flags == KeyInstanceFlag.USER_SET_ACTIVE
 
 
+
+def test_key_usage_accounts() -> None:
+    class MockKeyUsageAccount:
+        def __init__(self, account_id: int) -> None:
+            self._id = account_id
+            self.utxos: Set[Tuple[bytes, int]] = set()
+            self.tx_hashes: List[bytes] = []
+            self.thread_names: Set[str] = set()
+
+        def get_utxo(self, tx_hash: bytes, output_index: int) -> Optional[bool]:
+            return True if (tx_hash, output_index) in self.utxos else None
+
+        def process_key_usage_batch(self, entries) -> Set[bytes]:
+            self.thread_names.add(threading.current_thread().name)
+            self.tx_hashes.extend(entry[0] for entry in entries)
+            return set(entry[0] for entry in entries)
+
+        def process_key_usage(self, tx_hash: bytes, tx, relevant_txos) -> bool:
+            return len(self.process_key_usage_batch([ (tx_hash, tx, relevant_txos) ])) > 0
+
+    def make_tx(*prevouts: Tuple[bytes, int]) -> SimpleNamespace:
+        return SimpleNamespace(inputs=[ SimpleNamespace(prev_hash=prev_hash, prev_idx=prev_idx)
+            for prev_hash, prev_idx in prevouts ])
+
+    TX_HASH_1, TX_HASH_2, TX_HASH_3, TX_HASH_4 = (bytes([ i ]) * 32 for i in range(1, 5))
+    wallet = Wallet.__new__(Wallet)
+    wallet._transaction_accounts = {}
+    wallet._transaction_accounts_lock = threading.Lock()
+    wallet._key_usage_executor = None
+    accounts = { account_id: MockKeyUsageAccount(account_id) for account_id in (1, 2, 3) }
+    wallet._accounts = accounts
+
+    # The server history of a key in account 1 lists the first transaction.
+    wallet.update_transaction_accounts(1, [ TX_HASH_1 ], [])
+    assert wallet._process_key_usage(TX_HASH_1, make_tx()) == { 1 }
+    assert accounts[1].tx_hashes == [ TX_HASH_1 ]
+    assert accounts[2].tx_hashes == accounts[3].tx_hashes == []
+    assert wallet._key_usage_executor is None
+
+    # Account 2 is involved through the coin the second transaction spends.
+    accounts[2].utxos.add((b"\0" * 32, 0))
+    assert wallet._process_key_usage(TX_HASH_2, make_tx((b"\0" * 32, 0))) == { 2 }
+
+    # The batch follows the coins that earlier transactions in the batch create.
+    accounts[1].tx_hashes.clear()
+    wallet.update_transaction_accounts(3, [ TX_HASH_3 ], [])
+    involved = wallet._process_key_usage_batch([ (TX_HASH_1, make_tx()),
+        (TX_HASH_3, make_tx()), (TX_HASH_4, make_tx((TX_HASH_1, 0))) ])
+    assert involved == { TX_HASH_1: { 1 }, TX_HASH_3: { 3 }, TX_HASH_4: { 1 } }
+    assert accounts[1].tx_hashes == [ TX_HASH_1, TX_HASH_4 ]
+    assert accounts[3].tx_hashes == [ TX_HASH_3 ]
+    # More than one account involved means the work was done on the worker pool.
+    assert wallet._key_usage_executor is not None
+    assert all(name.startswith("key-usage") for name in accounts[3].thread_names)
+
+    wallet.update_transaction_accounts(1, [], [ TX_HASH_1 ])
+    assert wallet.get_transaction_account_ids(TX_HASH_1) == set()
+    assert TX_HASH_1 not in wallet._transaction_accounts
+    wallet._key_usage_executor.shutdown()
+
+
 # class TestImportedPrivkeyAccount:
 #     # TODO(rt12) REQUIRED add some unit tests for this account type. The following is obsolete.
 #     def test_pubkeys_to_a_ddress(self, tmp_storage, network):
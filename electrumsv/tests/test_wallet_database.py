@@ -1,5 +1,8 @@
+import asyncio
 import os
 import pytest
+import sys
+import threading
 from typing import Tuple, Optional
 
 import bitcoinx
@@ -241,6 +244,69 @@ class TestTransactionCache:
         assert TxFlags.HasByteData == entry.flags & TxFlags.HasByteData
         assert cache.have_transaction_data_cached(tx_hash)
 
+    @pytest.mark.timeout(5)
+    def test_lazy_load(self):
+        cache = TransactionCache(self.store)
+        tx = Transaction.from_hex(tx_hex_1)
+        tx_hash = tx.hash()
+        with SynchronousWriter() as writer:
+            cache.add_transaction(tx_hash, tx, completion_callback=writer.get_callback())
+            assert writer.succeeded()
+
+        cache = TransactionCache(self.store, lazy_load=True)
+        assert cache.wait_until_loaded(5)
+        assert cache.is_loaded()
+        assert cache.is_cached(tx_hash)
+        # The bytedata is not cached in advance, and is only obtained when it is needed.
+        assert not cache.have_transaction_data_cached(tx_hash)
+        assert cache.get_transaction(tx_hash).to_bytes() == tx.to_bytes()
+        assert cache.have_transaction_data_cached(tx_hash)
+
+    @pytest.mark.timeout(5)
+    def test_lazy_load_raw_cache(self):
+        cache = TransactionCache(self.store)
+        tx = Transaction.from_hex(tx_hex_1)
+        tx_hash = tx.hash()
+        with SynchronousWriter() as writer:
+            cache.add_transaction(tx_hash, tx, completion_callback=writer.get_callback())
+            assert writer.succeeded()
+
+        # A transaction that is read from the store is parsed, not returned as its bytedata.
+        cache = TransactionCache(self.store, txdata_cache_raw=True, lazy_load=True)
+        assert cache.wait_until_loaded(5)
+        assert not cache.have_transaction_data_cached(tx_hash)
+        tx_read = cache.get_transaction(tx_hash)
+        assert isinstance(tx_read, Transaction)
+        assert tx_read.to_bytes() == tx.to_bytes()
+        assert cache._txdata_cache.get(tx_hash) == tx.to_bytes()
+        tx_cached = cache.get_transaction(tx_hash)
+        assert isinstance(tx_cached, Transaction)
+        assert tx_cached.to_bytes() == tx.to_bytes()
+
+    def test_flag_clause_uses_index(self):
+        query = ("EXPLAIN QUERY PLAN SELECT tx_hash FROM Transactions WHERE "+
+            wallet_database.tables.flag_clause("flags", TxFlags.HasByteData,
+                TxFlags.HasByteData | TxFlags.StateSettled)[0])
+        plan = self.store._db.execute(query, [ TxFlags.HasByteData ]).fetchall()
+        assert "idx_Transactions_bytedata_settled" in plan[0][-1]
+
+    @pytest.mark.timeout(5)
+    def test_add_transaction_raw_cache(self):
+        cache = TransactionCache(self.store, txdata_cache_raw=True)
+
+        tx = Transaction.from_hex(tx_hex_1)
+        tx_hash = tx.hash()
+        with SynchronousWriter() as writer:
+            cache.add_transaction(tx_hash, tx, completion_callback=writer.get_callback())
+            assert writer.succeeded()
+
+        assert cache.have_transaction_data_cached(tx_hash)
+        assert cache._txdata_cache.get(tx_hash) == tx.to_bytes()
+        assert cache._txdata_cache.current_size == sys.getsizeof(tx.to_bytes())
+        tx_cached = cache.get_transaction(tx_hash)
+        assert tx_cached is not None
+        assert tx_cached.to_bytes() == tx.to_bytes()
+
     @pytest.mark.timeout(5)
     def test_add_transaction_update(self):
         cache = TransactionCache(self.store)
@@ -267,6 +333,41 @@ class TestTransactionCache:
         assert cache.have_transaction_data_cached(tx_hash)
         assert TxFlags.StateCleared == entry.flags & TxFlags.StateCleared
 
+    @pytest.mark.timeout(5)
+    def test_add_transactions(self):
+        cache = TransactionCache(self.store)
+
+        tx_1 = Transaction.from_hex(tx_hex_1)
+        tx_hash_1 = tx_1.hash()
+        tx_2 = Transaction.from_hex(tx_hex_2)
+        tx_hash_2 = tx_2.hash()
+
+        # The first transaction is known but lacks data, the second is not known at all.
+        data = [ tx_hash_1, TxData(height=1295924,position=4,fee=None, date_added=1,
+            date_updated=1), None, TxFlags.Unset, None ]
+        with SynchronousWriter() as writer:
+            cache.add([ data ], completion_callback=writer.get_callback())
+            assert writer.succeeded()
+
+        with SynchronousWriter() as writer:
+            cache.add_transactions([ (tx_hash_1, tx_1), (tx_hash_2, tx_2) ],
+                TxFlags.StateCleared, completion_callback=writer.get_callback())
+            assert writer.succeeded()
+
+        for tx_hash in (tx_hash_1, tx_hash_2):
+            entry = cache.get_entry(tx_hash)
+            assert entry is not None
+            assert cache.have_transaction_data_cached(tx_hash)
+            assert TxFlags.StateCleared | TxFlags.HasByteData == \
+                entry.flags & (TxFlags.StateCleared | TxFlags.HasByteData)
+        assert 1295924 == cache.get_height(tx_hash_1)
+
+        # Nothing to write still completes.
+        with SynchronousWriter() as writer:
+            cache.add_transactions([], TxFlags.StateCleared,
+                completion_callback=writer.get_callback())
+            assert writer.succeeded()
+
     @pytest.mark.timeout(5)
     def test_add_then_update(self):
         cache = TransactionCache(self.store)
@@ -599,6 +700,75 @@ class TestTransactionCache:
         results = cache.get_unverified_entries(11)
         assert 1 == len(results)
 
+    @pytest.mark.timeout(5)
+    def test_work_indexes(self) -> None:
+        cache = TransactionCache(self.store)
+
+        txs = [ Transaction.from_hex(tx_hex) for tx_hex in (tx_hex_1, tx_hex_2, tx_hex_3) ]
+        tx_hashes = [ tx.hash() for tx in txs ]
+        with SynchronousWriter() as writer:
+            cache.add([
+                    (tx_hashes[0], TxData(height=12), txs[0], TxFlags.StateSettled, None),
+                    (tx_hashes[1], TxData(height=11), txs[1], TxFlags.StateCleared, None),
+                    (tx_hashes[2], TxData(height=11), None, TxFlags.Unset, None),
+                ], completion_callback=writer.get_callback())
+            assert writer.succeeded()
+
+        # A freshly loaded cache indexes the entries the same way.
+        for cache in (TransactionCache(self.store), cache):
+            assert cache.get_unsynced_hashes() == [ tx_hashes[2] ]
+            assert [ t[0] for t in cache.get_unverified_entries(12) ] == \
+                [ tx_hashes[1], tx_hashes[0] ]
+            assert [ t[0] for t in cache.get_unverified_entries(11) ] == [ tx_hashes[1] ]
+
+        with SynchronousWriter() as writer:
+            cache.update([ (tx_hashes[2], TxData(), txs[2], TxFlags.HasByteData),
+                    (tx_hashes[1], TxData(position=3), None, TxFlags.HasPosition) ],
+                completion_callback=writer.get_callback())
+            assert writer.succeeded()
+        assert cache.get_unsynced_hashes() == []
+        assert [ t[0] for t in cache.get_unverified_entries(12) ] == \
+            [ tx_hashes[2], tx_hashes[0] ]
+
+        with SynchronousWriter() as writer:
+            cache.delete(tx_hashes[2], completion_callback=writer.get_callback())
+            assert writer.succeeded()
+        assert [ t[0] for t in cache.get_unverified_entries(12) ] == [ tx_hashes[0] ]
+
+        # A reorg unconfirms the transaction, which no longer needs a proof.
+        with SynchronousWriter() as writer:
+            cache.apply_reorg(11, completion_callback=writer.get_callback())
+            assert writer.succeeded()
+        assert cache.get_unverified_entries(12) == []
+
+    @pytest.mark.timeout(5)
+    def test_apply_reorg_height_index(self) -> None:
+        cache = TransactionCache(self.store)
+
+        txs = [ Transaction.from_hex(tx_hex) for tx_hex in (tx_hex_1, tx_hex_2, tx_hex_3) ]
+        heights = [ 7, 5, 9 ]
+        with SynchronousWriter() as writer:
+            cache.add([ (tx.hash(), TxData(height=height, position=1), tx, TxFlags.StateSettled,
+                None) for tx, height in zip(txs, heights) ],
+                completion_callback=writer.get_callback())
+            assert writer.succeeded()
+
+        # The heights are indexed in order regardless of the order the entries were loaded in.
+        cache = TransactionCache(self.store)
+        assert cache._get_settled_heights() == [ 5, 7, 9 ]
+
+        with SynchronousWriter() as writer:
+            reorg_count, tx_hashes = cache.apply_reorg(6,
+                completion_callback=writer.get_callback())
+            assert writer.succeeded()
+        assert reorg_count == 2
+        assert set(tx_hashes) == { txs[0].hash(), txs[2].hash() }
+        assert cache._get_settled_heights() == [ 5 ]
+        assert cache.get_flags(txs[0].hash()) & TxFlags.STATE_MASK == TxFlags.StateCleared
+
+        # Nothing is left above the fork to unverify.
+        assert cache.apply_reorg(6) == (0, [])
+
     @pytest.mark.timeout(5)
     def test_apply_reorg(self) -> None:
         common_height = 5
@@ -749,3 +919,144 @@ class TestSqliteWriteDispatcher:
 
         assert _write_callback_called
 
+
+    # As we use threading pytest can deadlock if something errors. This will break the deadlock
+    # and display stacktraces.
+    @pytest.mark.timeout(5)
+    def test_write_dispatcher_isolates_failure(self) -> None:
+        self.dispatcher = wallet_database.SqliteWriteDispatcher(self.db_context)
+        self.dispatcher._writer_loop_event.wait()
+        dispatcher = self.dispatcher
+        initial_limit = dispatcher.MINIMUM_BATCH_SIZE * 2
+        dispatcher._batch_size_limit = initial_limit
+
+        completion_results = {}
+        first_batch_done_event = threading.Event()
+        def _make_completion_callback(index: int):
+            def _completion_callback(exc_value: Optional[Exception]) -> None:
+                completion_results[index] = exc_value
+                if len(completion_results) == 10:
+                    first_batch_done_event.set()
+            return _completion_callback
+
+        def _make_write_callback(index: int):
+            def _write_callback(conn) -> None:
+                if index == 5:
+                    raise ValueError("bad write")
+            return _write_callback
+
+        def _put_batch(indexes: range) -> None:
+            # Hold up the writer thread until all the entries are queued, so that they are
+            # written as one batch.
+            started_event = threading.Event()
+            release_event = threading.Event()
+            def _blocking_write_callback(conn) -> None:
+                started_event.set()
+                release_event.wait()
+            dispatcher.put(WriteEntryType(_blocking_write_callback, None, 0))
+            started_event.wait()
+            for i in indexes:
+                dispatcher.put(WriteEntryType(_make_write_callback(i),
+                    _make_completion_callback(i), 0))
+            release_event.set()
+
+        _put_batch(range(10))
+        assert first_batch_done_event.wait(5)
+        # Failures do not shrink the batch size limit.
+        assert dispatcher._batch_size_limit == initial_limit
+        for i in range(10):
+            if i == 5:
+                assert isinstance(completion_results[i], ValueError)
+            else:
+                assert completion_results[i] is None
+
+        # Once the bad entry is isolated, writes go back to full-size batches.
+        _put_batch(range(10, 20))
+        dispatcher.stop()
+        assert len(completion_results) == 20
+        assert all(completion_results[i] is None for i in range(10, 20))
+
+        statistics = dispatcher.get_statistics()
+        assert statistics.queue_depth == 0
+        assert statistics.total_writes == 21
+        assert statistics.failed_writes == 1
+        assert statistics.last_batch_size == 10
+        assert statistics.batch_size_limit == initial_limit
+
+    def test_write_dispatcher_adapts_batch_size(self) -> None:
+        self.dispatcher = wallet_database.SqliteWriteDispatcher(self.db_context)
+        self.dispatcher._writer_loop_event.wait()
+        dispatcher = self.dispatcher
+        initial_limit = dispatcher._batch_size_limit
+
+        # A fast batch that filled the limit grows the limit.
+        dispatcher._record_batch(initial_limit, 0, 0, False)
+        assert dispatcher._batch_size_limit == initial_limit * 2
+        # A fast batch that did not fill the limit does not grow it.
+        dispatcher._record_batch(1, 0, 0, False)
+        assert dispatcher._batch_size_limit == initial_limit * 2
+        # A slow batch shrinks the limit.
+        dispatcher._record_batch(1, 0, dispatcher.BATCH_TIME_BUDGET_MS + 1, False)
+        assert dispatcher._batch_size_limit == initial_limit
+        # Retried batches do not affect the limit.
+        dispatcher._record_batch(initial_limit, 0, 0, True)
+        assert dispatcher._batch_size_limit == initial_limit
+
+        statistics = dispatcher.get_statistics()
+        assert statistics.total_batches == 4
+        assert statistics.last_commit_ms == 0
+
+
+class TestAsynchronousWrites:
+    @classmethod
+    def setup_class(cls):
+        unique_name = os.urandom(8).hex()
+        cls.db_filename = DatabaseContext.shared_memory_uri(unique_name)
+        cls.db_context = DatabaseContext(cls.db_filename)
+        # We hold onto an open connection to ensure that the database persists for the
+        # lifetime of the tests.
+        cls.db = cls.db_context.acquire_connection()
+        cls.db.execute("CREATE TABLE t (value INTEGER)")
+
+    @classmethod
+    def teardown_class(cls):
+        cls.db_context.release_connection(cls.db)
+        cls.db_context.close()
+
+    @pytest.mark.timeout(5)
+    def test_queue_write_async(self) -> None:
+        def _write(db) -> None:
+            db.execute("INSERT INTO t (value) VALUES (1)")
+
+        loop = asyncio.new_event_loop()
+        try:
+            loop.run_until_complete(self.db_context.queue_write_async(_write))
+        finally:
+            loop.close()
+
+        assert self.db.execute("SELECT COUNT(*) FROM t").fetchone()[0] == 1
+
+    @pytest.mark.timeout(5)
+    def test_queue_write_async_exception(self) -> None:
+        def _write(db) -> None:
+            raise ValueError("bad write")
+
+        loop = asyncio.new_event_loop()
+        try:
+            with pytest.raises(ValueError):
+                loop.run_until_complete(self.db_context.queue_write_async(_write))
+        finally:
+            loop.close()
+
+    @pytest.mark.timeout(5)
+    def test_asynchronous_writer(self) -> None:
+        async def _run() -> bool:
+            async with wallet_database.AsynchronousWriter() as writer:
+                self.db_context.queue_write(lambda db: None, writer.get_callback())
+                return await writer.succeeded()
+
+        loop = asyncio.new_event_loop()
+        try:
+            assert loop.run_until_complete(_run())
+        finally:
+            loop.close()
@@ -21,10 +21,11 @@ from electrumsv.wallet_database import (migration, KeyInstanceTable, MasterKeyTa
     PaymentRequestTable, TransactionTable, DatabaseContext, TransactionDeltaTable,
     TransactionOutputTable, SynchronousWriter, TxData, TxProof, AccountTable)
 from electrumsv.wallet_database.sqlite_support import LeakedSQLiteConnectionError
-from electrumsv.wallet_database.tables import (AccountRow, InvoiceAccountRow, InvoiceRow,
-    InvoiceTable, KeyInstanceRow, MAGIC_UNTOUCHED_BYTEDATA, MasterKeyRow, PaymentRequestRow,
-    TransactionDeltaRow, TransactionDeltaKeySummaryRow, TransactionRow, TransactionOutputRow,
-    WalletEventTable, WalletEventRow)
+from electrumsv.wallet_database.tables import (AccountRow, DataPackingError, InvoiceAccountRow,
+    InvoiceRow, InvoiceTable, KeyHistoryRow, KeyHistoryTable, KeyInstanceRow,
+    MAGIC_UNTOUCHED_BYTEDATA, MasterKeyRow, PaymentRequestRow, TransactionDeltaRow,
+    TransactionDeltaKeySummaryRow, TransactionRow, TransactionOutputRow, WalletEventTable,
+    WalletEventRow)
 
 
 logs.set_level("debug")
@@ -1003,6 +1004,80 @@ def test_table_transactionoutputs_crud(db_context: DatabaseContext) -> None:
     table.close()
 
 
+@pytest.mark.timeout(8)
+def test_table_transactionoutputs_create_key_usage(db_context: DatabaseContext) -> None:
+    table = TransactionOutputTable(db_context)
+    table._get_current_timestamp = lambda: 10
+
+    TX_BYTES = os.urandom(10)
+    TX_HASH = bitcoinx.double_sha256(TX_BYTES)
+    TX_INDEX = 1
+    TXOUT_FLAGS = 1 << 15
+    KEYINSTANCE_ID_1 = 1
+    KEYINSTANCE_ID_2 = 2
+    ACCOUNT_ID = 10
+    MASTERKEY_ID = 20
+
+    with TransactionTable(db_context) as transaction_table:
+        with SynchronousWriter() as writer:
+            transaction_table.create([ (TX_HASH, TxData(height=1, fee=2, position=None,
+                    date_added=1, date_updated=1), TX_BYTES,
+                    TxFlags.HasByteData|TxFlags.HasFee|TxFlags.HasHeight,
+                    None) ],
+                completion_callback=writer.get_callback())
+            assert writer.succeeded()
+
+    with MasterKeyTable(db_context) as masterkey_table:
+        with SynchronousWriter() as writer:
+            masterkey_table.create([ (MASTERKEY_ID, None, 2, b'111') ],
+                completion_callback=writer.get_callback())
+            assert writer.succeeded()
+
+    with AccountTable(db_context) as account_table:
+        with SynchronousWriter() as writer:
+            account_table.create([ (ACCOUNT_ID, MASTERKEY_ID, ScriptType.P2PKH, 'name') ],
+                completion_callback=writer.get_callback())
+            assert writer.succeeded()
+
+    with KeyInstanceTable(db_context) as keyinstance_table:
+        with SynchronousWriter() as writer:
+            keyinstance_table.create([
+                (KEYINSTANCE_ID_1, ACCOUNT_ID, MASTERKEY_ID, DerivationType.BIP32, b'111',
+                    ScriptType.P2PKH, True, None),
+                (KEYINSTANCE_ID_2, ACCOUNT_ID, MASTERKEY_ID, DerivationType.BIP32, b'222',
+                    ScriptType.P2PKH, True, None),
+                ], completion_callback=writer.get_callback())
+            assert writer.succeeded()
+
+    line1 = TransactionOutputRow(TX_HASH, TX_INDEX, 100, KEYINSTANCE_ID_1, TXOUT_FLAGS)
+    with SynchronousWriter() as writer:
+        table.create([ line1 ], completion_callback=writer.get_callback())
+        assert writer.succeeded()
+
+    # Create an output, spend another and apply the deltas all in the one write.
+    line3 = TransactionOutputRow(TX_HASH, TX_INDEX+2, 300, KEYINSTANCE_ID_2, TXOUT_FLAGS)
+    with SynchronousWriter() as writer:
+        table.create_key_usage([ line3 ],
+            [ (TransactionOutputFlag.IS_SPENT, line1.tx_hash, line1.tx_index) ],
+            [ TransactionDeltaRow(TX_HASH, KEYINSTANCE_ID_2, 300),
+              TransactionDeltaRow(TX_HASH, KEYINSTANCE_ID_1, -100) ],
+            completion_callback=writer.get_callback())
+        assert writer.succeeded()
+
+    db_lines = table.read()
+    assert 2 == len(db_lines)
+    db_line1 = [ db_line for db_line in db_lines if db_line[0:2] == line1[0:2] ][0]
+    assert db_line1.flags == TransactionOutputFlag.IS_SPENT
+    assert line3 in db_lines
+
+    with TransactionDeltaTable(db_context) as delta_table:
+        db_deltas = delta_table.read()
+    assert set(db_deltas) == { TransactionDeltaRow(TX_HASH, KEYINSTANCE_ID_2, 300),
+        TransactionDeltaRow(TX_HASH, KEYINSTANCE_ID_1, -100) }
+
+    table.close()
+
+
 @pytest.mark.timeout(8)
 def test_table_transactiondeltas_crud(db_context: DatabaseContext) -> None:
     table = TransactionDeltaTable(db_context)
@@ -1260,6 +1335,85 @@ def test_table_transactiondeltas_crud(db_context: DatabaseContext) -> None:
 
 
 @pytest.mark.timeout(8)
+def test_table_keyhistory_crud(db_context: DatabaseContext) -> None:
+    table = KeyHistoryTable(db_context)
+    assert [] == table.read()
+
+    table._get_current_timestamp = lambda: 10
+
+    KEYINSTANCE_ID = 0
+    ACCOUNT_ID = 10
+    MASTERKEY_ID = 20
+    TX_HASH1 = bitcoinx.double_sha256(b'1')
+    TX_HASH2 = bitcoinx.double_sha256(b'2')
+
+    line1 = KeyHistoryRow(KEYINSTANCE_ID+1, ACCOUNT_ID+1, [ (TX_HASH1, 100), (TX_HASH2, 0) ])
+    line2 = KeyHistoryRow(KEYINSTANCE_ID+2, ACCOUNT_ID+2, [ (TX_HASH2, -1) ])
+
+    # No effect: The key instance foreign key constraint will fail as the key does not exist.
+    with pytest.raises(sqlite3.IntegrityError):
+        with SynchronousWriter() as writer:
+            table.upsert([ line1 ], completion_callback=writer.get_callback())
+            assert not writer.succeeded()
+
+    # Satisfy the foreign key constraints by creating the masterkey, accounts and keys.
+    with MasterKeyTable(db_context) as mktable:
+        with SynchronousWriter() as writer:
+            mktable.create([ MasterKeyRow(MASTERKEY_ID+1, None, 2, b'111') ],
+                completion_callback=writer.get_callback())
+            assert writer.succeeded()
+
+    with AccountTable(db_context) as acctable:
+        with SynchronousWriter() as writer:
+            acctable.create([ AccountRow(ACCOUNT_ID+1, MASTERKEY_ID+1, ScriptType.P2PKH, 'name1'),
+                AccountRow(ACCOUNT_ID+2, MASTERKEY_ID+1, ScriptType.P2PKH, 'name2') ],
+                completion_callback=writer.get_callback())
+            assert writer.succeeded()
+
+    with KeyInstanceTable(db_context) as keyinstance_table:
+        with SynchronousWriter() as writer:
+            keyinstance_table.create([
+                KeyInstanceRow(KEYINSTANCE_ID+1, ACCOUNT_ID+1, MASTERKEY_ID+1,
+                    DerivationType.BIP32, b'111', ScriptType.P2PKH, True, None),
+                KeyInstanceRow(KEYINSTANCE_ID+2, ACCOUNT_ID+2, MASTERKEY_ID+1,
+                    DerivationType.BIP32, b'222', ScriptType.P2PKH, True, None) ],
+                completion_callback=writer.get_callback())
+            assert writer.succeeded()
+
+    with SynchronousWriter() as writer:
+        table.upsert([ line1, line2 ], completion_callback=writer.get_callback())
+        assert writer.succeeded()
+
+    # The history is returned in the order it was stored.
+    assert [ line1 ] == table.read(ACCOUNT_ID+1)
+    assert [ line2 ] == table.read(ACCOUNT_ID+2)
+    assert [ line1, line2 ] == sorted(table.read())
+
+    # Replacing the history of an existing key overwrites it.
+    line1_replaced = line1._replace(history=[ (TX_HASH1, 101) ])
+    with SynchronousWriter() as writer:
+        table.upsert([ line1_replaced ], completion_callback=writer.get_callback())
+        assert writer.succeeded()
+    assert [ line1_replaced ] == table.read(ACCOUNT_ID+1)
+
+    with SynchronousWriter() as writer:
+        table.delete([ KEYINSTANCE_ID+1 ], completion_callback=writer.get_callback())
+        assert writer.succeeded()
+    assert [] == table.read(ACCOUNT_ID+1)
+    assert [ line2 ] == table.read()
+
+    # Corrupt history data is detected rather than silently truncated.
+    with SynchronousWriter() as writer:
+        db_context.queue_write(lambda db: db.execute(
+            "UPDATE KeyHistory SET history=? WHERE keyinstance_id=?",
+            [ b'\x00' * 35, KEYINSTANCE_ID+2 ]), writer.get_callback())
+        assert writer.succeeded()
+    with pytest.raises(DataPackingError):
+        table.read()
+
+    table.close()
+
+
 def test_table_paymentrequests_crud(db_context: DatabaseContext) -> None:
     table = PaymentRequestTable(db_context)
     assert [] == table.read()
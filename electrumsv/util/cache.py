@@ -1,20 +1,55 @@
 import sys
 from threading import RLock
-from typing import Dict, List, Optional, Tuple
+from typing import Any, Dict, Generic, Hashable, List, Optional, Tuple, TypeVar
 
 from .misc import obj_size
 from ..transaction import Transaction
-from ..constants import MAXIMUM_TXDATA_CACHE_SIZE_MB, MINIMUM_TXDATA_CACHE_SIZE_MB
 
 
-class Node:
-    previous: 'Node'
-    next: 'Node'
-    key: bytes
-    value: Transaction
+# The approximate memory overhead of a parsed transaction beyond the bytes of its serialised form.
+# These were fitted against `obj_size` for transactions with varying numbers of inputs/outputs.
+TRANSACTION_OVERHEAD_SIZE = 420
+TRANSACTION_INPUT_OVERHEAD_SIZE = 300
+TRANSACTION_OUTPUT_OVERHEAD_SIZE = 160
 
-    def __init__(self, previous: Optional['Node']=None, next: Optional['Node']=None,
-            key: bytes=b'', value=None,  value_size: int=0) -> None:
+
+def estimate_transaction_size(tx: Transaction, bytedata_size: Optional[int]=None) -> int:
+    """
+    Estimate the memory footprint of a parsed transaction. This is much cheaper than `obj_size`
+    which walks every object within the transaction, and is exact enough for cache accounting.
+    If the length of the serialised transaction is known it should be provided.
+    """
+    if bytedata_size is None:
+        bytedata_size = 10 + sum(41 + len(txin.script_sig) for txin in tx.inputs) + \
+            sum(9 + len(txout.script_pubkey) for txout in tx.outputs)
+    return TRANSACTION_OVERHEAD_SIZE + bytedata_size + \
+        TRANSACTION_INPUT_OVERHEAD_SIZE * len(tx.inputs) + \
+        TRANSACTION_OUTPUT_OVERHEAD_SIZE * len(tx.outputs)
+
+
+def estimate_size(value: Any) -> int:
+    if value is None:
+        return 0
+    if isinstance(value, bytes):
+        return sys.getsizeof(value)
+    if isinstance(value, Transaction):
+        return estimate_transaction_size(value)
+    return obj_size(value)
+
+
+KT = TypeVar("KT", bound=Hashable)
+VT = TypeVar("VT")
+
+
+class Node(Generic[KT, VT]):
+    previous: 'Node[KT, VT]'
+    next: 'Node[KT, VT]'
+    key: KT
+    value: VT
+
+    def __init__(self, previous: Optional['Node[KT, VT]']=None,
+            next: Optional['Node[KT, VT]']=None, key: Any=b'', value: Any=None,
+            value_size: int=0) -> None:
         """
         The only node which can have an empty key or value is the root node. None of the added
         nodes will have empty links, keys or values.
@@ -28,16 +63,14 @@ class Node:
 
 # Derived from functools.lrucache, LRUCache should be considered licensed under Python license.
 # This intentionally does not have a dictionary interface for now.
-class LRUCache:
+class LRUCache(Generic[KT, VT]):
     def __init__(self, max_count: Optional[int]=None, max_size: Optional[int]=None) -> None:
-        self._cache: Dict[bytes, Node] = {}
+        self._cache: Dict[KT, Node[KT, VT]] = {}
 
         assert max_count is not None or max_size is not None, "need some limit"
         if max_size is None:
-            max_size = MAXIMUM_TXDATA_CACHE_SIZE_MB * (1024 * 1024)
-        assert MINIMUM_TXDATA_CACHE_SIZE_MB * (1024 * 1024) <= max_size <= \
-            MAXIMUM_TXDATA_CACHE_SIZE_MB * (1024 * 1024), \
-            f"maximum size {max_size} not within min/max constraints"
+            max_size = sys.maxsize
+        assert max_size >= 0, f"maximum size {max_size} is negative"
         self._max_size = max_size
         self._max_count: int = max_count if max_count is not None else sys.maxsize
         self.current_size = 0
@@ -45,7 +78,7 @@ class LRUCache:
         self.hits = self.misses = 0
         self._lock = RLock()
         # This will be a node in a bi-directional circular linked list with itself as sole entry.
-        self._root = Node()
+        self._root: Node[KT, VT] = Node()
 
     def set_maximum_size(self, maximum_size: int, resize: bool=True) -> None:
         self._max_size = maximum_size
@@ -56,7 +89,7 @@ class LRUCache:
     def get_sizes(self) -> Tuple[int, int]:
         return (self.current_size, self._max_size)
 
-    def _add(self, key: bytes, value: Transaction, size: int) -> Node:
+    def _add(self, key: KT, value: VT, size: int) -> Node[KT, VT]:
         most_recent_node = self._root.previous
         new_node = Node(most_recent_node, self._root, key, value, size)
         most_recent_node.next = self._root.previous = self._cache[key] = new_node
@@ -66,13 +99,17 @@ class LRUCache:
     def __len__(self) -> int:
         return len(self._cache)
 
-    def __contains__(self, key: bytes) -> bool:
+    def __contains__(self, key: KT) -> bool:
         return key in self._cache
 
-    def set(self, key: bytes, value: Optional[Transaction]) -> Tuple[bool, List[Tuple[
-            bytes, Transaction]]]:
+    def set(self, key: KT, value: Optional[VT], size: Optional[int]=None) \
+            -> Tuple[bool, List[Tuple[KT, VT]]]:
+        """
+        Add, replace or remove (if the value is `None`) the cached value for the given key. If
+        the caller knows the size of the value it can provide it, otherwise it is estimated.
+        """
         added = False
-        removals: List[Tuple[bytes, Transaction]] = []
+        removals: List[Tuple[KT, VT]] = []
         with self._lock:
             node = self._cache.get(key, None)
             if node is not None:
@@ -86,7 +123,8 @@ class LRUCache:
                 del self._cache[key]
                 removals.append((key, old_value))
 
-            size = obj_size(value)
+            if size is None:
+                size = estimate_size(value)
             if value is not None and size <= self._max_size:
                 added_node = self._add(key, value, size)
                 a, b, c, d = len(self._cache)-1, self._max_count, self.current_size, self._max_size
@@ -98,7 +136,7 @@ class LRUCache:
 
         return added, removals
 
-    def get(self, key: bytes) -> Optional[Transaction]:
+    def get(self, key: KT) -> Optional[VT]:
         with self._lock:
             node = self._cache.get(key)
             if node is not None:
@@ -114,8 +152,8 @@ class LRUCache:
             self.misses += 1
         return None
 
-    def _resize(self) -> List[Tuple[bytes, Transaction]]:
-        removals = []
+    def _resize(self) -> List[Tuple[KT, VT]]:
+        removals: List[Tuple[KT, VT]] = []
         # Discount the root node when considering count.
         while len(self._cache) > self._max_count or self.current_size > self._max_size:
             node = self._root.next
@@ -0,0 +1,69 @@
+"""
+The block timestamps of each chain by height, for the history, export and transaction views that
+only need the timestamp of a header. The timestamp is read straight out of the raw header in the
+memory-mapped headers file the first time it is needed, and from then on it is held in a compact
+array rather than deserialising the header each time.
+
+    timestamps = header_timestamps.timestamps_for_heights([ 1000, 0, 2000 ])
+"""
+
+from array import array
+from struct import Struct
+import threading
+from typing import Dict, Iterable, List, Optional
+
+from bitcoinx import Chain, Headers, MissingHeader
+
+
+# The timestamp is the little-endian uint32 following the version, previous hash and merkle root.
+struct_timestamp = Struct("<I")
+TIMESTAMP_OFFSET = 68
+
+
+class HeaderTimestamps:
+    def __init__(self, headers: Headers) -> None:
+        self._headers = headers
+        self._lock = threading.Lock()
+        # The timestamps of each chain from the height it forks from its parent, or from the
+        # genesis block for the base chain. Zero is a timestamp that has not been read yet.
+        # Headers only ever get added to a chain, so the entries that have been read never change.
+        self._tables: Dict[Chain, array] = {}
+
+    def timestamps_for_heights(self, heights: Iterable[int], chain: Optional[Chain]=None) \
+            -> List[Optional[int]]:
+        """
+        The timestamps of the headers at the given heights on the chain, or the longest chain
+        if none is given. The timestamp is `None` for any height that has no header, whether it
+        is not on the chain yet or is before the checkpoint and has not been backfilled.
+        """
+        if chain is None:
+            chain = self._headers.longest_chain()
+        with self._lock:
+            return [ self._get_timestamp(chain, height) for height in heights ]
+
+    def timestamp_at_height(self, height: int, chain: Optional[Chain]=None) -> Optional[int]:
+        return self.timestamps_for_heights([ height ], chain)[0]
+
+    def _get_timestamp(self, chain: Chain, height: int) -> Optional[int]:
+        if not 0 <= height <= chain.height:
+            return None
+        while chain.parent is not None and height < chain.first_height:
+            chain = chain.parent
+        first_height = 0 if chain.parent is None else chain.first_height
+
+        table = self._tables.get(chain)
+        if table is None:
+            table = self._tables[chain] = array('I')
+        index = height - first_height
+        if index >= len(table):
+            table.frombytes(bytes(table.itemsize * (index + 1 - len(table))))
+
+        timestamp = table[index]
+        if timestamp == 0:
+            try:
+                raw_header = self._headers.raw_header_at_height(chain, height)
+            except MissingHeader:
+                return None
+            timestamp = table[index] = struct_timestamp.unpack_from(raw_header,
+                TIMESTAMP_OFFSET)[0]
+        return timestamp
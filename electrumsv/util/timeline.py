@@ -0,0 +1,179 @@
+"""
+A record of how long each phase of startup takes, for tracking regressions in wallet open time.
+
+Phases are nested by the order in which they are entered on each thread. This is disabled unless
+the `--startup-timeline` command-line option is given, and when it is disabled entering a phase
+does nothing. When it is enabled, the timeline is written out as JSON each time an outermost
+phase ends.
+
+    with timeline.phase("keyinstances") as phase:
+        rows = table.read()
+        phase.set_count("rows", len(rows))
+"""
+
+import json
+import os
+import sys
+import threading
+import time
+import tracemalloc
+from types import TracebackType
+from typing import Any, Dict, List, Optional, Type
+
+try:
+    import resource
+except ImportError:
+    resource = None # type: ignore
+
+from ..logs import logs
+
+
+logger = logs.get_logger("timeline")
+
+TIMELINE_VERSION = 1
+
+
+class TimelinePhase:
+    def __init__(self, timeline: 'Timeline', name: str, parent: Optional['TimelinePhase']) \
+            -> None:
+        self._timeline = timeline
+        self.name = name
+        self.parent = parent
+        self.thread_name = threading.current_thread().name
+        self.start_time = 0.0
+        self.duration: Optional[float] = None
+        self.counts: Dict[str, int] = {}
+        self.peak_memory = 0
+        self.children: List['TimelinePhase'] = []
+
+    def set_count(self, name: str, value: int) -> None:
+        self.counts[name] = value
+
+    def __enter__(self) -> 'TimelinePhase':
+        self._timeline._enter_phase(self)
+        return self
+
+    def __exit__(self, exc_type: Optional[Type[BaseException]],
+            exc_value: Optional[BaseException], traceback: Optional[TracebackType]) -> None:
+        self._timeline._exit_phase(self, exc_type is not None)
+
+    def to_dict(self, origin: float) -> Dict[str, Any]:
+        return {
+            "name": self.name,
+            "thread": self.thread_name,
+            "start": round(self.start_time - origin, 6),
+            "duration": None if self.duration is None else round(self.duration, 6),
+            "counts": self.counts,
+            "peak_memory": self.peak_memory,
+            "children": [ child.to_dict(origin) for child in self.children ],
+        }
+
+
+class _DisabledPhase:
+    def set_count(self, name: str, value: int) -> None:
+        pass
+
+    def __enter__(self) -> '_DisabledPhase':
+        return self
+
+    def __exit__(self, exc_type: Optional[Type[BaseException]],
+            exc_value: Optional[BaseException], traceback: Optional[TracebackType]) -> None:
+        pass
+
+
+_disabled_phase = _DisabledPhase()
+
+
+class Timeline:
+    def __init__(self) -> None:
+        self._path: Optional[str] = None
+        self._origin = time.time()
+        self._lock = threading.Lock()
+        self._local = threading.local()
+        self._phases: List[TimelinePhase] = []
+
+    def is_enabled(self) -> bool:
+        return self._path is not None
+
+    def enable(self, path: str) -> None:
+        """
+        Start recording phases, and write the timeline to the given path. Peak memory is the
+        peak of Python memory allocations for the whole process, and tracing them slows down the
+        application.
+        """
+        self._path = os.path.abspath(path)
+        self._origin = time.time()
+        if not tracemalloc.is_tracing():
+            tracemalloc.start()
+        logger.debug("recording startup timeline to %s", self._path)
+
+    def phase(self, name: str) -> Any:
+        if self._path is None:
+            return _disabled_phase
+        stack = self._get_stack()
+        return TimelinePhase(self, name, stack[-1] if len(stack) else None)
+
+    def _get_stack(self) -> List[TimelinePhase]:
+        stack = getattr(self._local, "stack", None)
+        if stack is None:
+            stack = self._local.stack = []
+        return stack
+
+    def _enter_phase(self, phase: TimelinePhase) -> None:
+        stack = self._get_stack()
+        if phase.parent is not None:
+            # Resetting the peak for the new phase loses what the parent has seen up to now.
+            phase.parent.peak_memory = max(phase.parent.peak_memory,
+                tracemalloc.get_traced_memory()[1])
+        if hasattr(tracemalloc, "reset_peak"):
+            tracemalloc.reset_peak()
+        stack.append(phase)
+        with self._lock:
+            if phase.parent is None:
+                self._phases.append(phase)
+            else:
+                phase.parent.children.append(phase)
+        phase.start_time = time.time()
+
+    def _exit_phase(self, phase: TimelinePhase, failed: bool) -> None:
+        phase.duration = time.time() - phase.start_time
+        phase.peak_memory = max(phase.peak_memory, tracemalloc.get_traced_memory()[1])
+        if failed:
+            phase.counts["failed"] = 1
+        stack = self._get_stack()
+        assert stack[-1] is phase, f"phase {phase.name} exited out of order"
+        stack.pop()
+        if phase.parent is not None:
+            phase.parent.peak_memory = max(phase.parent.peak_memory, phase.peak_memory)
+        else:
+            self.write()
+
+    def to_dict(self) -> Dict[str, Any]:
+        with self._lock:
+            phases = [ phase.to_dict(self._origin) for phase in self._phases ]
+        max_rss: Optional[int] = None
+        if resource is not None:
+            # This is kilobytes on Linux, and bytes on MacOS.
+            max_rss = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+            if sys.platform != "darwin":
+                max_rss *= 1024
+        return {
+            "version": TIMELINE_VERSION,
+            "started": self._origin,
+            "python": sys.version.split()[0],
+            "platform": sys.platform,
+            "max_rss": max_rss,
+            "phases": phases,
+        }
+
+    def write(self) -> None:
+        if self._path is None:
+            return
+        try:
+            with open(self._path, "w") as f:
+                json.dump(self.to_dict(), f, indent=2)
+        except OSError:
+            logger.exception("unable to write startup timeline to %s", self._path)
+
+
+timeline = Timeline()
@@ -27,27 +27,31 @@
 #   - StandardAccount: one keystore, P2PKH
 #   - MultisigAccount: several keystores, P2SH
 
+from array import array
+import bisect
 from collections import defaultdict
+from concurrent.futures import Executor, ThreadPoolExecutor
 from datetime import datetime
 from functools import partial
 import itertools
 import json
 import os
 import random
+import sqlite3
 import threading
 import time
-from typing import (Any, cast, Dict, Iterable, List, NamedTuple, Optional, Sequence,
-    Set, Tuple, TypeVar, TYPE_CHECKING, Union)
+from typing import (Any, Callable, cast, Dict, Iterable, Iterator, List, Mapping, MutableMapping,
+    NamedTuple, Optional, Sequence, Set, Tuple, TypeVar, TYPE_CHECKING, Union)
 import weakref
 
 import aiorpcx
 import attr
 from bitcoinx import (Address, PrivateKey, PublicKey, hash_to_hex_str, hash160, hex_str_to_hash,
-    MissingHeader, Ops, P2MultiSig_Output, P2PK_Output, P2SH_Address, pack_byte, push_item, Script)
+    Ops, P2MultiSig_Output, P2PK_Output, P2SH_Address, pack_byte, push_item, Script)
 
 from . import coinchooser
 from .app_state import app_state
-from .bitcoin import compose_chain_string, COINBASE_MATURITY, ScriptTemplate
+from .bitcoin import compose_chain_string, COINBASE_MATURITY, scripthash_bytes, ScriptTemplate
 from .constants import (AccountType, CHANGE_SUBPATH, DEFAULT_TXDATA_CACHE_SIZE_MB, DerivationType,
     KeyInstanceFlag, KeystoreTextType, MAXIMUM_TXDATA_CACHE_SIZE_MB, MINIMUM_TXDATA_CACHE_SIZE_MB,
     RECEIVING_SUBPATH, ScriptType, TransactionOutputFlag, TxFlags, WalletEventFlag,
@@ -71,14 +75,17 @@ from .transaction import (Transaction, TransactionContext, TxSerialisationFormat
 from .types import TxoKeyType, WaitingUpdateCallback
 from .util import (format_satoshis, get_wallet_name_from_path, profiler, timestamp_to_datetime,
     TriggeredCallbacks)
+from .util.cache import LRUCache
+from .util.timeline import timeline
 from .wallet_database import TxData, TxProof, TransactionCacheEntry, TransactionCache
 from .wallet_database.tables import (AccountRow, AccountTable, InvoiceTable,
-    KeyInstanceRow, KeyInstanceTable, MasterKeyRow, MasterKeyTable, TransactionTable,
-    TransactionOutputTable, TransactionOutputRow, TransactionDeltaTable, TransactionDeltaRow,
+    KeyHistoryRow, KeyHistoryTable, KeyInstanceRow, KeyInstanceTable, MasterKeyRow,
+    MasterKeyTable, TransactionTable, TransactionOutputTable, TransactionOutputRow,
+    TransactionDeltaTable, TransactionDeltaHistoryRow, TransactionDeltaRow,
     TransactionDeltaSumRow, PaymentRequestTable, PaymentRequestRow, WalletEventRow,
     WalletEventTable)
-from .wallet_database.sqlite_support import CompletionCallbackType, DatabaseContext, \
-    SynchronousWriter
+from .wallet_database.sqlite_support import AsynchronousWriter, CompletionCallbackType, \
+    DatabaseContext, SynchronousWriter
 
 if TYPE_CHECKING:
     from .network import Network
@@ -87,6 +94,19 @@ if TYPE_CHECKING:
 
 logger = logs.get_logger("wallet")
 
+# Compare the incrementally maintained account balances against a full recalculation on every
+# read. This is for development use, as it makes reading the balance as slow as it used to be.
+DEBUG_BALANCE_AGGREGATES = False
+
+# How many lines of account history there are between running balance checkpoints.
+HISTORY_CHECKPOINT_INTERVAL = 256
+# How many key scripts an account keeps cached.
+SCRIPT_CACHE_COUNT = 10000
+# How many accounts can have their key usage for a transaction processed at the same time.
+KEY_USAGE_WORKER_COUNT = 4
+# How many seconds a history export waits for the headers of the exported lines to be fetched.
+EXPORT_HEADER_FETCH_TIMEOUT = 20.0
+
 
 @attr.s(auto_attribs=True)
 class DeterministicKeyAllocation:
@@ -102,6 +122,27 @@ class BIP32KeyData:
     script_pubkey: bytes
 
 
+@attr.s(auto_attribs=True, slots=True)
+class DerivedKeyScript:
+    derivation_path: Tuple[int, ...]
+    script_type: ScriptType
+    public_keys: List[PublicKey]
+    script_template: ScriptTemplate
+    script: Script
+    scripthash: bytes
+
+
+@attr.s(auto_attribs=True)
+class KeyUsageChanges:
+    """
+    The database changes resulting from processing key usage for one or more transactions,
+    collected so that they can be written together.
+    """
+    txo_rows: List[TransactionOutputRow] = attr.Factory(list)
+    txo_flag_updates: List[Tuple[TransactionOutputFlag, bytes, int]] = attr.Factory(list)
+    tx_deltas: Dict[Tuple[bytes, int], int] = attr.Factory(lambda: defaultdict(int))
+
+
 class HistoryLine(NamedTuple):
     sort_key: Tuple[int, int]
     tx_hash: bytes
@@ -153,41 +194,664 @@ class UTXO:
         )
 
 
+KeyHistoryEntryType = Tuple[bytes, int]
+
+
 class SyncState:
+    """
+    The server history for each key, and which keys each transaction is known to relate to.
+
+    Each key history is stored compactly as the concatenated transaction hashes and an array of
+    the matching heights, rather than as a list of tuples.
+    """
     def __init__(self) -> None:
-        self._key_history: Dict[int, List[Tuple[str, int]]] = {}
-        self._tx_keys: Dict[str, Set[int]] = {}
+        self._key_history: Dict[int, Tuple[bytes, array]] = {}
+        self._tx_keys: Dict[bytes, Set[int]] = {}
 
-    def get_key_history(self, key_id: int) -> List[Tuple[str, int]]:
-        return self._key_history.get(key_id, [])
+    def get_key_history(self, key_id: int) -> List[KeyHistoryEntryType]:
+        entry = self._key_history.get(key_id)
+        if entry is None:
+            return []
+        tx_hashes, heights = entry
+        return [ (tx_hashes[i*32:(i+1)*32], height) for i, height in enumerate(heights) ]
 
-    def set_key_history(self, key_id: int, history: List[Tuple[str, int]]) \
-            -> Tuple[Set[str], Set[str]]:
-        old_history = self._key_history.get(key_id, [])
-        self._key_history[key_id] = history
+    def get_key_tx_hashes(self, key_id: int) -> List[bytes]:
+        entry = self._key_history.get(key_id)
+        if entry is None:
+            return []
+        tx_hashes = entry[0]
+        return [ tx_hashes[i:i+32] for i in range(0, len(tx_hashes), 32) ]
+
+    def set_key_history(self, key_id: int, history: List[KeyHistoryEntryType]) \
+            -> Tuple[Set[bytes], Set[bytes]]:
+        old_tx_hashes = set(self.get_key_tx_hashes(key_id))
+        if len(history):
+            self._key_history[key_id] = (b"".join(t[0] for t in history),
+                array('i', (t[1] for t in history)))
+        else:
+            self._key_history.pop(key_id, None)
 
-        old_tx_ids = set(t[0] for t in old_history)
-        new_tx_ids = set(t[0] for t in history)
+        new_tx_hashes = set(t[0] for t in history)
 
-        removed_tx_ids = old_tx_ids - new_tx_ids
-        added_tx_ids = new_tx_ids - old_tx_ids
+        removed_tx_hashes = old_tx_hashes - new_tx_hashes
+        added_tx_hashes = new_tx_hashes - old_tx_hashes
 
-        for tx_id in removed_tx_ids:
-            self._tx_keys[tx_id].remove(key_id)
+        for tx_hash in removed_tx_hashes:
+            tx_keys = self._tx_keys[tx_hash]
+            tx_keys.remove(key_id)
+            if not tx_keys:
+                del self._tx_keys[tx_hash]
 
-        for tx_id in added_tx_ids:
-            if tx_id not in self._tx_keys:
-                self._tx_keys[tx_id] = set()
-            self._tx_keys[tx_id].add(key_id)
+        for tx_hash in added_tx_hashes:
+            if tx_hash not in self._tx_keys:
+                self._tx_keys[tx_hash] = set()
+            self._tx_keys[tx_hash].add(key_id)
 
-        return removed_tx_ids, added_tx_ids
+        return removed_tx_hashes, added_tx_hashes
 
-    def get_transaction_key_ids(self, tx_id: str) -> Set[int]:
-        tx_keys = self._tx_keys.get(tx_id)
+    def get_transaction_key_ids(self, tx_hash: bytes) -> Set[int]:
+        tx_keys = self._tx_keys.get(tx_hash)
         if tx_keys is None:
             return set()
         return tx_keys
 
+    def get_transaction_hashes(self) -> List[bytes]:
+        return list(self._tx_keys)
+
+
+@attr.s(auto_attribs=True, slots=True)
+class _UTXOIndexEntry:
+    height: int
+    is_coinbase: bool
+    # Indexed by frozen state.
+    values: List[int]
+    coin_keys: Tuple[Set[TxoKeyType], Set[TxoKeyType]]
+
+
+class UTXOIndex:
+    """
+    The unspent coins of an account, bucketed by what affects whether they can be spent and with
+    running totals of their values. Neither the balance nor the spendable coins need every coin
+    to be visited to be read.
+
+    Coins are grouped by transaction, as all of the coins in a transaction share its height and
+    any change in height can be applied to the group in one step. Non-coinbase transactions are
+    bucketed by whether they are confirmed, and within each group frozen coins are kept apart.
+    Coinbase coins mature as the chain grows, so their transactions are instead classified
+    against the local height when read. There are few enough of them that this is not a concern.
+    """
+    def __init__(self) -> None:
+        self.clear()
+
+    def clear(self) -> None:
+        # Indexed by [frozen][confirmed].
+        self._totals: List[List[int]] = [ [ 0, 0 ], [ 0, 0 ] ]
+        self._entries: Dict[bytes, _UTXOIndexEntry] = {}
+        # Indexed by confirmed state.
+        self._tx_hashes: Tuple[Set[bytes], Set[bytes]] = (set(), set())
+        self._coinbase_tx_hashes: Set[bytes] = set()
+        self._key_coin_keys: Dict[int, Set[TxoKeyType]] = {}
+
+    def add_coin(self, utxo_key: TxoKeyType, keyinstance_id: int, height: int,
+            is_coinbase: bool, value: int, frozen: bool) -> None:
+        entry = self._entries.get(utxo_key.tx_hash)
+        if entry is None:
+            entry = self._entries[utxo_key.tx_hash] = _UTXOIndexEntry(height, is_coinbase,
+                [ 0, 0 ], (set(), set()))
+            if is_coinbase:
+                self._coinbase_tx_hashes.add(utxo_key.tx_hash)
+            else:
+                self._tx_hashes[height > 0].add(utxo_key.tx_hash)
+        entry.values[frozen] += value
+        entry.coin_keys[frozen].add(utxo_key)
+        if not entry.is_coinbase:
+            self._totals[frozen][entry.height > 0] += value
+
+        key_coin_keys = self._key_coin_keys.get(keyinstance_id)
+        if key_coin_keys is None:
+            key_coin_keys = self._key_coin_keys[keyinstance_id] = set()
+        key_coin_keys.add(utxo_key)
+
+    def remove_coin(self, utxo_key: TxoKeyType, keyinstance_id: int, value: int,
+            frozen: bool) -> None:
+        entry = self._entries[utxo_key.tx_hash]
+        entry.values[frozen] -= value
+        entry.coin_keys[frozen].remove(utxo_key)
+        if not entry.is_coinbase:
+            self._totals[frozen][entry.height > 0] -= value
+        if not entry.coin_keys[0] and not entry.coin_keys[1]:
+            del self._entries[utxo_key.tx_hash]
+            if entry.is_coinbase:
+                self._coinbase_tx_hashes.remove(utxo_key.tx_hash)
+            else:
+                self._tx_hashes[entry.height > 0].remove(utxo_key.tx_hash)
+
+        key_coin_keys = self._key_coin_keys[keyinstance_id]
+        key_coin_keys.remove(utxo_key)
+        if not key_coin_keys:
+            del self._key_coin_keys[keyinstance_id]
+
+    def set_coin_frozen(self, utxo_key: TxoKeyType, value: int, frozen: bool) -> None:
+        entry = self._entries[utxo_key.tx_hash]
+        entry.coin_keys[not frozen].remove(utxo_key)
+        entry.coin_keys[frozen].add(utxo_key)
+        entry.values[not frozen] -= value
+        entry.values[frozen] += value
+        if not entry.is_coinbase:
+            confirmed = entry.height > 0
+            self._totals[not frozen][confirmed] -= value
+            self._totals[frozen][confirmed] += value
+
+    def has_transaction(self, tx_hash: bytes) -> bool:
+        return tx_hash in self._entries
+
+    def set_height(self, tx_hash: bytes, height: int) -> None:
+        entry = self._entries.get(tx_hash)
+        if entry is None:
+            return
+        was_confirmed = entry.height > 0
+        entry.height = height
+        if entry.is_coinbase or was_confirmed == (height > 0):
+            return
+        self._tx_hashes[was_confirmed].remove(tx_hash)
+        self._tx_hashes[not was_confirmed].add(tx_hash)
+        for frozen in (False, True):
+            value = entry.values[frozen]
+            self._totals[frozen][was_confirmed] -= value
+            self._totals[frozen][not was_confirmed] += value
+
+    def get_balance(self, local_height: int, frozen: Optional[bool]=None) \
+            -> Tuple[int, int, int]:
+        """
+        Get the confirmed, unconfirmed and immature totals. These are for all coins if `frozen`
+        is `None`, otherwise only for the coins that do or do not have the given frozen state.
+        """
+        if frozen is None:
+            c = self._totals[0][1] + self._totals[1][1]
+            u = self._totals[0][0] + self._totals[1][0]
+        else:
+            c = self._totals[frozen][1]
+            u = self._totals[frozen][0]
+        x = 0
+        for tx_hash in self._coinbase_tx_hashes:
+            entry = self._entries[tx_hash]
+            value = sum(entry.values) if frozen is None else entry.values[frozen]
+            if entry.height + COINBASE_MATURITY > local_height:
+                x += value
+            elif entry.height > 0:
+                c += value
+            else:
+                u += value
+        return c, u, x
+
+    def get_coin_keys(self, local_height: int, exclude_frozen: bool=False, mature: bool=False,
+            confirmed_only: bool=False, key_ids: Optional[Iterable[int]]=None) \
+            -> List[TxoKeyType]:
+        """
+        Get the keys of the coins that match the given spendability criteria, optionally only
+        for the given keys.
+        """
+        # A coin is spendable at height + COINBASE_MATURITY.
+        mempool_height = local_height + 1
+        def is_included(entry: _UTXOIndexEntry) -> bool:
+            if confirmed_only and entry.height <= 0:
+                return False
+            if mature and entry.is_coinbase and \
+                    mempool_height < entry.height + COINBASE_MATURITY:
+                return False
+            return True
+
+        coin_keys: List[TxoKeyType] = []
+        if key_ids is not None:
+            for key_id in key_ids:
+                for utxo_key in self._key_coin_keys.get(key_id, ()):
+                    entry = self._entries[utxo_key.tx_hash]
+                    if exclude_frozen and utxo_key in entry.coin_keys[1]:
+                        continue
+                    if is_included(entry):
+                        coin_keys.append(utxo_key)
+            return coin_keys
+
+        tx_hashes: Iterable[bytes] = self._coinbase_tx_hashes
+        if confirmed_only:
+            tx_hashes = itertools.chain(tx_hashes, self._tx_hashes[1])
+        else:
+            tx_hashes = itertools.chain(tx_hashes, *self._tx_hashes)
+        for tx_hash in tx_hashes:
+            entry = self._entries[tx_hash]
+            if is_included(entry):
+                coin_keys.extend(entry.coin_keys[0])
+                if not exclude_frozen:
+                    coin_keys.extend(entry.coin_keys[1])
+        return coin_keys
+
+    def get_key_coin_keys(self, key_ids: Iterable[int]) -> List[TxoKeyType]:
+        coin_keys: List[TxoKeyType] = []
+        for key_id in key_ids:
+            coin_keys.extend(self._key_coin_keys.get(key_id, ()))
+        return coin_keys
+
+
+HistorySortKey = Tuple[int, int]
+HistoryIndexUpdate = Callable[['HistoryIndex'], None]
+
+# Lines that are not mined are ordered after all the mined lines.
+UNMINED_SORT_HEIGHT = 1_000_000_000
+
+
+@attr.s(auto_attribs=True, slots=True)
+class _HistoryIndexEntry:
+    sort_key: Optional[HistorySortKey]
+    height: Optional[int]
+    value_delta: int
+
+
+class HistoryIndex:
+    """
+    The transaction history of an account, kept in order of when the transactions were mined with
+    the running balance checkpointed every `checkpoint_interval` lines. A page of history and its
+    running balances can be read in time proportional to the page and the interval, rather than
+    to the whole history. Lines are moved in place as transactions are added, confirmed or
+    reorged, and only the checkpoints after the earliest moved line need to be recalculated.
+
+    Transactions without a height (signed but not cleared) have their value tracked, but are not
+    included in the history until they are given one.
+    """
+    def __init__(self, checkpoint_interval: int=HISTORY_CHECKPOINT_INTERVAL) -> None:
+        self._checkpoint_interval = checkpoint_interval
+        # The ordered history, as [ (sort key, tx hash), ... ].
+        self._order: List[Tuple[HistorySortKey, bytes]] = []
+        self._entries: Dict[bytes, _HistoryIndexEntry] = {}
+        # The running balance at the end of each complete interval of lines.
+        self._checkpoints: List[int] = []
+
+    def __len__(self) -> int:
+        return len(self._order)
+
+    @staticmethod
+    def get_sort_key(metadata: TxData) -> Optional[HistorySortKey]:
+        height, position = metadata.height, metadata.position
+        if height is None:
+            return None
+        if position is not None:
+            return height, position
+        date_added = cast(int, metadata.date_added)
+        if height > 0:
+            return height, date_added
+        return UNMINED_SORT_HEIGHT, date_added
+
+    def has_transaction(self, tx_hash: bytes) -> bool:
+        return tx_hash in self._entries
+
+    def update(self, tx_hash: bytes, metadata: Optional[TxData], value_delta: int=0) -> None:
+        """
+        Add the value delta to the given transaction and move it to the place in the history
+        that matches the given metadata.
+        """
+        entry = self._entries.get(tx_hash)
+        if entry is None:
+            entry = self._entries[tx_hash] = _HistoryIndexEntry(None, None, 0)
+        sort_key = None if metadata is None else self.get_sort_key(metadata)
+        if sort_key != entry.sort_key:
+            self._remove_line(tx_hash, entry)
+            entry.sort_key = sort_key
+            if sort_key is not None:
+                index = bisect.bisect_left(self._order, (sort_key, tx_hash))
+                self._order.insert(index, (sort_key, tx_hash))
+                self._invalidate_checkpoints(index)
+        elif value_delta != 0 and sort_key is not None:
+            self._invalidate_checkpoints(bisect.bisect_left(self._order, (sort_key, tx_hash)))
+        if metadata is not None:
+            entry.height = metadata.height
+        entry.value_delta += value_delta
+
+    def remove(self, tx_hash: bytes) -> None:
+        entry = self._entries.pop(tx_hash, None)
+        if entry is not None:
+            self._remove_line(tx_hash, entry)
+
+    def _remove_line(self, tx_hash: bytes, entry: _HistoryIndexEntry) -> None:
+        if entry.sort_key is not None:
+            index = bisect.bisect_left(self._order, (entry.sort_key, tx_hash))
+            del self._order[index]
+            self._invalidate_checkpoints(index)
+
+    def _invalidate_checkpoints(self, index: int) -> None:
+        del self._checkpoints[index // self._checkpoint_interval:]
+
+    def _get_balance_before(self, index: int) -> int:
+        interval = self._checkpoint_interval
+        checkpoint_count = index // interval
+        while len(self._checkpoints) < checkpoint_count:
+            start = len(self._checkpoints) * interval
+            balance = self._checkpoints[-1] if self._checkpoints else 0
+            balance += sum(self._entries[tx_hash].value_delta
+                for _sort_key, tx_hash in self._order[start:start+interval])
+            self._checkpoints.append(balance)
+        balance = self._checkpoints[checkpoint_count-1] if checkpoint_count else 0
+        return balance + sum(self._entries[tx_hash].value_delta
+            for _sort_key, tx_hash in self._order[checkpoint_count*interval:index])
+
+    def get_lines(self, start: int, end: int) -> List[Tuple[bytes, int, int, int]]:
+        """
+        Get the lines from `start` up to but not including `end`, in ascending order, as
+        `(tx_hash, height, value_delta, balance)`.
+        """
+        start = max(start, 0)
+        end = min(end, len(self._order))
+        lines: List[Tuple[bytes, int, int, int]] = []
+        if start >= end:
+            return lines
+        balance = self._get_balance_before(start)
+        for _sort_key, tx_hash in self._order[start:end]:
+            entry = self._entries[tx_hash]
+            balance += entry.value_delta
+            lines.append((tx_hash, cast(int, entry.height), entry.value_delta, balance))
+        return lines
+
+    def get_height(self, index: int) -> int:
+        return cast(int, self._entries[self._order[index][1]].height)
+
+    def get_tx_hashes(self) -> List[bytes]:
+        return [ tx_hash for _sort_key, tx_hash in self._order ]
+
+    def find_height(self, height: int) -> int:
+        """
+        The index of the first line mined at or above the given height. Lines that are not mined
+        are ordered after all mined lines.
+        """
+        return bisect.bisect_left(self._order, ((height,), b""))
+
+
+class KeyInstanceStore(MutableMapping[int, KeyInstanceRow]):
+    """
+    The key instances loaded by an account, held in parallel arrays of column values rather than
+    as a dictionary of row tuples. An account can have hundreds of thousands of keys, and the
+    overhead of a tuple, a derivation data bytes object and a dictionary entry for each of them
+    is several times the size of the data they hold. Rows are created when they are looked up.
+
+    The columns are ordered by key id. A removed key leaves a dead slot behind, which is reused
+    if the key is added again, and the columns are compacted once enough slots are dead. The
+    derivation path of each key can also be stored alongside it, see `KeyPathMapping`.
+    """
+
+    def __init__(self, rows: Iterable[KeyInstanceRow]=()) -> None:
+        self._lock = threading.RLock()
+        self._reset()
+        self.paths = KeyPathMapping(self)
+        for row in sorted(rows, key=lambda row: row.keyinstance_id):
+            self[row.keyinstance_id] = row
+
+    def _reset(self) -> None:
+        self._ids = array('q')
+        self._live = bytearray()
+        self._live_count = 0
+        self._account_ids = array('q')
+        # `None` is stored as -1.
+        self._masterkey_ids = array('q')
+        self._derivation_types = array('B')
+        self._script_types = array('B')
+        self._flags = array('Q')
+        # The derivation data of all keys is packed into one buffer.
+        self._data = bytearray()
+        self._data_offsets = array('Q')
+        self._data_lengths = array('I')
+        self._data_unused = 0
+        # The derivation path of all keys is packed into one array, a length of -1 is no path.
+        self._path_data = array('I')
+        self._path_offsets = array('Q')
+        self._path_lengths = array('i')
+        self._path_unused = 0
+        self._path_count = 0
+        # The ids of the keys with a path, in key id order, by the parent of that path.
+        self._path_children: Dict[Tuple[int, ...], array] = {}
+        # Most keys do not have descriptions.
+        self._descriptions: Dict[int, str] = {}
+
+    def _find(self, key_id: int) -> int:
+        index = bisect.bisect_left(self._ids, key_id)
+        if index < len(self._ids) and self._ids[index] == key_id and self._live[index]:
+            return index
+        return -1
+
+    def _get_row(self, index: int) -> KeyInstanceRow:
+        key_id = self._ids[index]
+        masterkey_id = self._masterkey_ids[index]
+        data_offset = self._data_offsets[index]
+        return KeyInstanceRow(key_id, self._account_ids[index],
+            None if masterkey_id == -1 else masterkey_id,
+            DerivationType(self._derivation_types[index]),
+            bytes(self._data[data_offset:data_offset + self._data_lengths[index]]),
+            ScriptType(self._script_types[index]), KeyInstanceFlag(self._flags[index]),
+            self._descriptions.get(key_id))
+
+    def __len__(self) -> int:
+        return self._live_count
+
+    def __contains__(self, key_id: object) -> bool:
+        with self._lock:
+            return isinstance(key_id, int) and self._find(key_id) != -1
+
+    def __iter__(self) -> Iterator[int]:
+        # Like iterating over a copy of the keys, this does not see later changes.
+        with self._lock:
+            key_ids = [ key_id for key_id, live in zip(self._ids, self._live) if live ]
+        return iter(key_ids)
+
+    def __getitem__(self, key_id: int) -> KeyInstanceRow:
+        with self._lock:
+            index = self._find(key_id)
+            if index == -1:
+                raise KeyError(key_id)
+            return self._get_row(index)
+
+    def __setitem__(self, key_id: int, row: KeyInstanceRow) -> None:
+        assert row.keyinstance_id == key_id, f"key id mismatch {key_id} != {row.keyinstance_id}"
+        with self._lock:
+            index = bisect.bisect_left(self._ids, key_id)
+            if index == len(self._ids) or self._ids[index] != key_id:
+                self._ids.insert(index, key_id)
+                self._live.insert(index, 1)
+                self._live_count += 1
+                self._account_ids.insert(index, 0)
+                self._masterkey_ids.insert(index, -1)
+                self._derivation_types.insert(index, 0)
+                self._script_types.insert(index, 0)
+                self._flags.insert(index, 0)
+                self._data_offsets.insert(index, len(self._data))
+                self._data_lengths.insert(index, 0)
+                self._path_offsets.insert(index, 0)
+                self._path_lengths.insert(index, -1)
+            elif not self._live[index]:
+                self._live[index] = 1
+                self._live_count += 1
+
+            self._account_ids[index] = row.account_id
+            self._masterkey_ids[index] = -1 if row.masterkey_id is None else row.masterkey_id
+            self._derivation_types[index] = row.derivation_type
+            self._script_types[index] = row.script_type
+            self._flags[index] = row.flags
+
+            data = row.derivation_data
+            data_length = self._data_lengths[index]
+            if len(data) == data_length:
+                data_offset = self._data_offsets[index]
+                self._data[data_offset:data_offset + data_length] = data
+            else:
+                self._data_unused += data_length
+                self._data_offsets[index] = len(self._data)
+                self._data_lengths[index] = len(data)
+                self._data.extend(data)
+
+            if row.description is None:
+                self._descriptions.pop(key_id, None)
+            else:
+                self._descriptions[key_id] = row.description
+
+    def __delitem__(self, key_id: int) -> None:
+        with self._lock:
+            index = self._find(key_id)
+            if index == -1:
+                raise KeyError(key_id)
+            self._live[index] = 0
+            self._live_count -= 1
+            self._data_unused += self._data_lengths[index]
+            self._data_lengths[index] = 0
+            self._descriptions.pop(key_id, None)
+            self._clear_path(index)
+            if len(self._ids) - self._live_count > max(1024, self._live_count):
+                self._compact()
+
+    def clear(self) -> None:
+        with self._lock:
+            self._reset()
+
+    def get_script_type(self, key_id: int) -> ScriptType:
+        with self._lock:
+            index = self._find(key_id)
+            if index == -1:
+                raise KeyError(key_id)
+            return ScriptType(self._script_types[index])
+
+    def get_flags(self, key_id: int) -> KeyInstanceFlag:
+        with self._lock:
+            index = self._find(key_id)
+            if index == -1:
+                raise KeyError(key_id)
+            return KeyInstanceFlag(self._flags[index])
+
+    def _get_path(self, key_id: int) -> Optional[Tuple[int, ...]]:
+        with self._lock:
+            index = self._find(key_id)
+            if index == -1 or self._path_lengths[index] == -1:
+                return None
+            path_offset = self._path_offsets[index]
+            return tuple(self._path_data[path_offset:path_offset + self._path_lengths[index]])
+
+    def _set_path(self, key_id: int, path: Sequence[int]) -> None:
+        with self._lock:
+            index = self._find(key_id)
+            if index == -1:
+                raise KeyError(key_id)
+            path_length = self._path_lengths[index]
+            if path_length == -1:
+                self._path_count += 1
+            else:
+                self._remove_path_child(index)
+            self._add_path_child(key_id, path)
+            if len(path) == path_length:
+                path_offset = self._path_offsets[index]
+                self._path_data[path_offset:path_offset + path_length] = array('I', path)
+            else:
+                self._path_unused += max(path_length, 0)
+                self._path_offsets[index] = len(self._path_data)
+                self._path_lengths[index] = len(path)
+                self._path_data.extend(path)
+
+    def _clear_path(self, index: int) -> bool:
+        path_length = self._path_lengths[index]
+        if path_length == -1:
+            return False
+        self._remove_path_child(index)
+        self._path_unused += path_length
+        self._path_lengths[index] = -1
+        self._path_count -= 1
+        return True
+
+    def _add_path_child(self, key_id: int, path: Sequence[int]) -> None:
+        if path:
+            bisect.insort(self._path_children.setdefault(tuple(path[:-1]), array('q')), key_id)
+
+    def _remove_path_child(self, index: int) -> None:
+        path_length = self._path_lengths[index]
+        if path_length <= 0:
+            return
+        path_offset = self._path_offsets[index]
+        parent_path = tuple(self._path_data[path_offset:path_offset + path_length - 1])
+        children = self._path_children[parent_path]
+        del children[bisect.bisect_left(children, self._ids[index])]
+        if not children:
+            del self._path_children[parent_path]
+
+    def _get_path_key_ids(self) -> List[int]:
+        with self._lock:
+            return [ key_id for key_id, path_length in zip(self._ids, self._path_lengths)
+                if path_length != -1 ]
+
+    def _get_child_key_ids(self, parent_path: Sequence[int]) -> List[int]:
+        with self._lock:
+            return list(self._path_children.get(tuple(parent_path), ()))
+
+    def _compact(self) -> None:
+        indexes = [ index for index, live in enumerate(self._live) if live ]
+        data, data_offsets, data_lengths = bytearray(), array('Q'), array('I')
+        for index in indexes:
+            data_offset = self._data_offsets[index]
+            data_offsets.append(len(data))
+            data_lengths.append(self._data_lengths[index])
+            data.extend(self._data[data_offset:data_offset + self._data_lengths[index]])
+        path_data, path_offsets = array('I'), array('Q')
+        for index in indexes:
+            path_offset = self._path_offsets[index]
+            path_offsets.append(len(path_data))
+            path_data.extend(self._path_data[path_offset:
+                path_offset + max(self._path_lengths[index], 0)])
+
+        self._ids = array('q', (self._ids[index] for index in indexes))
+        self._live = bytearray([ 1 ]) * len(indexes)
+        self._account_ids = array('q', (self._account_ids[index] for index in indexes))
+        self._masterkey_ids = array('q', (self._masterkey_ids[index] for index in indexes))
+        self._derivation_types = array('B',
+            (self._derivation_types[index] for index in indexes))
+        self._script_types = array('B', (self._script_types[index] for index in indexes))
+        self._flags = array('Q', (self._flags[index] for index in indexes))
+        self._data, self._data_offsets, self._data_lengths = data, data_offsets, data_lengths
+        self._data_unused = 0
+        self._path_data, self._path_offsets = path_data, path_offsets
+        self._path_lengths = array('i', (self._path_lengths[index] for index in indexes))
+        self._path_unused = 0
+
+
+class KeyPathMapping(MutableMapping[int, Tuple[int, ...]]):
+    """
+    The derivation paths of the keys in a `KeyInstanceStore`, by key id. A key must be in the
+    store before it can be given a path, and removing it from the store removes its path.
+    """
+
+    def __init__(self, store: KeyInstanceStore) -> None:
+        self._store = weakref.proxy(store)
+
+    def __len__(self) -> int:
+        return self._store._path_count
+
+    def __contains__(self, key_id: object) -> bool:
+        return isinstance(key_id, int) and self._store._get_path(key_id) is not None
+
+    def __iter__(self) -> Iterator[int]:
+        return iter(self._store._get_path_key_ids())
+
+    def __getitem__(self, key_id: int) -> Tuple[int, ...]:
+        path = self._store._get_path(key_id)
+        if path is None:
+            raise KeyError(key_id)
+        return path
+
+    def __setitem__(self, key_id: int, path: Sequence[int]) -> None:
+        self._store._set_path(key_id, path)
+
+    def __delitem__(self, key_id: int) -> None:
+        store = self._store
+        with store._lock:
+            index = store._find(key_id)
+            if index == -1 or not store._clear_path(index):
+                raise KeyError(key_id)
+
+    def get_child_key_ids(self, parent_path: Sequence[int]) -> List[int]:
+        """
+        The ids of the keys directly derived from the given path, in key id order.
+        """
+        return self._store._get_child_key_ids(parent_path)
+
 
 def dust_threshold(network):
     return 546 # hard-coded Bitcoin SV dust threshold. Was changed to this as of Sept. 2018
@@ -195,6 +859,7 @@ def dust_threshold(network):
 CachedScriptType = Tuple[Script, bytes, Optional[ScriptTemplate]]
 
 T = TypeVar('T', bound='AbstractAccount')
+R = TypeVar('R')
 
 class AbstractAccount:
     """
@@ -217,7 +882,15 @@ class AbstractAccount:
         self._logger = logs.get_logger("account[{}]".format(self.name()))
         self._network = None
 
-        self._script_cache: Dict[Tuple[int, ScriptType], CachedScriptType] = {}
+        # The scripts are only needed while keys are in use, and are cheap to recreate.
+        self._script_cache: LRUCache[Tuple[int, ScriptType], CachedScriptType] = \
+            LRUCache(max_count=SCRIPT_CACHE_COUNT)
+        # The spending transaction for outpoints that may be coins of this account, spent by
+        # processed transactions, and the transactions whose inputs have been indexed in this
+        # way. These are derived from the persisted transactions and key histories, and are
+        # rebuilt lazily for each key as it is needed.
+        self._txo_spenders: Dict[TxoKeyType, bytes] = {}
+        self._spend_indexed_tx_hashes: Set[bytes] = set()
 
         # For synchronization.
         self._activated_keys: List[int] = []
@@ -237,15 +910,20 @@ class AbstractAccount:
         self._load_sync_state()
         self._utxos: Dict[TxoKeyType, UTXO] = {}
         self._utxos_lock = threading.RLock()
+        self._utxo_index = UTXOIndex()
+        self._history_index: Optional[HistoryIndex] = None
+        # The changes to the history made while the index is being read, to apply to it after.
+        self._history_index_updates: Optional[List[HistoryIndexUpdate]] = None
+        self._history_index_read_lock = threading.Lock()
+        self._history_lock = threading.RLock()
         self._stxos: Dict[TxoKeyType, int] = {}
-        self._keypath: Dict[int, Sequence[int]] = {}
-        self._keyinstances: Dict[int, KeyInstanceRow] = { r.keyinstance_id: r for r
-            in keyinstance_rows }
+        self._keyinstances = KeyInstanceStore(keyinstance_rows)
+        self._keypath = self._keyinstances.paths
         self._masterkey_ids: Set[int] = set(row.masterkey_id for row in keyinstance_rows
             if row.masterkey_id is not None)
 
-        # { txids -> { scripthashes: [ <set of txo indices> ]} }
-        self._script_txos: Dict[str, Dict[bytes, Set[int]]] = {}
+        # { tx_hash -> { scripthashes: [ <set of txo indices> ]} }
+        self._script_txos: Dict[bytes, Dict[bytes, Set[int]]] = {}
 
         self._load_keys(keyinstance_rows)
         self._load_txos(output_rows)
@@ -262,29 +940,29 @@ class AbstractAccount:
         script_bytes = bytes(script)
         return sha256(script_bytes)
 
-    def get_script_txos(self, tx_id: str, keyinstance_id: int) -> Optional[Set[int]]:
+    def get_script_txos(self, tx_hash: bytes, keyinstance_id: int) -> Optional[Set[int]]:
         """get the set of all output indices in a given transaction for a given keyinstance id"""
         script, _script_bytes, _object = self._get_cached_script(keyinstance_id)
-        if tx_id in self._script_txos:
+        if tx_hash in self._script_txos:
             try:
                 scripthash = self.scriptpubkey_to_scripthash(script)
-                return self._script_txos[tx_id][scripthash]
+                return self._script_txos[tx_hash][scripthash]
             except KeyError as e:
                 return None
         return None
 
-    def add_tx_to_script_txos(self, tx_id: str, tx: Transaction) -> None:
+    def add_tx_to_script_txos(self, tx_hash: bytes, tx: Transaction) -> None:
         """lazy-loads cache as new txids are encountered by set_key_history."""
-        # { txids -> { scripthashes: [ <set of txo indices> ]} }
-        if self._script_txos.get(tx_id) is not None:
+        # { tx_hash -> { scripthashes: [ <set of txo indices> ]} }
+        if self._script_txos.get(tx_hash) is not None:
             return
 
-        self._script_txos[tx_id] = {}
+        self._script_txos[tx_hash] = {}
         for index, output in enumerate(tx.outputs):
             _hash = self.scriptpubkey_to_scripthash(output.script_pubkey)
-            if not self._script_txos[tx_id].get(_hash):
-                self._script_txos[tx_id][_hash] = set()
-            self._script_txos[tx_id][_hash].add(index)
+            if not self._script_txos[tx_hash].get(_hash):
+                self._script_txos[tx_hash][_hash] = set()
+            self._script_txos[tx_hash][_hash].add(index)
 
     def get_id(self) -> int:
         return self._id
@@ -410,9 +1088,7 @@ class AbstractAccount:
         # Flush the associated UTXO state and account state from memory.
         with self._utxos_lock:
             for utxo_key in utxokeys:
-                if utxo_key in self._frozen_coins:
-                    self._frozen_coins.remove(utxo_key)
-                del self._utxos[utxo_key]
+                self._remove_utxo(utxo_key)
         for stxokey in stxokeys:
             del self._stxos[stxokey]
         for key_id in key_ids:
@@ -420,18 +1096,17 @@ class AbstractAccount:
 
     def get_key_txokeys(self, key_ids: Set[int]) -> Tuple[List[TxoKeyType], List[TxoKeyType]]:
         with self._utxos_lock:
-            utxo_keys = [ k for (k, v) in self._utxos.items() if v.keyinstance_id in key_ids ]
+            utxo_keys = self._utxo_index.get_key_coin_keys(key_ids)
         stxo_keys = [ k for (k, v) in self._stxos.items() if v in key_ids ]
         return utxo_keys, stxo_keys
 
     def get_key_utxos(self, key_ids: Set[int]) -> List[UTXO]:
         with self._utxos_lock:
-            return [ u for u in self._utxos.values() if u.keyinstance_id in key_ids ]
+            return [ self._utxos[k] for k in self._utxo_index.get_key_coin_keys(key_ids) ]
 
     def get_script_type_for_id(self, key_id: int) -> ScriptType:
-        keyinstance = self._keyinstances[key_id]
-        return (keyinstance.script_type if keyinstance.script_type != ScriptType.NONE else
-            self.get_default_script_type())
+        script_type = self._keyinstances.get_script_type(key_id)
+        return script_type if script_type != ScriptType.NONE else self.get_default_script_type()
 
     def get_script_template_for_id(self, keyinstance_id: int,
             script_type: Optional[ScriptType]=None) -> ScriptTemplate:
@@ -448,6 +1123,15 @@ class AbstractAccount:
     def get_possible_scripts_for_id(self, keyinstance_id: int) -> List[Tuple[ScriptType, Script]]:
         raise NotImplementedError
 
+    def get_subscription_triples(self, keyinstance_ids: Iterable[int],
+            executor: Optional[Executor]=None) -> List[Tuple[int, ScriptType, bytes]]:
+        """
+        The (keyinstance_id, script_type, scripthash) triples to subscribe to for the given keys.
+        Accounts that can derive their keys in bulk spread the work over the executor if given.
+        """
+        return [ (key_id, script_type, scripthash_bytes(script)) for key_id in keyinstance_ids
+            for script_type, script in self.get_possible_scripts_for_id(key_id) ]
+
     def get_script_for_id(self, keyinstance_id: int,
             script_type: Optional[ScriptType]=None) -> Script:
         script_template = self.get_script_template_for_id(keyinstance_id, script_type)
@@ -566,34 +1250,26 @@ class AbstractAccount:
     def _load_sync_state(self) -> None:
         self._sync_state = SyncState()
 
-        with TransactionDeltaTable(self._wallet._db_context) as table:
-            rows = table.read_key_history(self._id)
+        # The key history is persisted as it is received from the server, in immediately usable
+        # order. Loading it is proportional to the number of keys with history.
+        with timeline.phase("sync_state") as phase:
+            with KeyHistoryTable(self._wallet._db_context) as table:
+                rows = table.read(self._id)
 
-        key_history: Dict[int, List[Tuple[str, int]]] = {}
-        maximum_position = 0
-        positions: Dict[str, int] = {}
-        for tx_hash, keyinstance_id in rows:
-            metadata = cast(TxData, self.get_transaction_metadata(tx_hash))
-            if metadata.height is not None:
-                tx_id = hash_to_hex_str(tx_hash)
-                if metadata.position is not None:
-                    positions[tx_id] = metadata.position
-                    maximum_position = max(maximum_position, metadata.position)
-                entries = key_history.setdefault(keyinstance_id, [])
-                entries.append((tx_id, metadata.height))
-
-        # From elsewhere:
-        #   The history is in immediately usable order. Transactions are listed in ascending
-        #   block height (height > 0), followed by the unconfirmed (height == 0) and then
-        #   those with unconfirmed parents (height < 0). [ (tx_hash, tx_height), ... ]
-        # We place unconfirmed transactions last by giving them a position larger than the largest
-        # known position. But we have no concept of what also has unconfirmed parents, so we
-        # leave this as a less common case that will reprocess the state. In the longer term
-        # syncing from the blockchain will likely be phased out except for restoration of older
-        # seeds.
-        for keyinstance_id, entries in key_history.items():
-            entries.sort(key=lambda v: (v[1], positions.get(v[0], maximum_position+1)))
-            self._sync_state.set_key_history(keyinstance_id, entries)
+            for row in rows:
+                self._sync_state.set_key_history(row.keyinstance_id, row.history)
+            phase.set_count("rows", len(rows))
+
+        self._wallet.update_transaction_accounts(self._id,
+            self._sync_state.get_transaction_hashes(), [])
+
+    def _set_sync_key_history(self, keyinstance_id: int, hist: List[KeyHistoryEntryType]) -> None:
+        removed_tx_hashes, added_tx_hashes = self._sync_state.set_key_history(keyinstance_id,
+            hist)
+        # A transaction is only no longer related to this account when no other key lists it.
+        self._wallet.update_transaction_accounts(self._id, added_tx_hashes,
+            [ tx_hash for tx_hash in removed_tx_hashes
+                if not self._sync_state.get_transaction_key_ids(tx_hash) ])
 
     def _load_keys(self, keyinstance_rows: List[KeyInstanceRow]) -> None:
         pass
@@ -602,6 +1278,7 @@ class AbstractAccount:
         self._stxos.clear()
         self._utxos.clear()
         self._frozen_coins: Set[TxoKeyType] = set([])
+        self._utxo_index.clear()
 
         for row in output_rows:
             self._load_txo(row)
@@ -623,6 +1300,8 @@ class AbstractAccount:
         is_coinbase = (flags & TransactionOutputFlag.IS_COINBASE) != 0
         utxo_key = TxoKeyType(tx_hash, output_index)
         with self._utxos_lock:
+            if utxo_key in self._utxos:
+                self._remove_utxo(utxo_key)
             self._utxos[utxo_key] = UTXO(
                 value=value,
                 script_pubkey=script,
@@ -637,21 +1316,52 @@ class AbstractAccount:
                 if flags & TransactionOutputFlag.IS_SPENT:
                     self._logger.warning("Ignoring frozen flag for spent txo %s:%d",
                         hash_to_hex_str(tx_hash), output_index)
-                    return
-                self._frozen_coins.add(utxo_key)
+                else:
+                    self._frozen_coins.add(utxo_key)
+            metadata = self.get_transaction_metadata(tx_hash)
+            height = 0 if metadata is None or metadata.height is None else metadata.height
+            self._utxo_index.add_coin(utxo_key, keyinstance.keyinstance_id, height, is_coinbase,
+                value, utxo_key in self._frozen_coins)
+
+    # Should be called with the UTXO lock.
+    def _remove_utxo(self, utxo_key: TxoKeyType) -> UTXO:
+        utxo = self._utxos.pop(utxo_key)
+        frozen = utxo_key in self._frozen_coins
+        if frozen:
+            self._frozen_coins.remove(utxo_key)
+        self._utxo_index.remove_coin(utxo_key, utxo.keyinstance_id, utxo.value, frozen)
+        return utxo
+
+    def update_transaction_heights(self, tx_hashes: Iterable[bytes]) -> None:
+        """
+        Move the coins and history lines of the given transactions to match their current
+        heights. This should be called whenever the height of a transaction is changed.
+        """
+        with self._utxos_lock, self._history_lock:
+            for tx_hash in tx_hashes:
+                self._update_history_index(partial(self._move_history_line, tx_hash))
+                if self._utxo_index.has_transaction(tx_hash):
+                    metadata = self.get_transaction_metadata(tx_hash)
+                    if metadata is not None and metadata.height is not None:
+                        self._utxo_index.set_height(tx_hash, metadata.height)
 
     # Should be called with the transaction lock.
     def create_transaction_output(self, tx_hash: bytes, output_index: int, value: int,
             flags: TransactionOutputFlag, keyinstance: KeyInstanceRow,
-            script: Script, address: Optional[ScriptTemplate]=None):
+            script: Script, address: Optional[ScriptTemplate]=None,
+            changes: Optional[KeyUsageChanges]=None) -> None:
         if flags & TransactionOutputFlag.IS_SPENT:
             self._stxos[TxoKeyType(tx_hash, output_index)] = keyinstance.keyinstance_id
         else:
             self.register_utxo(tx_hash, output_index, value, flags, keyinstance,
                 script, address)
 
-        self._wallet.create_transactionoutputs(self._id, [ TransactionOutputRow(tx_hash,
-            output_index, value, keyinstance.keyinstance_id, flags) ])
+        row = TransactionOutputRow(tx_hash, output_index, value, keyinstance.keyinstance_id,
+            flags)
+        if changes is None:
+            self._wallet.create_transactionoutputs(self._id, [ row ])
+        else:
+            changes.txo_rows.append(row)
 
     def is_deterministic(self) -> bool:
         # Not all wallets have a keystore, like imported address for instance.
@@ -720,7 +1430,7 @@ class AbstractAccount:
         self._wallet.update_account_script_types([ (script_type, self._row.account_id) ])
         self._row = self._row._replace(default_script_type=script_type)
 
-    def get_key_paths(self) -> Dict[int, Sequence[int]]:
+    def get_key_paths(self) -> Mapping[int, Sequence[int]]:
         return self._keypath
 
     def get_derivation_path(self, keyinstance_id: int) -> Optional[Sequence[int]]:
@@ -754,13 +1464,17 @@ class AbstractAccount:
         return PrivateKey(secret).to_WIF(compressed=compressed, coin=Net.COIN)
 
     # Should be called with the transaction lock.
-    def set_utxo_spent(self, tx_hash: bytes, output_index: int) -> None:
+    def set_utxo_spent(self, tx_hash: bytes, output_index: int,
+            changes: Optional[KeyUsageChanges]=None) -> None:
         with self._utxos_lock:
             txo_key = TxoKeyType(tx_hash, output_index)
-            utxo = self._utxos.pop(txo_key)
+            utxo = self._remove_utxo(txo_key)
         retained_flags = utxo.flags & TransactionOutputFlag.IS_COINBASE
-        self._wallet.update_transactionoutput_flags(
-            [ (retained_flags | TransactionOutputFlag.IS_SPENT, tx_hash, output_index)  ])
+        flag_update = (retained_flags | TransactionOutputFlag.IS_SPENT, tx_hash, output_index)
+        if changes is None:
+            self._wallet.update_transactionoutput_flags([ flag_update ])
+        else:
+            changes.txo_flag_updates.append(flag_update)
         self._stxos[txo_key] = utxo.keyinstance_id
 
     def is_frozen_utxo(self, utxo):
@@ -774,27 +1488,16 @@ class AbstractAccount:
 
     def get_spendable_coins(self, domain: Optional[List[int]], config) -> List[UTXO]:
         confirmed_only = config.get('confirmed_only', False)
-        utxos = self.get_utxos(exclude_frozen=True, mature=True, confirmed_only=confirmed_only)
-        if domain is not None:
-            return [ utxo for utxo in utxos if utxo.keyinstance_id in domain ]
-        return utxos
+        return self.get_utxos(exclude_frozen=True, mature=True, confirmed_only=confirmed_only,
+            key_ids=domain)
 
-    def get_utxos(self, exclude_frozen=False, mature=False, confirmed_only=False) -> List[UTXO]:
+    def get_utxos(self, exclude_frozen=False, mature=False, confirmed_only=False,
+            key_ids: Optional[Iterable[int]]=None) -> List[UTXO]:
         '''Note exclude_frozen=True checks for coin-level frozen status. '''
-        mempool_height = self._wallet.get_local_height() + 1
-        def is_spendable_utxo(utxo):
-            metadata = self.get_transaction_metadata(utxo.tx_hash)
-            if exclude_frozen and self.is_frozen_utxo(utxo):
-                return False
-            if confirmed_only and metadata.height <= 0:
-                return False
-            # A coin is spendable at height + COINBASE_MATURITY)
-            if mature and utxo.is_coinbase and \
-                    mempool_height < metadata.height + COINBASE_MATURITY:
-                return False
-            return True
         with self._utxos_lock:
-            return [ utxo for utxo in self._utxos.values() if is_spendable_utxo(utxo)]
+            utxo_keys = self._utxo_index.get_coin_keys(self._wallet.get_local_height(),
+                exclude_frozen, mature, confirmed_only, key_ids)
+            return [ self._utxos[k] for k in utxo_keys ]
 
     def existing_active_keys(self) -> List[int]:
         with self._activated_keys_lock:
@@ -804,12 +1507,24 @@ class AbstractAccount:
 
     def get_frozen_balance(self) -> Tuple[int, int, int]:
         with self._utxos_lock:
-            return self.get_balance(self._frozen_coins)
+            balance = self._utxo_index.get_balance(self._wallet.get_local_height(), frozen=True)
+            assert not DEBUG_BALANCE_AGGREGATES or \
+                balance == self._calculate_balance(self._frozen_coins)
+            return balance
 
     def get_balance(self, domain=None, exclude_frozen_coins: bool=False) -> Tuple[int, int, int]:
         with self._utxos_lock:
-            if domain is None:
-                domain = set(self._utxos.keys())
+            if domain is not None:
+                return self._calculate_balance(domain, exclude_frozen_coins)
+            balance = self._utxo_index.get_balance(self._wallet.get_local_height(),
+                frozen=False if exclude_frozen_coins else None)
+            assert not DEBUG_BALANCE_AGGREGATES or \
+                balance == self._calculate_balance(self._utxos.keys(), exclude_frozen_coins)
+            return balance
+
+    def _calculate_balance(self, domain: Iterable[TxoKeyType],
+            exclude_frozen_coins: bool=False) -> Tuple[int, int, int]:
+        with self._utxos_lock:
             c = u = x = 0
             for k in domain:
                 if exclude_frozen_coins and k in self._frozen_coins:
@@ -851,24 +1566,104 @@ class AbstractAccount:
                 return True
             return False
 
-    def _get_cached_script(self, keyinstance_id: int) -> CachedScriptType:
-        keyinstance = self.get_keyinstance(keyinstance_id)
-        script_type = keyinstance.script_type
+    def _get_cached_script(self, keyinstance_id: int,
+            script_type: Optional[ScriptType]=None) -> CachedScriptType:
+        if script_type is None:
+            script_type = self._keyinstances.get_script_type(keyinstance_id)
         assert script_type != ScriptType.NONE, "key_id=%s has ScriptType.NONE" % keyinstance_id
-        cache_key = (keyinstance_id, script_type)
-        cache_value = self._script_cache.get(cache_key)
+        cache_value = self._script_cache.get((keyinstance_id, script_type))
         if cache_value is None:
             script_template = self.get_script_template_for_id(keyinstance_id, script_type)
-            address = script_template if isinstance(script_template, Address) else None
+            cache_value = self._cache_script(keyinstance_id, script_type, script_template)
+        return cache_value
+
+    def _cache_script(self, keyinstance_id: int, script_type: ScriptType,
+            script_template: ScriptTemplate, script: Optional[Script]=None) -> CachedScriptType:
+        address = script_template if isinstance(script_template, Address) else None
+        if script is None:
             script = script_template.to_script()
-            cache_value = script, bytes(script), address
-            self._script_cache[cache_key] = cache_value
+        cache_value = script, bytes(script), address
+        # The cache is bounded by count, so there is no need to estimate the size of the entry.
+        self._script_cache.set((keyinstance_id, script_type), cache_value, 0)
         return cache_value
 
+    def _index_transaction_spends(self, tx_hash: bytes, tx: Transaction) -> None:
+        if tx_hash in self._spend_indexed_tx_hashes:
+            return
+        for txin in tx.inputs:
+            # Only the spends of outputs of transactions in the history of this account's keys
+            # can be spends of its coins. The history of a key includes both the transaction
+            # that funds it and any that spend from it, so the funding transaction is known.
+            if not self._sync_state.get_transaction_key_ids(txin.prev_hash):
+                continue
+            txo_key = TxoKeyType(txin.prev_hash, txin.prev_idx)
+            # The spends of known coins are applied to them directly.
+            if txo_key in self._utxos or txo_key in self._stxos:
+                continue
+            self._txo_spenders[txo_key] = tx_hash
+        self._spend_indexed_tx_hashes.add(tx_hash)
+
+    def _unindex_transaction_spends(self, tx_hash: bytes, tx: Transaction) -> None:
+        if tx_hash not in self._spend_indexed_tx_hashes:
+            return
+        for txin in tx.inputs:
+            txo_key = TxoKeyType(txin.prev_hash, txin.prev_idx)
+            if self._txo_spenders.get(txo_key) == tx_hash:
+                del self._txo_spenders[txo_key]
+        self._spend_indexed_tx_hashes.remove(tx_hash)
+
+    def _get_txo_spender(self, txo_key: TxoKeyType, keyinstance_id: int) -> Optional[bytes]:
+        spend_tx_hash = self._txo_spenders.get(txo_key)
+        if spend_tx_hash is not None:
+            return spend_tx_hash
+
+        # Transactions processed in earlier sessions are not indexed. The candidates are those
+        # in the history of the key, and each will only ever need to be indexed once.
+        for spend_tx_hash in self._sync_state.get_key_tx_hashes(keyinstance_id):
+            if spend_tx_hash in self._spend_indexed_tx_hashes:
+                continue
+            spend_tx = self._wallet._transaction_cache.get_transaction(spend_tx_hash)
+            if spend_tx is None:
+                continue
+            self._index_transaction_spends(spend_tx_hash, spend_tx)
+        return self._txo_spenders.get(txo_key)
+
     def process_key_usage(self, tx_hash: bytes, tx: Transaction,
             relevant_txos: Optional[List[Tuple[int, XTxOutput]]]) -> bool:
+        return len(self.process_key_usage_batch([ (tx_hash, tx, relevant_txos) ])) > 0
+
+    def process_key_usage_batch(self, entries: Sequence[Tuple[bytes, Transaction,
+            Optional[List[Tuple[int, XTxOutput]]]]]) -> Set[bytes]:
+        """
+        Process the key usage for the given transactions in order, writing all the resulting
+        database changes together. Returns the hashes of the transactions that were found to
+        use keys in this account.
+        """
+        changes = KeyUsageChanges()
+        used_tx_hashes: Set[bytes] = set()
         with self.transaction_lock:
-            return self._process_key_usage(tx_hash, tx, relevant_txos)
+            for tx_hash, tx, relevant_txos in entries:
+                if self._process_key_usage(tx_hash, tx, relevant_txos, changes):
+                    used_tx_hashes.add(tx_hash)
+
+            if len(changes.txo_rows) or len(changes.txo_flag_updates) or len(changes.tx_deltas):
+                check_keyinstance_ids = set(k[1] for k in changes.tx_deltas.keys())
+                self._wallet.create_transaction_key_usage(changes.txo_rows,
+                    changes.txo_flag_updates,
+                    [ TransactionDeltaRow(k[0], k[1], v) for k, v in changes.tx_deltas.items() ],
+                    partial(self.requests.check_paid_requests, check_keyinstance_ids))
+
+            with self._history_lock:
+                for (tx_hash, _keyinstance_id), value_delta in changes.tx_deltas.items():
+                    self._update_history_index(partial(self._add_history_value, tx_hash,
+                        value_delta))
+
+        if len(changes.tx_deltas):
+            affected_keys = [ self._keyinstances[k] for k in
+                set(k[1] for k in changes.tx_deltas.keys()) ]
+            self._wallet.trigger_callback('on_keys_updated', self._id, affected_keys)
+
+        return used_tx_hashes
 
     # def _process_key_usage(self, tx_hash: bytes, tx: Transaction) -> None:
     #     import cProfile, pstats, io
@@ -884,17 +1679,20 @@ class AbstractAccount:
     #     print(s.getvalue())
 
     def _process_key_usage(self, tx_hash: bytes, tx: Transaction,
-            relevant_txos: Optional[List[Tuple[int, XTxOutput]]]) -> bool:
-        tx_id = hash_to_hex_str(tx_hash)
-        key_ids = self._sync_state.get_transaction_key_ids(tx_id)
-        key_matches = [(self.get_keyinstance(key_id),
-            *self._get_cached_script(key_id)) for key_id in key_ids]
+            relevant_txos: Optional[List[Tuple[int, XTxOutput]]],
+            changes: KeyUsageChanges) -> bool:
+        key_ids = self._sync_state.get_transaction_key_ids(tx_hash)
+        # The scripts of the candidate keys, which are current even if a key has had it's script
+        # type changed since it was last used.
+        script_key_ids = { self._get_cached_script(key_id)[1]: key_id for key_id in key_ids }
+        self._index_transaction_spends(tx_hash, tx)
 
         base_txo_flags = TransactionOutputFlag.IS_COINBASE if tx.is_coinbase() \
             else TransactionOutputFlag.NONE
-        tx_deltas: Dict[Tuple[bytes, int], int] = defaultdict(int)
-        new_txos: List[Tuple[bytes, int, int, TransactionOutputFlag, KeyInstanceRow,
-            ScriptTemplate]] = []
+        # The deltas are accumulated across the batch, so we need to track use by this
+        # transaction separately.
+        tx_deltas = changes.tx_deltas
+        is_used = False
         # NOTE(typing) Item "List[Tuple[int, XTxOutput]]" of
         #     "Union[Iterator[Tuple[int, XTxOutput]], List[Tuple[int, XTxOutput]],
         #     enumerate[Any]]" has no attribute "__next__"
@@ -906,37 +1704,24 @@ class AbstractAccount:
             if keyinstance_id is not None:
                 continue
 
-            output_bytes = bytes(output.script_pubkey)
-            for keyinstance, script, script_bytes, address in key_matches:
-                if script_bytes == output_bytes:
-                    break
-            else:
+            matched_key_id = script_key_ids.get(bytes(output.script_pubkey))
+            if matched_key_id is None:
                 continue
+            keyinstance = self.get_keyinstance(matched_key_id)
+            script, _script_bytes, address = self._get_cached_script(matched_key_id)
 
-            # Search the known candidates to see if we already have this txo's spending input.
+            # Check if we already have this txo's spending input.
             txo_flags = base_txo_flags
-            for spend_tx_id, _height in self._sync_state.get_key_history(
-                    keyinstance.keyinstance_id):
-                if spend_tx_id == tx_id:
-                    continue
-                spend_tx_hash = hex_str_to_hash(spend_tx_id)
-                spend_tx = self._wallet._transaction_cache.get_transaction(spend_tx_hash)
-                if spend_tx is None:
-                    continue
-                for spend_txin in spend_tx.inputs:
-                    if spend_txin.prev_hash == tx_hash and spend_txin.prev_idx == output_index:
-                        break
-                else:
-                    continue
-
-                tx_deltas[(spend_tx_hash, keyinstance.keyinstance_id)] -= output.value
+            spend_tx_hash = self._get_txo_spender(TxoKeyType(tx_hash, output_index),
+                matched_key_id)
+            if spend_tx_hash is not None:
+                tx_deltas[(spend_tx_hash, matched_key_id)] -= output.value
                 txo_flags |= TransactionOutputFlag.IS_SPENT
-                break
 
-            # TODO(rt12) BACKLOG batch create the outputs.
             self.create_transaction_output(tx_hash, output_index, output.value,
-                txo_flags, keyinstance, script, address)
+                txo_flags, keyinstance, script, address, changes)
             tx_deltas[(tx_hash, keyinstance.keyinstance_id)] += output.value
+            is_used = True
 
         for input_index, input in enumerate(tx.inputs):
             keyinstance_id = self.get_stxo(input.prev_hash, input.prev_idx)
@@ -946,21 +1731,11 @@ class AbstractAccount:
             if utxo is None:
                 continue
 
-            self.set_utxo_spent(input.prev_hash, input.prev_idx)
+            self.set_utxo_spent(input.prev_hash, input.prev_idx, changes)
             tx_deltas[(tx_hash, utxo.keyinstance_id)] -= utxo.value
+            is_used = True
 
-        if len(tx_deltas):
-            check_keyinstance_ids = set(r[1] for r in tx_deltas.keys())
-            self._wallet.create_or_update_transactiondelta_relative(
-                [ TransactionDeltaRow(k[0], k[1], v) for k, v in tx_deltas.items() ],
-                partial(self.requests.check_paid_requests, check_keyinstance_ids))
-
-            affected_keys = [self._keyinstances[k] for (_x, k) in tx_deltas.keys()]
-            self._wallet.trigger_callback('on_keys_updated', self._id, affected_keys)
-
-            return True
-
-        return False
+        return is_used
 
     def delete_transaction(self, tx_hash: bytes) -> None:
         # Invoices have foreign key on the transaction.
@@ -982,12 +1757,15 @@ class AbstractAccount:
             self._remove_transaction(tx_hash)
             self._logger.debug("deleting tx from cache and datastore: %s", tx_id)
             self._wallet._transaction_cache.delete(tx_hash, _completion_callback)
+            with self._history_lock:
+                self._update_history_index(partial(self._remove_history_line, tx_hash))
 
     def _remove_transaction(self, tx_hash: bytes) -> None:
         with self.transaction_lock:
             self._logger.debug("removing transaction %s", hash_to_hex_str(tx_hash))
 
             tx = self._wallet._transaction_cache.get_transaction(tx_hash)
+            self._unindex_transaction_spends(tx_hash, tx)
             # tx_deltas: Dict[Tuple[bytes, int], int] = defaultdict(int)
 
             txo_key: TxoKeyType
@@ -1041,9 +1819,7 @@ class AbstractAccount:
                 # Expunge the UTXO.
                 utxo_key = utxo.key()
                 with self._utxos_lock:
-                    if utxo_key in self._frozen_coins:
-                        self._frozen_coins.remove(utxo_key)
-                    del self._utxos[utxo_key]
+                    self._remove_utxo(utxo_key)
 
             if len(txout_flags):
                 self._wallet.update_transactionoutput_flags(txout_flags)
@@ -1056,7 +1832,7 @@ class AbstractAccount:
             #         [ TransactionDeltaRow(k[0], k[1], v) for k, v in tx_deltas.items() ])
 
     def get_key_history(self, keyinstance_id: int,
-            script_type: ScriptType) -> List[Tuple[str, int]]:
+            script_type: ScriptType) -> List[KeyHistoryEntryType]:
         keyinstance = self._keyinstances[keyinstance_id]
         if keyinstance.script_type in (ScriptType.NONE, script_type):
             return self._sync_state.get_key_history(keyinstance_id)
@@ -1067,9 +1843,10 @@ class AbstractAccount:
         #     f"past, and will ignore it for now. Please report it.")
         return []
 
-    def get_relevant_txos(self, keyinstance_id, tx, tx_id) -> Optional[List[Tuple[int, XTxOutput]]]:
-        self.add_tx_to_script_txos(tx_id, tx)
-        relevant_indices = self.get_script_txos(tx_id, keyinstance_id)
+    def get_relevant_txos(self, keyinstance_id: int, tx: Transaction, tx_hash: bytes) \
+            -> Optional[List[Tuple[int, XTxOutput]]]:
+        self.add_tx_to_script_txos(tx_hash, tx)
+        relevant_indices = self.get_script_txos(tx_hash, keyinstance_id)
         if relevant_indices is None:
             return None
 
@@ -1080,7 +1857,7 @@ class AbstractAccount:
 
     # Called by network.
     async def set_key_history(self, keyinstance_id: int, script_type: ScriptType,
-            hist: List[Tuple[str, int]], tx_fees: Dict[str, int]) -> None:
+            hist: List[KeyHistoryEntryType], tx_fees: Dict[bytes, int]) -> None:
         if self._stopped:
             self._logger.debug("set_key_history on stopped wallet: %s", keyinstance_id)
             return
@@ -1091,126 +1868,271 @@ class AbstractAccount:
         # - The key usage has been processed.
         # As some of the events may read from the database or access wallet state.
         update_state_changes: List[Tuple[bytes, TxFlags, TxFlags]] = []
-        pending_event_count = 1
-
-        def do_post_processing() -> None:
-            nonlocal update_state_changes
-            self._logger.debug("set_key_history post-processing %d state changes",
-                len(update_state_changes))
-            for state_change in update_state_changes:
-                self._wallet.trigger_callback('transaction_state_change', self._id, *state_change)
-
-            self._wallet.txs_changed_event.set()
-            self.synchronize()
-
-        def on_event_completed() -> None:
-            nonlocal pending_event_count
-            pending_event_count -= 1
-            if pending_event_count > 0:
-                return
 
-            # We do not want to block the completion thread.
-            app_state.app.run_in_thread(do_post_processing)
+        async with AsynchronousWriter() as add_writer, AsynchronousWriter() as update_writer:
+            have_adds = have_updates = False
+            with self.lock:
+                self._logger.debug("set_key_history key_id=%s fees=%s", keyinstance_id, tx_fees)
+                key = self._keyinstances[keyinstance_id]
+                if key.script_type == ScriptType.NONE:
+                    # This is the first use of the allocated key and we update the key to
+                    # reflect it.
+                    self._keyinstances[keyinstance_id] = key._replace(script_type=script_type)
+                    self._wallet.update_keyinstance_script_types([ (script_type, keyinstance_id) ])
+                elif key.script_type != script_type:
+                    self._logger.error("Received key history from server for key that already "
+                        f"has script type {key.script_type}, where server history relates "
+                        f"to script type {script_type}. ElectrumSV has never handled this in the "
+                        f"past, and will ignore it for now. Please report it. History={hist}")
+                    return
 
-        with self.lock:
-            self._logger.debug("set_key_history key_id=%s fees=%s", keyinstance_id, tx_fees)
-            key = self._keyinstances[keyinstance_id]
-            if key.script_type == ScriptType.NONE:
-                # This is the first use of the allocated key and we update the key to reflect it.
-                self._keyinstances[keyinstance_id] = key._replace(script_type=script_type)
-                self._wallet.update_keyinstance_script_types([ (script_type, keyinstance_id) ])
-            elif key.script_type != script_type:
-                self._logger.error("Received key history from server for key that already "
-                    f"has script type {key.script_type}, where server history relates "
-                    f"to script type {script_type}. ElectrumSV has never handled this in the "
-                    f"past, and will ignore it for now. Please report it. History={hist}")
+                # The history is in immediately usable order. Transactions are listed in ascending
+                # block height (height > 0), followed by the unconfirmed (height == 0) and then
+                # those with unconfirmed parents (height < 0). [ (tx_hash, tx_height), ... ]
+                self._set_sync_key_history(keyinstance_id, hist)
+                self._wallet.update_key_history([ KeyHistoryRow(keyinstance_id, self._id,
+                    hist) ])
+
+                adds = []
+                updates = []
+                unique_tx_hashes: Set[bytes] = set([])
+                for tx_hash, tx_height in hist:
+                    tx_fee = tx_fees.get(tx_hash, None)
+                    data = TxData(height=tx_height, fee=tx_fee)
+                    # The metadata flags indicate to the update call which TxData fields should
+                    # be updated. Fields that are not flagged in the existing cache record, should
+                    # remain as they are.
+                    flags = TxFlags.HasHeight
+                    if tx_fee is not None:
+                        flags |= TxFlags.HasFee
+                    entry_flags = self._wallet._transaction_cache.get_flags(tx_hash)
+                    if entry_flags is None:
+                        adds.append((tx_hash, data, None, flags, None))
+                    else:
+                        # If a transaction has bytedata at this point, but no state, then it is
+                        # likely that we added it locally and broadcast it ourselves. Transactions
+                        # without bytedata cannot have a state.
+                        if entry_flags & \
+                                (TxFlags.HasByteData|TxFlags.StateCleared|TxFlags.StateSettled) \
+                                == TxFlags.HasByteData:
+                            flags |= TxFlags.StateCleared
+                            # Event workaround.
+                            update_state_changes.append((tx_hash,
+                                entry_flags & TxFlags.STATE_MASK, flags & TxFlags.STATE_MASK))
+                        updates.append((tx_hash, data, None, flags))
+                    unique_tx_hashes.add(tx_hash)
+
+                if len(adds):
+                    # The completion callback is guaranteed to be called.
+                    self._wallet._transaction_cache.add(adds,
+                        completion_callback=add_writer.get_callback())
+                    have_adds = True
+
+                if len(updates):
+                    # The completion callback is only guaranteed to be called if database updates
+                    # are actually made. We can infer this from the return value which is how
+                    # many are.
+                    have_updates = self._wallet._transaction_cache.update(updates,
+                        completion_callback=update_writer.get_callback()) > 0
+                    self.update_transaction_heights(update[0] for update in updates)
+
+                key_usage_entries = []
+                for tx_hash, tx_height in hist:
+                    entry_flags = self._wallet._transaction_cache.get_flags(tx_hash)
+                    if entry_flags & TxFlags.HasByteData == TxFlags.HasByteData:
+                        tx = self._wallet._transaction_cache.get_transaction(tx_hash)
+                        relevant_txos = self.get_relevant_txos(keyinstance_id, tx, tx_hash)
+                        key_usage_entries.append((tx_hash, tx, relevant_txos))
+                if len(key_usage_entries):
+                    self.process_key_usage_batch(key_usage_entries)
+
+            try:
+                if have_adds:
+                    await add_writer.succeeded()
+                if have_updates:
+                    await update_writer.succeeded()
+            except Exception:
+                # The failed write has been logged by the writer, and there is no way we can
+                # recover from it here.
+                self._logger.exception("set_key_history writes failed for key_id=%s",
+                    keyinstance_id)
                 return
 
-            # The history is in immediately usable order. Transactions are listed in ascending
-            # block height (height > 0), followed by the unconfirmed (height == 0) and then
-            # those with unconfirmed parents (height < 0). [ (tx_hash, tx_height), ... ]
-            self._sync_state.set_key_history(keyinstance_id, hist)
-
-            adds = []
-            updates = []
-            unique_tx_hashes: Set[bytes] = set([])
-            for tx_id, tx_height in hist:
-                tx_fee = tx_fees.get(tx_id, None)
-                data = TxData(height=tx_height, fee=tx_fee)
-                # The metadata flags indicate to the update call which TxData fields should
-                # be updated. Fields that are not flagged in the existing cache record, should
-                # remain as they are.
-                flags = TxFlags.HasHeight
-                if tx_fee is not None:
-                    flags |= TxFlags.HasFee
-                tx_hash = hex_str_to_hash(tx_id)
-                entry_flags = self._wallet._transaction_cache.get_flags(tx_hash)
-                if entry_flags is None:
-                    adds.append((tx_hash, data, None, flags, None))
+        self._logger.debug("set_key_history post-processing %d state changes",
+            len(update_state_changes))
+        for state_change in update_state_changes:
+            self._wallet.trigger_callback('transaction_state_change', self._id, *state_change)
+
+        self._wallet.txs_changed_event.set()
+        await self._trigger_synchronization()
+
+    def _update_history_index(self, update: HistoryIndexUpdate) -> None:
+        # Called with the history lock.
+        if self._history_index is not None:
+            update(self._history_index)
+        elif self._history_index_updates is not None:
+            self._history_index_updates.append(update)
+
+    def _move_history_line(self, tx_hash: bytes, history_index: HistoryIndex) -> None:
+        if history_index.has_transaction(tx_hash):
+            history_index.update(tx_hash, self.get_transaction_metadata(tx_hash))
+
+    def _add_history_value(self, tx_hash: bytes, value_delta: int,
+            history_index: HistoryIndex) -> None:
+        history_index.update(tx_hash, self.get_transaction_metadata(tx_hash), value_delta)
+
+    def _remove_history_line(self, tx_hash: bytes, history_index: HistoryIndex) -> None:
+        history_index.remove(tx_hash)
+
+    def _get_history_index(self) -> HistoryIndex:
+        with self._history_index_read_lock:
+            with self._history_lock:
+                if self._history_index is not None:
+                    return self._history_index
+
+            # Key usage is processed under the transaction lock and written in the background.
+            # The history is read by a queued write, so that it includes exactly the key usage
+            # processed before the read was queued. The changes made after that are collected
+            # and applied to the index once it is read, without holding the transaction lock
+            # while waiting.
+            rows: List[TransactionDeltaHistoryRow] = []
+            def _read_history(db: sqlite3.Connection) -> None:
+                rows[:] = TransactionDeltaTable.read_history_with_connection(db, self._id)
+
+            with SynchronousWriter() as writer:
+                with self.transaction_lock, self._history_lock:
+                    self._history_index_updates = []
+                    self._wallet._db_context.queue_write(_read_history, writer.get_callback())
+                try:
+                    assert writer.succeeded()
+                except Exception:
+                    with self._history_lock:
+                        self._history_index_updates = None
+                    raise
+
+            history_index = HistoryIndex()
+            with self._history_lock:
+                for row in rows:
+                    history_index.update(row.tx_hash, self.get_transaction_metadata(row.tx_hash),
+                        int(row.value_delta))
+                for update in cast(List[HistoryIndexUpdate], self._history_index_updates):
+                    update(history_index)
+                self._history_index_updates = None
+                self._history_index = history_index
+            return history_index
+
+    def _get_history_lines(self, start: int, end: int) -> List[Tuple[HistoryLine, int]]:
+        # Called with the history lock.
+        history_index = cast(HistoryIndex, self._history_index)
+        history: List[Tuple[HistoryLine, int]] = []
+        for tx_hash, height, value_delta, balance in history_index.get_lines(start, end):
+            metadata = cast(TxData, self.get_transaction_metadata(tx_hash))
+            sort_key = cast(HistorySortKey, HistoryIndex.get_sort_key(metadata))
+            tx_flags = cast(TxFlags, self._wallet._transaction_cache.get_flags(tx_hash))
+            history.append((HistoryLine(sort_key, tx_hash, tx_flags, height, value_delta),
+                balance))
+        history.reverse()
+        return history
+
+    def get_history_count(self) -> int:
+        history_index = self._get_history_index()
+        with self._history_lock:
+            return len(history_index)
+
+    def get_history_tx_hashes(self) -> List[bytes]:
+        """
+        Get the hashes of the transactions in the history, in the same order as `get_history`.
+        """
+        history_index = self._get_history_index()
+        with self._history_lock:
+            tx_hashes = history_index.get_tx_hashes()
+        tx_hashes.reverse()
+        return tx_hashes
+
+    def get_history_page(self, offset: int, count: int) -> List[Tuple[HistoryLine, int]]:
+        """
+        Get `count` lines of history starting `offset` lines from the most recent, in the same
+        order as `get_history`.
+        """
+        history_index = self._get_history_index()
+        with self._history_lock:
+            end = len(history_index) - offset
+            return self._get_history_lines(end - count, end)
+
+    def get_history_for_heights(self, from_height: int, to_height: Optional[int]=None) \
+            -> List[Tuple[HistoryLine, int]]:
+        """
+        Get the lines of history mined from `from_height` up to but not including `to_height`,
+        in the same order as `get_history`. If `to_height` is not given, the unmined lines are
+        also included.
+        """
+        history_index = self._get_history_index()
+        with self._history_lock:
+            start = history_index.find_height(from_height)
+            end = len(history_index) if to_height is None else \
+                history_index.find_height(to_height)
+            return self._get_history_lines(start, end)
+
+    def get_history_for_timestamps(self, from_timestamp: Optional[int]=None,
+            to_timestamp: Optional[int]=None) -> List[Tuple[HistoryLine, int]]:
+        """
+        Get the lines of history mined from `from_timestamp` up to but not including
+        `to_timestamp`, in the same order as `get_history`. Unmined lines are treated as mined
+        now.
+
+        The lines are located by a binary search over their block timestamps. Block timestamps
+        are only loosely ordered, so a line in a block with a timestamp that is out of order
+        and close to either limit may be included or excluded.
+        """
+        history_index = self._get_history_index()
+        header_timestamps = app_state.header_timestamps
+        chain = app_state.headers.longest_chain()
+        now = int(time.time())
+        def get_timestamp(index: int) -> int:
+            height = history_index.get_height(index)
+            if height <= 0:
+                return now
+            # The headers are only missing for the checkpointed range of the chain, which is
+            # before any line we could include.
+            return header_timestamps.timestamp_at_height(height, chain) or 0
+
+        def find_timestamp(timestamp: Optional[int], default: int) -> int:
+            if timestamp is None:
+                return default
+            lo, hi = 0, len(history_index)
+            while lo < hi:
+                mid = (lo + hi) // 2
+                if get_timestamp(mid) < timestamp:
+                    lo = mid + 1
                 else:
-                    # If a transaction has bytedata at this point, but no state, then it is
-                    # likely that we added it locally and broadcast it ourselves. Transactions
-                    # without bytedata cannot have a state.
-                    if entry_flags & \
-                            (TxFlags.HasByteData|TxFlags.StateCleared|TxFlags.StateSettled) \
-                            == TxFlags.HasByteData:
-                        flags |= TxFlags.StateCleared
-                        # Event workaround.
-                        update_state_changes.append((tx_hash, entry_flags & TxFlags.STATE_MASK,
-                            flags & TxFlags.STATE_MASK))
-                    updates.append((tx_hash, data, None, flags))
-                unique_tx_hashes.add(tx_hash)
-
-            def _completion_callback(exc_value: Any) -> None:
-                if exc_value is not None:
-                    raise exc_value # pylint: disable=raising-bad-type
-                on_event_completed()
-
-            if len(adds):
-                # The completion callback is guaranteed to be called.
-                pending_event_count += 1
-                self._wallet._transaction_cache.add(adds, completion_callback=_completion_callback)
-
-            if len(updates):
-                # The completion callback is only guaranteed to be called if database updates are
-                # actually made. We can infer this from the return value which is how many are.
-                pending_event_count += 1
-                if self._wallet._transaction_cache.update(updates,
-                    completion_callback=_completion_callback) == 0:
-                        pending_event_count -= 1
-
-            for tx_id, tx_height in hist:
-                tx_hash = hex_str_to_hash(tx_id)
-                entry_flags = self._wallet._transaction_cache.get_flags(tx_hash)
-                if entry_flags & TxFlags.HasByteData == TxFlags.HasByteData:
-                    tx = self._wallet._transaction_cache.get_transaction(tx_hash)
-                    relevant_txos = self.get_relevant_txos(keyinstance_id, tx, tx_id)
-                    self.process_key_usage(tx_hash, tx, relevant_txos)
-
-        # Reaching this stage is the only guaranteed event in triggering post-processing.
-        on_event_completed()
+                    hi = mid
+            return lo
+
+        with self._history_lock:
+            start = find_timestamp(from_timestamp, 0)
+            end = find_timestamp(to_timestamp, len(history_index))
+            return self._get_history_lines(start, end)
 
     def get_history(self, domain: Optional[Set[int]]=None) -> List[Tuple[HistoryLine, int]]:
+        if domain is None:
+            history_index = self._get_history_index()
+            with self._history_lock:
+                return self._get_history_lines(0, len(history_index))
+
         history_raw: List[HistoryLine] = []
         with TransactionDeltaTable(self._wallet._db_context) as table:
             rows = table.read_history(self._id, domain)
 
         for row in rows:
             metadata = self._wallet._transaction_cache.get_metadata(row.tx_hash)
+            sort_key = HistoryIndex.get_sort_key(metadata)
             # Signed but not cleared.
-            if metadata.height is None:
+            if sort_key is None:
                 continue
-            height, position = metadata.height, metadata.position
-            if position is not None:
-                sort_key = height, position
-            elif height is not None and height > 0:
-                sort_key = (height, metadata.date_added)
-            else:
-                sort_key = (1e9, metadata.date_added)
-            history_raw.append(HistoryLine(sort_key, row.tx_hash, row.tx_flags, height,
+            history_raw.append(HistoryLine(sort_key, row.tx_hash, row.tx_flags, metadata.height,
                 row.value_delta))
 
-        history_raw.sort(key = lambda v: v.sort_key)
+        history_raw.sort(key = lambda v: (v.sort_key, v.tx_hash))
 
         history: List[Tuple[HistoryLine, int]] = []
         balance = 0
@@ -1224,47 +2146,68 @@ class AbstractAccount:
 
     def export_history(self, from_timestamp=None, to_timestamp=None,
                        show_addresses=False):
-        h = self.get_history()
+        h = self.get_history_for_timestamps(
+            int(from_timestamp.timestamp()) if from_timestamp else None,
+            int(to_timestamp.timestamp()) if to_timestamp else None)
         fx = app_state.fx
         out = []
+        fiat_items: List[Dict[str, Any]] = []
+        fiat_amounts: List[int] = []
+        fiat_timestamps: List[int] = []
 
         network = app_state.daemon.network
         chain = app_state.headers.longest_chain()
-        backfill_headers = network.backfill_headers_at_heights
-        header_at_height = app_state.headers.header_at_height
+        header_timestamps = app_state.header_timestamps
+        heights = [ history_line.height for history_line, _balance in h ]
+        block_timestamps = header_timestamps.timestamps_for_heights(heights, chain)
+        # Any missing headers are fetched together, rather than a request for each line. Only
+        # the main server can provide them, and if it does not do so in time, or there is no
+        # network, the lines are exported without a timestamp.
         server_height = network.get_server_height() if network else 0
-        for history_line, balance in h:
+        missing_heights = sorted(set(height for height, block_timestamp
+            in zip(heights, block_timestamps)
+            if block_timestamp is None and 0 < height <= server_height))
+        if missing_heights:
+            self._logger.debug("fetching missing headers at heights: %s", missing_heights)
             try:
-                timestamp = timestamp_to_datetime(header_at_height(chain,
-                                history_line.height).timestamp)
-            except MissingHeader:
-                if history_line.height > 0:
-                    self._logger.debug("fetching missing headers at height: %s",
-                                       history_line.height)
-                    assert history_line.height <= server_height, "inconsistent blockchain data"
-                    backfill_headers([history_line.height])
-                    timestamp = timestamp_to_datetime(header_at_height(chain,
-                                    history_line.height).timestamp)
-                else:
-                    timestamp = datetime.now()
-            if from_timestamp and timestamp < from_timestamp:
-                continue
-            if to_timestamp and timestamp >= to_timestamp:
-                continue
+                network.backfill_headers_at_heights_and_wait(missing_heights,
+                    EXPORT_HEADER_FETCH_TIMEOUT)
+            except Exception:
+                self._logger.exception("unable to fetch missing headers")
+            block_timestamps = header_timestamps.timestamps_for_heights(heights, chain)
+        for (history_line, balance), block_timestamp in zip(h, block_timestamps):
+            timestamp: Optional[datetime] = None
+            if history_line.height <= 0:
+                timestamp = datetime.now()
+            elif block_timestamp is not None:
+                timestamp = timestamp_to_datetime(block_timestamp)
+            if timestamp is not None:
+                if from_timestamp and timestamp < from_timestamp:
+                    continue
+                if to_timestamp and timestamp >= to_timestamp:
+                    continue
             item = {
                 'txid': hash_to_hex_str(history_line.tx_hash),
                 'height': history_line.height,
-                'timestamp': timestamp.isoformat(),
+                'timestamp': timestamp.isoformat() if timestamp is not None else None,
                 'value': format_satoshis(history_line.value_delta,
                             is_diff=True) if history_line.value_delta is not None else '--',
                 'balance': format_satoshis(balance),
                 'label': self._wallet.get_transaction_label(history_line.tx_hash)
             }
             if fx:
-                date = timestamp
-                item['fiat_value'] = fx.historical_value_str(history_line.value_delta, date)
-                item['fiat_balance'] = fx.historical_value_str(balance, date)
+                if timestamp is not None:
+                    fiat_items.append(item)
+                    fiat_amounts.extend((history_line.value_delta, balance))
+                    fiat_timestamps.extend((int(timestamp.timestamp()),) * 2)
+                else:
+                    item['fiat_value'] = item['fiat_balance'] = _("No data")
             out.append(item)
+        if fx:
+            fiat_texts = fx.historical_value_strs(fiat_amounts, fiat_timestamps)
+            for i, item in enumerate(fiat_items):
+                item['fiat_value'] = fiat_texts[i*2]
+                item['fiat_balance'] = fiat_texts[i*2+1]
         return out
 
     def create_extra_outputs(self, coins: List[UTXO], outputs: List[XTxOutput], \
@@ -1367,6 +2310,11 @@ class AbstractAccount:
         is set/unset independent of address-level freezing, however both must be satisfied for
         a coin to be defined as spendable.'''
         update_entries: List[Tuple[TransactionOutputFlag, bytes, int]] = []
+        with self._utxos_lock:
+            for utxo in utxos:
+                utxo_key = utxo.key()
+                if utxo_key in self._utxos and (utxo_key in self._frozen_coins) != freeze:
+                    self._utxo_index.set_coin_frozen(utxo_key, utxo.value, freeze)
         if freeze:
             self._frozen_coins.update(utxo.key() for utxo in utxos)
             update_entries.extend(
@@ -1715,9 +2663,15 @@ class AbstractAccount:
         with self.lock:
             tx_key_ids: List[Tuple[bytes, Set[int]]] = []
             for tx_hash in reorged_tx_hashes:
-                tx_key_ids.append((tx_hash, self._sync_state.get_transaction_key_ids(
-                    hash_to_hex_str(tx_hash))))
-            self.unarchive_transaction_keys(tx_key_ids)
+                # Only keys that have been deactivated and unloaded need to be reactivated, and
+                # most of the reorged transactions will not be related to this account.
+                key_ids = set(key_id for key_id
+                    in self._sync_state.get_transaction_key_ids(tx_hash)
+                    if key_id not in self._keyinstances)
+                if len(key_ids):
+                    tx_key_ids.append((tx_hash, key_ids))
+            if len(tx_key_ids):
+                self.unarchive_transaction_keys(tx_key_ids)
 
     async def new_deactivated_keys(self) -> List[int]:
         await self._deactivated_keys_event.wait()
@@ -1981,6 +2935,75 @@ class DeterministicAccount(AbstractAccount):
         return tuple(DeterministicKeyAllocation(masterkey_id, DerivationType.BIP32_SUBPATH,
             tuple(derivation_path) + (i,)) for i in range(next_id, next_id + count))
 
+    def derive_public_keys(self, derivation_parent: Sequence[int], first_index: int, count: int,
+            executor: Optional[Executor]=None) -> List[List[PublicKey]]:
+        """
+        Derive the public keys of each keystore for a range of child indexes of the parent path.
+        The keystores cache the parent key so this is far cheaper than deriving each key by its
+        full path, and the executor if given spreads the work over a process pool.
+        """
+        keystore_public_keys = [ cast(Xpub, keystore).derive_pubkeys(derivation_parent,
+            first_index, count, executor) for keystore in self.get_keystores() ]
+        return [ list(public_keys) for public_keys in zip(*keystore_public_keys) ]
+
+    def derive_scripts(self, derivation_parent: Sequence[int], first_index: int, count: int,
+            script_types: Optional[Sequence[ScriptType]]=None,
+            executor: Optional[Executor]=None) -> List[DerivedKeyScript]:
+        """
+        Derive the public keys, scripts and scripthashes for a range of child indexes of the
+        parent path in one pass, for instance to subscribe to them. There is a result for each
+        of the script types for each index, where the default is the account's script type.
+        """
+        if script_types is None:
+            script_types = (self.get_default_script_type(),)
+        derivation_parent = tuple(derivation_parent)
+        results: List[DerivedKeyScript] = []
+        for i, public_keys in enumerate(self.derive_public_keys(derivation_parent, first_index,
+                count, executor)):
+            for script_type in script_types:
+                script_template = self._get_script_template_for_public_keys(public_keys,
+                    script_type)
+                script = script_template.to_script()
+                results.append(DerivedKeyScript(derivation_parent + (first_index + i,),
+                    script_type, public_keys, script_template, script,
+                    scripthash_bytes(script)))
+        return results
+
+    def get_subscription_triples(self, keyinstance_ids: Iterable[int],
+            executor: Optional[Executor]=None) -> List[Tuple[int, ScriptType, bytes]]:
+        # Keys are created in contiguous ranges of child indexes, and each range is derived in
+        # bulk rather than key by key.
+        key_ids_by_path: Dict[Tuple[int, ...], int] = {}
+        other_key_ids: List[int] = []
+        for key_id in keyinstance_ids:
+            derivation_path = self._keypath.get(key_id)
+            if derivation_path:
+                key_ids_by_path[derivation_path] = key_id
+            else:
+                other_key_ids.append(key_id)
+        results = super().get_subscription_triples(other_key_ids)
+
+        script_types = self.get_enabled_script_types()
+        derivation_paths = sorted(key_ids_by_path)
+        start = 0
+        while start < len(derivation_paths):
+            derivation_parent = derivation_paths[start][:-1]
+            first_index = derivation_paths[start][-1]
+            end = start + 1
+            while end < len(derivation_paths) and \
+                    derivation_paths[end] == derivation_parent + (first_index + end - start,):
+                end += 1
+            for derived_script in self.derive_scripts(derivation_parent, first_index,
+                    end - start, script_types, executor):
+                results.append((key_ids_by_path[derived_script.derivation_path],
+                    derived_script.script_type, derived_script.scripthash))
+            start = end
+        return results
+
+    def _get_script_template_for_public_keys(self, public_keys: List[PublicKey],
+            script_type: Optional[ScriptType]=None) -> ScriptTemplate:
+        raise NotImplementedError
+
     # Returns ordered from use first to use last.
     def get_fresh_keys(self, derivation_parent: Sequence[int], count: int) -> List[KeyInstanceRow]:
         fresh_keys = self.get_existing_fresh_keys(derivation_parent)
@@ -1998,12 +3021,9 @@ class DeterministicAccount(AbstractAccount):
         def _is_fresh_key(keyinstance: KeyInstanceRow) -> bool:
             return (keyinstance.script_type == ScriptType.NONE and
                 (keyinstance.flags & KeyInstanceFlag.ALLOCATED_MASK) == 0)
-        parent_depth = len(derivation_parent)
-        candidates = [ key for key in self._keyinstances.values()
-            if len(self._keypath[key.keyinstance_id]) == parent_depth+1
-            and self._keypath[key.keyinstance_id][:parent_depth] == derivation_parent ]
         # Order keys from newest to oldest and work out how many in front are unused/fresh.
-        keys = sorted(candidates, key=lambda v: -v.keyinstance_id)
+        key_ids = reversed(self._keypath.get_child_key_ids(derivation_parent))
+        keys = (self._keyinstances[key_id] for key_id in key_ids)
         newest_to_oldest = list(itertools.takewhile(_is_fresh_key, keys))
         # Provide them in the more usable oldest to newest form.
         return list(reversed(newest_to_oldest))
@@ -2064,9 +3084,7 @@ class SimpleDeterministicAccount(SimpleAccount, DeterministicAccount):
         return (ScriptType.P2PKH, ScriptType.P2PK)
 
     def get_possible_scripts_for_id(self, keyinstance_id: int) -> List[Tuple[ScriptType, Script]]:
-        public_key = self._get_public_key_for_id(keyinstance_id)
-        keyinstance = self._keyinstances[keyinstance_id]
-        return [ (script_type, self.get_script_template(public_key, script_type).to_script())
+        return [ (script_type, self._get_cached_script(keyinstance_id, script_type)[0])
             for script_type in self.get_enabled_script_types() ]
 
     def get_script_template_for_id(self, keyinstance_id: int,
@@ -2084,6 +3102,10 @@ class SimpleDeterministicAccount(SimpleAccount, DeterministicAccount):
     def derive_script_template(self, derivation_path: Sequence[int]) -> ScriptTemplate:
         return self.get_script_template(self.derive_pubkeys(derivation_path))
 
+    def _get_script_template_for_public_keys(self, public_keys: List[PublicKey],
+            script_type: Optional[ScriptType]=None) -> ScriptTemplate:
+        return self.get_script_template(public_keys[0], script_type)
+
 
 
 class StandardAccount(SimpleDeterministicAccount):
@@ -2117,10 +3139,8 @@ class MultisigAccount(DeterministicAccount):
     def get_enabled_script_types(self) -> Sequence[ScriptType]:
         return (ScriptType.MULTISIG_P2SH, ScriptType.MULTISIG_BARE, ScriptType.MULTISIG_ACCUMULATOR)
 
-    def get_possible_scripts_for_id(self, keyinstance_id: int) -> List[Script]:
-        public_keys = self.get_public_keys_for_id(keyinstance_id)
-        public_keys_hex = [pubkey.to_hex() for pubkey in public_keys]
-        return [ (script_type, self.get_script_template(public_keys_hex, script_type).to_script())
+    def get_possible_scripts_for_id(self, keyinstance_id: int) -> List[Tuple[ScriptType, Script]]:
+        return [ (script_type, self._get_cached_script(keyinstance_id, script_type)[0])
             for script_type in self.get_enabled_script_types() ]
 
     def get_script_template_for_id(self, keyinstance_id: int,
@@ -2159,6 +3179,11 @@ class MultisigAccount(DeterministicAccount):
         public_keys_hex = [pubkey.to_hex() for pubkey in self.derive_pubkeys(derivation_path)]
         return self.get_script_template(public_keys_hex)
 
+    def _get_script_template_for_public_keys(self, public_keys: List[PublicKey],
+            script_type: Optional[ScriptType]=None) -> ScriptTemplate:
+        return self.get_script_template([ public_key.to_hex() for public_key in public_keys ],
+            script_type)
+
     def get_keystore(self) -> Multisig_KeyStore:
         return self._multisig_keystore
 
@@ -2214,8 +3239,14 @@ class Wallet(TriggeredCallbacks):
         txdata_cache_size = self.get_cache_size_for_tx_bytedata() * (1024 * 1024)
 
         self._transaction_table = TransactionTable(self._db_context)
-        self._transaction_cache = TransactionCache(self._transaction_table,
-            txdata_cache_size=txdata_cache_size)
+        with timeline.phase("transaction_cache") as phase:
+            self._transaction_cache = TransactionCache(self._transaction_table,
+                txdata_cache_size=txdata_cache_size,
+                txdata_cache_raw=self._storage.get('tx_bytedata_cache_raw', False),
+                lazy_load=self._storage.get('tx_cache_lazy_load', False))
+            if self._transaction_cache.is_loaded():
+                phase.set_count("transactions", len(self._transaction_cache._cache))
+                phase.set_count("cached_bytedata", len(self._transaction_cache._txdata_cache))
         self._transaction_descriptions: Dict[bytes, str] = {}
 
         self._masterkey_rows: Dict[int, MasterKeyRow] = {}
@@ -2223,8 +3254,13 @@ class Wallet(TriggeredCallbacks):
 
         self._accounts: Dict[int, AbstractAccount] = {}
         self._keystores: Dict[int, KeyStore] = {}
+        # The accounts with keys whose server history lists each transaction.
+        self._transaction_accounts: Dict[bytes, Set[int]] = {}
+        self._transaction_accounts_lock = threading.Lock()
+        self._key_usage_executor: Optional[ThreadPoolExecutor] = None
 
-        self.load_state()
+        with timeline.phase("load_state"):
+            self.load_state()
 
         self.contacts = Contacts(self._storage)
 
@@ -2268,47 +3304,66 @@ class Wallet(TriggeredCallbacks):
         self._keystores.clear()
         self._accounts.clear()
         self._transaction_descriptions.clear()
+        with self._transaction_accounts_lock:
+            self._transaction_accounts.clear()
 
-        with TransactionTable(self._db_context) as table:
+        with timeline.phase("descriptions") as phase, \
+                TransactionTable(self._db_context) as table:
             # NOTE(rt12) BACKLOG These are actually read in the transaction cache but perhaps
             # shouldn't be, if they are managed separately.
             self._transaction_descriptions = dict(table.read_descriptions())
+            phase.set_count("rows", len(self._transaction_descriptions))
 
-        with MasterKeyTable(self._db_context) as table:
-            for row in sorted(table.read(), key=lambda t: 0 if t[1] is None else t[1]):
+        with timeline.phase("masterkeys") as phase, MasterKeyTable(self._db_context) as table:
+            masterkey_rows = table.read()
+            for row in sorted(masterkey_rows, key=lambda t: 0 if t[1] is None else t[1]):
                 self._realize_keystore(row)
+            phase.set_count("rows", len(masterkey_rows))
 
-        with KeyInstanceTable(self._db_context) as table:
+        with timeline.phase("keyinstances") as phase, \
+                KeyInstanceTable(self._db_context) as table:
             all_account_keys: Dict[int, List[KeyInstanceRow]] = defaultdict(list)
             keyinstances = {}
             for row in table.read():
                 keyinstances[row.keyinstance_id] = row
                 all_account_keys[row.account_id].append(row)
+            phase.set_count("rows", len(keyinstances))
 
-        with TransactionOutputTable(self._db_context) as table:
+        with timeline.phase("outputs") as phase, \
+                TransactionOutputTable(self._db_context) as table:
             all_account_outputs: Dict[int, List[TransactionOutputRow]] = defaultdict(list)
+            output_count = 0
             for row in table.read():
                 keyinstance = keyinstances[row.keyinstance_id]
                 all_account_outputs[keyinstance.account_id].append(row)
+                output_count += 1
+            phase.set_count("rows", output_count)
 
-        with AccountTable(self._db_context) as table:
-            for row in table.read():
+        with timeline.phase("accounts") as phase, AccountTable(self._db_context) as table:
+            account_rows = table.read()
+            for row in account_rows:
                 account_keys = all_account_keys.get(row.account_id, [])
                 account_outputs = all_account_outputs.get(row.account_id, [])
-                if row.default_masterkey_id is not None:
-                    account = self._realize_account(row, account_keys, account_outputs)
-                else:
-                    found_types = set(key.derivation_type for key in account_keys)
-                    prvkey_types = set([ DerivationType.PRIVATE_KEY ])
-                    address_types = set([ DerivationType.PUBLIC_KEY_HASH,
-                        DerivationType.SCRIPT_HASH ])
-                    if found_types & prvkey_types:
-                        account = ImportedPrivkeyAccount(self, row, account_keys, account_outputs)
-                    elif found_types & address_types:
-                        account = ImportedAddressAccount(self, row, account_keys, account_outputs)
+                with timeline.phase(f"account_{row.account_id}") as account_phase:
+                    account_phase.set_count("keyinstances", len(account_keys))
+                    account_phase.set_count("outputs", len(account_outputs))
+                    if row.default_masterkey_id is not None:
+                        account = self._realize_account(row, account_keys, account_outputs)
                     else:
-                        raise WalletLoadError(_("Account corrupt, types: %s"), found_types)
+                        found_types = set(key.derivation_type for key in account_keys)
+                        prvkey_types = set([ DerivationType.PRIVATE_KEY ])
+                        address_types = set([ DerivationType.PUBLIC_KEY_HASH,
+                            DerivationType.SCRIPT_HASH ])
+                        if found_types & prvkey_types:
+                            account = ImportedPrivkeyAccount(self, row, account_keys,
+                                account_outputs)
+                        elif found_types & address_types:
+                            account = ImportedAddressAccount(self, row, account_keys,
+                                account_outputs)
+                        else:
+                            raise WalletLoadError(_("Account corrupt, types: %s"), found_types)
                 self.register_account(row.account_id, account)
+            phase.set_count("rows", len(account_rows))
 
     def register_account(self, account_id: int, account: AbstractAccount) -> None:
         self._accounts[account_id] = account
@@ -2626,6 +3681,10 @@ class Wallet(TriggeredCallbacks):
         with KeyInstanceTable(self.get_db_context()) as table:
             table.update_script_types(entries)
 
+    def update_key_history(self, entries: Iterable[KeyHistoryRow]) -> None:
+        with KeyHistoryTable(self.get_db_context()) as table:
+            table.upsert(entries)
+
     def read_transaction_metadatas(self, flags: Optional[int]=None, mask: Optional[int]=None,
             tx_hashes: Optional[Sequence[bytes]]=None, account_id: Optional[int]=None) \
                 -> List[Tuple[str, TxData]]:
@@ -2642,6 +3701,15 @@ class Wallet(TriggeredCallbacks):
         with TransactionOutputTable(self.get_db_context()) as table:
             table.update_flags(entries)
 
+    # This should only be called by an account that holds it's own transaction lock.
+    def create_transaction_key_usage(self, txo_entries: Iterable[TransactionOutputRow],
+            txo_flag_entries: Iterable[Tuple[TransactionOutputFlag, bytes, int]],
+            delta_entries: Iterable[TransactionDeltaRow],
+            cb: Optional[CompletionCallbackType]=None) -> None:
+        with TransactionOutputTable(self.get_db_context()) as table:
+            table.create_key_usage(txo_entries, txo_flag_entries, delta_entries,
+                completion_callback=cb)
+
     # This should only be called by an account that holds it's own transaction lock.
     def create_or_update_transactiondelta_relative(self,
             entries: Iterable[TransactionDeltaRow],
@@ -2695,12 +3763,7 @@ class Wallet(TriggeredCallbacks):
         assert metadata.height is not None, f"tx {hash_to_hex_str(tx_hash)} has no height"
         timestamp = None
         if metadata.height > 0:
-            chain = app_state.headers.longest_chain()
-            try:
-                header = app_state.headers.header_at_height(chain, metadata.height)
-                timestamp = header.timestamp
-            except MissingHeader:
-                pass
+            timestamp = app_state.header_timestamps.timestamp_at_height(metadata.height)
         if timestamp is not None:
             conf = max(self.get_local_height() - metadata.height + 1, 0)
             return metadata.height, conf, timestamp
@@ -2749,18 +3812,143 @@ class Wallet(TriggeredCallbacks):
         self._logger.debug("adding tx data %s (flags: %r)", tx_id, flags)
         self._transaction_cache.add_transaction(tx_hash, tx, flags, _completion_callback)
 
-        # TODO: It should be possible to determine what accounts are involved with this without
-        # entering the processing stage.
-        # TODO: It should be possible to parallelise each account's processing.
-        for account in self._accounts.values():
-            if account.process_key_usage(tx_hash, tx, None):
-                involved_account_ids.add(account.get_id())
+        involved_account_ids.update(self._process_key_usage(tx_hash, tx))
 
         attempt_callback()
 
     # Called by network.
-    def add_transaction_proof(self, tx_hash: bytes, height: int, timestamp: int, position: int,
-            proof_position: int, proof_branch: Sequence[bytes]) -> None:
+    async def add_transaction_async(self, tx_hash: bytes, tx: Transaction, flags: TxFlags,
+            external: bool=False) -> None:
+        tx_id = hash_to_hex_str(tx_hash)
+        if self._stopped:
+            self._logger.debug("add_transaction_async on stopped wallet: %s", tx_id)
+            return
+
+        self._logger.debug("adding tx data %s (flags: %r)", tx_id, flags)
+        async with AsynchronousWriter() as writer:
+            self._transaction_cache.add_transaction(tx_hash, tx, flags, writer.get_callback())
+            involved_account_ids = self._process_key_usage(tx_hash, tx)
+            try:
+                await writer.succeeded()
+            except Exception:
+                self._logger.exception("add_transaction_async write failed for %s", tx_id)
+                return
+
+        self._logger.debug("wallet.add_transaction: %s = %s", tx_id, involved_account_ids)
+        self.trigger_callback('transaction_added', tx_hash, tx, involved_account_ids, external)
+
+    async def add_transactions_async(self, entries: Sequence[Tuple[bytes, Transaction]],
+            flags: TxFlags, external: bool=False) -> None:
+        """
+        The bulk equivalent of `add_transaction_async`. The transactions are written to the
+        database together, and the key usage for each account is processed in one pass.
+        """
+        if self._stopped:
+            self._logger.debug("add_transactions_async on stopped wallet: %d transactions",
+                len(entries))
+            return
+
+        self._logger.debug("adding %d txs data (flags: %r)", len(entries), flags)
+        async with AsynchronousWriter() as writer:
+            self._transaction_cache.add_transactions(entries, flags, writer.get_callback())
+            involved_account_ids = self._process_key_usage_batch(entries)
+            try:
+                await writer.succeeded()
+            except Exception:
+                self._logger.exception("add_transactions_async write failed for %d transactions",
+                    len(entries))
+                return
+
+        for tx_hash, tx in entries:
+            self.trigger_callback('transaction_added', tx_hash, tx,
+                involved_account_ids[tx_hash], external)
+
+    def update_transaction_accounts(self, account_id: int, added_tx_hashes: Iterable[bytes],
+            removed_tx_hashes: Iterable[bytes]) -> None:
+        with self._transaction_accounts_lock:
+            for tx_hash in added_tx_hashes:
+                account_ids = self._transaction_accounts.get(tx_hash)
+                if account_ids is None:
+                    account_ids = self._transaction_accounts[tx_hash] = set()
+                account_ids.add(account_id)
+            for tx_hash in removed_tx_hashes:
+                account_ids = self._transaction_accounts.get(tx_hash)
+                if account_ids is not None:
+                    account_ids.discard(account_id)
+                    if not account_ids:
+                        del self._transaction_accounts[tx_hash]
+
+    def get_transaction_account_ids(self, tx_hash: bytes) -> Set[int]:
+        with self._transaction_accounts_lock:
+            return set(self._transaction_accounts.get(tx_hash, ()))
+
+    def _get_key_usage_accounts(self, entries: Sequence[Tuple[bytes, Transaction]]) \
+            -> Dict[int, List[Tuple[bytes, Transaction]]]:
+        """
+        Work out which of the given transactions each account needs to process, without
+        entering the processing stage. An account can only use an output if the server history
+        for one of its keys lists the transaction, and can only have an input spend one of its
+        coins. Coins created earlier in the same batch are also followed, as they are not yet
+        known to the account.
+        """
+        account_entries: Dict[int, List[Tuple[bytes, Transaction]]] = {}
+        batch_account_ids: Dict[bytes, Set[int]] = {}
+        for tx_hash, tx in entries:
+            account_ids = self.get_transaction_account_ids(tx_hash)
+            for account_id, account in self._accounts.items():
+                if account_id in account_ids:
+                    continue
+                for txin in tx.inputs:
+                    if account_id in batch_account_ids.get(txin.prev_hash, ()) or \
+                            account.get_utxo(txin.prev_hash, txin.prev_idx) is not None:
+                        account_ids.add(account_id)
+                        break
+            batch_account_ids[tx_hash] = account_ids
+            for account_id in account_ids:
+                if account_id in self._accounts:
+                    account_entries.setdefault(account_id, []).append((tx_hash, tx))
+        return account_entries
+
+    def _map_accounts(self, func: Callable[[AbstractAccount, List[Tuple[bytes, Transaction]]], R],
+            account_entries: Dict[int, List[Tuple[bytes, Transaction]]]) -> Dict[int, R]:
+        # Each account only takes its own locks when processing key usage, so the accounts can be
+        # processed alongside each other.
+        if len(account_entries) < 2:
+            return { account_id: func(self._accounts[account_id], entries)
+                for account_id, entries in account_entries.items() }
+
+        if self._key_usage_executor is None:
+            self._key_usage_executor = ThreadPoolExecutor(max_workers=KEY_USAGE_WORKER_COUNT,
+                thread_name_prefix="key-usage")
+        futures = { account_id: self._key_usage_executor.submit(func,
+            self._accounts[account_id], entries)
+            for account_id, entries in account_entries.items() }
+        return { account_id: future.result() for account_id, future in futures.items() }
+
+    def _process_key_usage(self, tx_hash: bytes, tx: Transaction) -> Set[int]:
+        account_entries = self._get_key_usage_accounts([ (tx_hash, tx) ])
+        results = self._map_accounts(
+            lambda account, entries: account.process_key_usage(tx_hash, tx, None),
+            account_entries)
+        return set(account_id for account_id, is_used in results.items() if is_used)
+
+    def _process_key_usage_batch(self, entries: Sequence[Tuple[bytes, Transaction]]) \
+            -> Dict[bytes, Set[int]]:
+        involved_account_ids: Dict[bytes, Set[int]] = { tx_hash: set() for tx_hash, _tx
+            in entries }
+        account_entries = self._get_key_usage_accounts(entries)
+        results = self._map_accounts(
+            lambda account, entries: account.process_key_usage_batch([ (tx_hash, tx, None)
+                for tx_hash, tx in entries ]),
+            account_entries)
+        for account_id, used_tx_hashes in results.items():
+            for tx_hash in used_tx_hashes:
+                involved_account_ids[tx_hash].add(account_id)
+        return involved_account_ids
+
+    # Called by network.
+    async def add_transaction_proof(self, tx_hash: bytes, height: int, timestamp: int,
+            position: int, proof_position: int, proof_branch: Sequence[bytes]) -> None:
         tx_id = hash_to_hex_str(tx_hash)
         if self._stopped:
             self._logger.debug("add_transaction_proof on stopped wallet: %s", tx_id)
@@ -2783,11 +3971,23 @@ class Wallet(TriggeredCallbacks):
         # We only update a subset.
         flags = TxFlags.HasHeight | TxFlags.HasPosition
         data = TxData(height=height, position=position)
-        self._transaction_cache.update(
-            [ (tx_hash, data, None, flags | TxFlags.StateSettled) ])
-
         proof = TxProof(proof_position, proof_branch)
-        self._transaction_cache.update_proof(tx_hash, proof)
+        async with AsynchronousWriter() as update_writer, \
+                AsynchronousWriter() as proof_writer:
+            have_update = self._transaction_cache.update(
+                [ (tx_hash, data, None, flags | TxFlags.StateSettled) ],
+                completion_callback=update_writer.get_callback()) > 0
+            self._transaction_cache.update_proof(tx_hash, proof,
+                completion_callback=proof_writer.get_callback())
+            for account in self._accounts.values():
+                account.update_transaction_heights([ tx_hash ])
+            try:
+                if have_update:
+                    await update_writer.succeeded()
+                await proof_writer.succeeded()
+            except Exception:
+                self._logger.exception("add_transaction_proof writes failed for %s", tx_id)
+                return
 
         height, conf, _timestamp = self.get_tx_height(tx_hash)
         self._logger.debug("add_transaction_proof %d %d %d", height, conf, timestamp)
@@ -2826,6 +4026,8 @@ class Wallet(TriggeredCallbacks):
             return
 
         reorg_count, updated_tx_hashes = self._transaction_cache.apply_reorg(above_height)
+        for account in self._accounts.values():
+            account.update_transaction_heights(updated_tx_hashes)
         self._logger.info(
             f'removing verification of {reorg_count} transactions above {above_height}')
 
@@ -2941,6 +4143,9 @@ class Wallet(TriggeredCallbacks):
 
         for account in self.get_accounts():
             account.stop()
+        if self._key_usage_executor is not None:
+            self._key_usage_executor.shutdown()
+            self._key_usage_executor = None
         if self._network is not None:
             self._network.remove_wallet(self)
         if self._transaction_table is not None:
@@ -4,9 +4,10 @@ needs to be authoritatively cached above the database. This also reduces the loc
 there will be no reads or
 """
 
+import bisect
 import threading
 import time
-from typing import cast, Dict, Iterable, List, Optional, Sequence, Tuple
+from typing import cast, Dict, Iterable, List, Optional, Sequence, Tuple, Union
 
 from bitcoinx import double_sha256, hash_to_hex_str
 
@@ -15,7 +16,14 @@ from ..logs import logs
 from ..transaction import Transaction
 from .tables import (CompletionCallbackType, InvalidDataError, MAGIC_UNTOUCHED_BYTEDATA,
     MissingRowError, TransactionTable, TxData, TxProof, TransactionRow)
-from ..util.cache import LRUCache
+from ..util.cache import estimate_transaction_size, LRUCache
+
+
+# Transactions that are mined and have bytedata, but do not have a verified merkle proof.
+UNVERIFIED_FLAGS = TxFlags.HasByteData | TxFlags.HasHeight
+UNVERIFIED_MASK = TxFlags.HasByteData | TxFlags.HasPosition | TxFlags.HasHeight
+# The most unverified transactions the network synchronisation is given to work on at a time.
+MAXIMUM_UNVERIFIED_ENTRIES = 200
 
 
 class TransactionCacheEntry:
@@ -29,29 +37,108 @@ class TransactionCacheEntry:
 
 
 class TransactionCache:
-    def __init__(self, store: TransactionTable, txdata_cache_size: Optional[int]=None) -> None:
+    def __init__(self, store: TransactionTable, txdata_cache_size: Optional[int]=None,
+            txdata_cache_raw: bool=False, lazy_load: bool=False) -> None:
+        """
+        If `txdata_cache_raw` is set the transaction bytedata cache holds the serialised
+        transactions, which are parsed each time they are fetched. This fits several times as
+        many transactions in the same cache size.
+
+        If `lazy_load` is set the metadata is loaded in a background thread, and no transaction
+        bytedata is loaded in advance. The cache lock is held by that thread until the metadata
+        is loaded, so any use of the cache before then waits for it.
+        """
         if txdata_cache_size is None:
             txdata_cache_size = MAXIMUM_TXDATA_CACHE_SIZE_MB * (1024 * 1024)
 
         self._logger = logs.get_logger("cache-tx")
         self._cache: Dict[bytes, TransactionCacheEntry] = {}
-        self._txdata_cache = LRUCache(max_size=txdata_cache_size)
+        # The entries that network synchronisation has work to do for are indexed, so that it can
+        # find them without looking at every entry. These are ordered sets of transaction hashes,
+        # the unverified entries grouped by height.
+        self._unsynced_hashes: Dict[bytes, None] = {}
+        self._unverified_hashes: Dict[int, Dict[bytes, None]] = {}
+        # The settled transactions by height, with the heights in a bisectable list so that a
+        # reorg only needs to look at the transactions above the fork. The list is only sorted
+        # when it is next used, as it is mostly built by loading entries in no particular order.
+        self._settled_hashes: Dict[int, Dict[bytes, None]] = {}
+        self._settled_heights: List[int] = []
+        self._settled_heights_sorted = True
+        self._txdata_cache: LRUCache[bytes, Union[bytes, Transaction]] = \
+            LRUCache(max_size=txdata_cache_size)
+        self._txdata_cache_raw = txdata_cache_raw
         self._store = store
 
         self._lock = threading.RLock()
+        self._loaded_event = threading.Event()
+
+        if lazy_load:
+            lock_acquired_event = threading.Event()
+            def _load_in_background() -> None:
+                with self._lock:
+                    lock_acquired_event.set()
+                    self._load_metadata()
+            threading.Thread(target=_load_in_background, name="transaction-cache-load",
+                daemon=True).start()
+            lock_acquired_event.wait()
+            return
 
-        self._logger.debug("caching all metadata records")
-        self.get_metadatas()
-        self._logger.debug("cached %d metadata records", len(self._cache))
-
+        self._load_metadata()
         if txdata_cache_size > 0:
             # How many of these can actually be cached is limited by the cache size.
             self._logger.debug("attempting to cache unsettled transaction bytedata")
             rows = self._store.read(TxFlags.HasByteData, TxFlags.HasByteData|TxFlags.StateSettled)
             for row in rows:
-                self._txdata_cache.set(row[0], Transaction.from_bytes(row[1]))
+                self._cache_transaction(row[0], bytedata=row[1])
             self._logger.debug("matched/cached %d unsettled transactions", len(rows))
 
+    def _load_metadata(self) -> None:
+        try:
+            self._logger.debug("caching all metadata records")
+            self._get_metadatas()
+            self._get_settled_heights()
+            self._logger.debug("cached %d metadata records", len(self._cache))
+        except Exception:
+            self._logger.exception("failed to load metadata records")
+            raise
+        finally:
+            # Nothing waiting on the load should wait forever if it failed.
+            self._loaded_event.set()
+
+    def is_loaded(self) -> bool:
+        return self._loaded_event.is_set()
+
+    def wait_until_loaded(self, timeout: Optional[float]=None) -> bool:
+        """
+        Wait for the metadata to be loaded. This is only needed for the methods that do not
+        acquire the cache lock, and is immediate if the cache was not lazily loaded.
+        """
+        return self._loaded_event.wait(timeout)
+
+    def _cache_transaction(self, tx_hash: bytes, tx: Optional[Transaction]=None,
+            bytedata: Optional[bytes]=None) -> None:
+        """
+        Add the transaction to the bytedata cache, in whichever form it is cached. Either or both
+        of the parsed transaction and the serialised transaction may be given.
+        """
+        if self._txdata_cache_raw:
+            if bytedata is None:
+                assert tx is not None
+                bytedata = tx.to_bytes()
+            self._txdata_cache.set(tx_hash, bytedata)
+        else:
+            if tx is None:
+                assert bytedata is not None
+                tx = Transaction.from_bytes(bytedata)
+            self._txdata_cache.set(tx_hash, tx, estimate_transaction_size(tx,
+                None if bytedata is None else len(bytedata)))
+
+    def _get_cached_transaction(self, tx_hash: bytes) -> Optional[Transaction]:
+        value = self._txdata_cache.get(tx_hash)
+        if value is not None and self._txdata_cache_raw:
+            return Transaction.from_bytes(cast(bytes, value))
+        return cast(Optional[Transaction], value)
+
     def set_store(self, store: TransactionTable) -> None:
         self._store = store
 
@@ -64,6 +151,65 @@ class TransactionCache:
             return True
         return tx_hash == double_sha256(bytedata)
 
+    def _set_entry(self, tx_hash: bytes, entry: TransactionCacheEntry) -> None:
+        existing_entry = self._cache.get(tx_hash)
+        if existing_entry is not None:
+            self._unindex_entry(tx_hash, existing_entry)
+        self._cache[tx_hash] = entry
+        self._index_entry(tx_hash, entry)
+
+    def _remove_entry(self, tx_hash: bytes) -> None:
+        self._unindex_entry(tx_hash, self._cache.pop(tx_hash))
+
+    def _index_entry(self, tx_hash: bytes, entry: TransactionCacheEntry) -> None:
+        # Any change to the flags or height of an entry has to be bracketed by unindexing it and
+        # indexing it again.
+        if entry.flags & TxFlags.HasByteData == 0:
+            self._unsynced_hashes[tx_hash] = None
+        elif entry.flags & UNVERIFIED_MASK == UNVERIFIED_FLAGS:
+            height = cast(int, entry.metadata.height)
+            self._unverified_hashes.setdefault(height, {})[tx_hash] = None
+        if entry.flags & TxFlags.StateSettled and entry.metadata.height is not None:
+            height = entry.metadata.height
+            height_hashes = self._settled_hashes.get(height)
+            if height_hashes is None:
+                height_hashes = self._settled_hashes[height] = {}
+                if len(self._settled_heights) and height < self._settled_heights[-1]:
+                    self._settled_heights_sorted = False
+                self._settled_heights.append(height)
+            height_hashes[tx_hash] = None
+
+    def _unindex_entry(self, tx_hash: bytes, entry: TransactionCacheEntry) -> None:
+        if entry.flags & TxFlags.HasByteData == 0:
+            self._unsynced_hashes.pop(tx_hash, None)
+        elif entry.flags & UNVERIFIED_MASK == UNVERIFIED_FLAGS:
+            height = cast(int, entry.metadata.height)
+            height_hashes = self._unverified_hashes.get(height)
+            if height_hashes is not None:
+                height_hashes.pop(tx_hash, None)
+                if not height_hashes:
+                    del self._unverified_hashes[height]
+        if entry.flags & TxFlags.StateSettled and entry.metadata.height is not None:
+            height = entry.metadata.height
+            height_hashes = self._settled_hashes.get(height)
+            if height_hashes is not None:
+                height_hashes.pop(tx_hash, None)
+                if not height_hashes:
+                    del self._settled_hashes[height]
+                    heights = self._get_settled_heights()
+                    del heights[bisect.bisect_left(heights, height)]
+
+    def _get_settled_heights(self) -> List[int]:
+        if not self._settled_heights_sorted:
+            self._settled_heights.sort()
+            self._settled_heights_sorted = True
+        return self._settled_heights
+
+    def _get_settled_hashes_above(self, height: int) -> List[bytes]:
+        heights = self._get_settled_heights()
+        return [ tx_hash for settled_height in heights[bisect.bisect_right(heights, height):]
+            for tx_hash in self._settled_hashes[settled_height] ]
+
     def _entry_visible(self, entry_flags: int, flags: Optional[TxFlags]=None,
             mask: Optional[TxFlags]=None) -> bool:
         """
@@ -114,6 +260,50 @@ class TransactionCache:
                         tx, flags | TxFlags.HasByteData, None)],
                     completion_callback=completion_callback)
 
+    def add_transactions(self, entries: Sequence[Tuple[bytes, Transaction]],
+            flags: TxFlags=TxFlags.Unset,
+            completion_callback: Optional[CompletionCallbackType]=None) -> None:
+        """
+        The bulk equivalent of `add_transaction`. New transactions are inserted in one write and
+        existing entries are updated in another, and the completion callback is called once when
+        all of the resulting writes are complete. It receives the first error, if any.
+        """
+        for _tx_hash, tx in entries:
+            assert isinstance(tx, Transaction)
+
+        pending_lock = threading.Lock()
+        pending_count = 2
+        pending_exc_value: Optional[Exception] = None
+        def _completion_callback(exc_value: Optional[Exception]) -> None:
+            nonlocal pending_count, pending_exc_value
+            with pending_lock:
+                pending_count -= 1
+                if pending_exc_value is None:
+                    pending_exc_value = exc_value
+                if pending_count > 0:
+                    return
+            if completion_callback is not None:
+                completion_callback(pending_exc_value)
+
+        with self._lock:
+            date_updated = self._store._get_current_timestamp()
+            metadata = TxData(date_added=date_updated, date_updated=date_updated)
+            inserts: List[Tuple[bytes, TxData, Transaction, TxFlags, Optional[str]]] = []
+            updates: List[Tuple[bytes, TxData, Optional[Transaction], TxFlags]] = []
+            for tx_hash, tx in entries:
+                if tx_hash in self._cache:
+                    updates.append((tx_hash, metadata, tx, flags | TxFlags.HasByteData))
+                else:
+                    inserts.append((tx_hash, metadata, tx, flags | TxFlags.HasByteData, None))
+
+            if len(inserts):
+                self._add(inserts, completion_callback=_completion_callback)
+            else:
+                _completion_callback(None)
+            if not len(updates) or self._update(updates,
+                    completion_callback=_completion_callback) == 0:
+                _completion_callback(None)
+
     def add(self, inserts: List[Tuple[bytes, TxData, Transaction, TxFlags, Optional[str]]],
             completion_callback: Optional[CompletionCallbackType]=None) -> None:
         with self._lock:
@@ -139,11 +329,11 @@ class TransactionCache:
             self._validate_new_flags(tx_hash, flags)
             metadata = TxData(metadata.height, metadata.position, metadata.fee, date_added,
                 date_added)
-            self._cache[tx_hash] = TransactionCacheEntry(metadata, flags)
+            self._set_entry(tx_hash, TransactionCacheEntry(metadata, flags))
             bytedata = None
             if tx is not None:
-                self._txdata_cache.set(tx_hash, tx)
                 bytedata = tx.to_bytes()
+                self._cache_transaction(tx_hash, tx, bytedata)
             inserts[i] = TransactionRow(  # type:ignore
                 tx_hash, metadata, bytedata, flags, description)
         self._store.create(inserts, completion_callback=completion_callback)  # type:ignore
@@ -205,14 +395,17 @@ class TransactionCache:
             new_entry = TransactionCacheEntry(new_metadata, flags, entry.time_loaded)
             self._logger.debug("_update: %s %r %s %r %r", hash_to_hex_str(tx_hash),
                 incoming_metadata, TxFlags.to_repr(incoming_flags), entry, new_entry)
-            self._cache[tx_hash] = new_entry
+            self._set_entry(tx_hash, new_entry)
             if incoming_tx:  # serialize txs -> binary before all db writes
                 incoming_bytedata: Optional[bytes] = incoming_tx.to_bytes()
             else:
                 incoming_bytedata = None
 
             if incoming_flags & TxFlags.HasByteData:
-                self._txdata_cache.set(tx_hash, incoming_tx)
+                if incoming_tx is None:
+                    self._txdata_cache.set(tx_hash, None)
+                else:
+                    self._cache_transaction(tx_hash, incoming_tx, incoming_bytedata)
             elif flags & TxFlags.HasByteData:
                 # Indicate the user is not changing the bytedata, it's a metadata/flags update.
                 incoming_bytedata = MAGIC_UNTOUCHED_BYTEDATA
@@ -239,7 +432,9 @@ class TransactionCache:
             date_updated = self._store._get_current_timestamp()
             entry = self._get_entry(tx_hash)
             assert entry is not None
+            self._unindex_entry(tx_hash, entry)
             entry.flags = (entry.flags & mask) | (flags & ~TxFlags.METADATA_FIELD_MASK)
+            self._index_entry(tx_hash, entry)
             self._validate_new_flags(tx_hash, entry.flags)
             # Update the cached metadata for the new modification date.
             metadata = entry.metadata
@@ -265,12 +460,13 @@ class TransactionCache:
             completion_callback: Optional[CompletionCallbackType]=None) -> None:
         with self._lock:
             self._logger.debug("cache_deletion: %s", hash_to_hex_str(tx_hash))
-            del self._cache[tx_hash]
+            self._remove_entry(tx_hash)
             self._txdata_cache.set(tx_hash, None)
             self._store.delete([ tx_hash ], completion_callback=completion_callback)
 
     def get_flags(self, tx_hash: bytes) -> Optional[TxFlags]:
         # We cache all metadata, so this can avoid touching the database.
+        self._loaded_event.wait()
         entry = self._cache.get(tx_hash)
         if entry is not None:
             return entry.flags
@@ -278,6 +474,7 @@ class TransactionCache:
 
     # NOTE: Only used by unit tests at this time.
     def is_cached(self, tx_hash: bytes) -> bool:
+        self._loaded_event.wait()
         return tx_hash in self._cache
 
     # This should not be used to get
@@ -300,8 +497,7 @@ class TransactionCache:
             if mask is not None and (mask & TxFlags.HasByteData) == 0:
                 return entry
             # If they do, and we have it cached, then give them the entry.
-            tx = self._txdata_cache.get(tx_hash)
-            if tx is not None:
+            if self._txdata_cache.get(tx_hash) is not None:
                 return entry
             force_store_fetch = True
         if not force_store_fetch:
@@ -314,9 +510,9 @@ class TransactionCache:
                 # Overwrite any existing entry for this transaction. Due to the lock, and lack of
                 # flushing we can assume that we will not be clobbering any fresh changes.
                 entry = TransactionCacheEntry(metadata, flags_get)
-                self._cache.update({ tx_hash: entry })
+                self._set_entry(tx_hash, entry)
                 if bytedata is not None:
-                    self._txdata_cache.set(tx_hash, Transaction.from_bytes(bytedata))
+                    self._cache_transaction(tx_hash, bytedata=bytedata)
                 self._logger.debug("get_entry/cache_change: %r", (hash_to_hex_str(tx_hash),
                     entry, TxFlags.to_repr(flags), TxFlags.to_repr(mask)))
                 # If they filter the entry they request, we only give them a matched result.
@@ -344,6 +540,7 @@ class TransactionCache:
         return None
 
     def have_transaction_data(self, tx_hash: bytes) -> bool:
+        self._loaded_event.wait()
         entry = self._cache.get(tx_hash)
         return entry is not None and (entry.flags & TxFlags.HasByteData) != 0
 
@@ -382,7 +579,7 @@ class TransactionCache:
             for tx_hash, entry in self._get_entries(flags, mask, tx_hashes):
                 if entry.flags & TxFlags.HasByteData == 0:
                     continue
-                tx = self._txdata_cache.get(tx_hash)
+                tx = self._get_cached_transaction(tx_hash)
                 if tx is not None:
                     results.append((tx_hash, tx))
                 else:
@@ -392,9 +589,10 @@ class TransactionCache:
                 for row in self._store.read(flags, mask, missing_tx_hashes):
                     if row[2] & TxFlags.HasByteData != 0:
                         bytedata = cast(bytes, row[1])
+                        # The transaction is parsed whichever form it is cached in.
                         tx = Transaction.from_bytes(bytedata)
-                        results.append((row[0], tx))  # type: ignore
-                        self._txdata_cache.set(row[0], tx)
+                        self._cache_transaction(row[0], tx, bytedata)
+                        results.append((row[0], tx))
         return results
 
     def get_entries(self, flags: Optional[TxFlags]=None, mask: Optional[TxFlags]=None,
@@ -475,7 +673,8 @@ class TransactionCache:
                 self._logger.debug("get_metadatas/cache_additions: adds=%d haves=%d %r...",
                     len(cache_additions),
                     len(existing_matches), existing_matches[:5])
-            self._cache.update(cache_additions)
+            for tx_hash, entry in cache_additions.items():
+                self._set_entry(tx_hash, entry)
 
         results = []
         if store_tx_hashes is not None and len(store_tx_hashes):
@@ -492,47 +691,60 @@ class TransactionCache:
         return results
 
     def get_height(self, tx_hash: bytes) -> Optional[int]:
+        self._loaded_event.wait()
         entry = self._cache.get(tx_hash)
         if entry is not None and entry.flags & (TxFlags.StateSettled|TxFlags.StateCleared):
             return entry.metadata.height
         return None
 
     def get_unsynced_hashes(self) -> List[bytes]:
-        entries = self.get_metadatas(flags=TxFlags.Unset, mask=TxFlags.HasByteData)
-        return [ t[0] for t in entries ]
+        """
+        The transactions that we know of but do not have the bytedata for.
+        """
+        with self._lock:
+            return list(self._unsynced_hashes)
 
     def get_unverified_entries(self, watermark_height: int) \
             -> List[Tuple[bytes, TransactionCacheEntry]]:
-        results = self.get_metadatas(
-            flags=TxFlags.HasByteData | TxFlags.HasHeight,
-            mask=TxFlags.HasByteData | TxFlags.HasPosition | TxFlags.HasHeight)
-        if len(results) > 200:
-            results = results[:200]
-        return [ (tx_hash, self._cache[tx_hash]) for (tx_hash, metadata) in results
-            if 0 < cast(int, metadata.height) <= watermark_height ]
+        """
+        The mined transactions that do not have a merkle proof, lowest height first, excluding
+        those mined above the watermark height. Only the first batch of these is returned.
+        """
+        results: List[Tuple[bytes, TransactionCacheEntry]] = []
+        with self._lock:
+            heights = sorted(height for height in self._unverified_hashes
+                if 0 < height <= watermark_height)
+            for height in heights:
+                for tx_hash in self._unverified_hashes[height]:
+                    results.append((tx_hash, self._cache[tx_hash]))
+                    if len(results) == MAXIMUM_UNVERIFIED_ENTRIES:
+                        return results
+        return results
 
     def apply_reorg(self, reorg_height: int,
             completion_callback: Optional[CompletionCallbackType]=None) \
             -> Tuple[int, List[bytes]]:
-        fetch_flags = TxFlags.StateSettled
-        fetch_mask = TxFlags.StateSettled
+        """
+        Unverify the settled transactions mined above the given height. Only those transactions
+        are looked at, so this costs time in proportion to the depth of the reorg.
+        """
         unverify_mask = ~(TxFlags.HasHeight | TxFlags.HasPosition | TxFlags.HasProofData |
             TxFlags.STATE_MASK)
 
         with self._lock:
             date_updated = self._store._get_current_timestamp()
-            # This does not request bytedata so if all metadata is cached, will not hit the
-            # database.
             store_updates = []
-            for (tx_hash, metadata) in self.get_metadatas(fetch_flags, fetch_mask):
-                if cast(int, metadata.height) > reorg_height:
-                    # Update the cached version to match the changes we are going to apply.
-                    entry = self._cache[tx_hash]
-                    entry.flags = (entry.flags & unverify_mask) | TxFlags.StateCleared
-                    # TODO(rt12) BACKLOG the real unconfirmed height may be -1 unconf parent
-                    entry.metadata = TxData(height=0, fee=metadata.fee,
-                        date_added=metadata.date_added, date_updated=date_updated)
-                    store_updates.append((tx_hash, entry.metadata, entry.flags))
+            for tx_hash in self._get_settled_hashes_above(reorg_height):
+                # Update the cached version to match the changes we are going to apply.
+                entry = self._cache[tx_hash]
+                metadata = entry.metadata
+                self._unindex_entry(tx_hash, entry)
+                entry.flags = (entry.flags & unverify_mask) | TxFlags.StateCleared
+                # TODO(rt12) BACKLOG the real unconfirmed height may be -1 unconf parent
+                entry.metadata = TxData(height=0, fee=metadata.fee,
+                    date_added=metadata.date_added, date_updated=date_updated)
+                self._index_entry(tx_hash, entry)
+                store_updates.append((tx_hash, entry.metadata, entry.flags))
             if len(store_updates):
                 self._store.update_metadata(store_updates,
                     completion_callback=completion_callback)
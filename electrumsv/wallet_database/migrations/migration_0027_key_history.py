@@ -0,0 +1,59 @@
+import json
+try:
+    # Linux expects the latest package version of 3.31.1 (as of p)
+    import pysqlite3 as sqlite3
+except ModuleNotFoundError:
+    # MacOS expects the latest brew version of 3.32.1 (as of 2020-07-10).
+    # Windows builds use the official Python 3.7.9 builds and version of 3.31.1.
+    import sqlite3 # type: ignore
+import struct
+import time
+from typing import Dict, List, Tuple
+
+MIGRATION = 27
+
+# This is the packing used by `KeyHistoryTable` at the time of this migration. It is duplicated
+# here so that later changes to the table do not alter what this migration writes.
+HISTORY_ENTRY_STRUCT = struct.Struct("<32si")
+
+def execute(conn: sqlite3.Connection) -> None:
+    conn.execute("CREATE TABLE IF NOT EXISTS KeyHistory ("
+        "keyinstance_id INTEGER PRIMARY KEY,"
+        "account_id INTEGER NOT NULL,"
+        "history BLOB NOT NULL,"
+        "date_created INTEGER NOT NULL,"
+        "date_updated INTEGER NOT NULL,"
+        "FOREIGN KEY(account_id) REFERENCES Accounts (account_id),"
+        "FOREIGN KEY(keyinstance_id) REFERENCES KeyInstances (keyinstance_id)"
+    ")")
+
+    conn.execute("CREATE INDEX IF NOT EXISTS idx_KeyHistory_account_id "
+        "ON KeyHistory(account_id)")
+
+    # Derive the key history from the transactions each key has been used in. This is what the
+    # wallet used to do every time an account was loaded. Transactions with no position within
+    # their block are ordered after those with one.
+    cursor = conn.execute("SELECT TD.keyinstance_id, KI.account_id, TD.tx_hash, T.block_height "
+        "FROM TransactionDeltas AS TD "
+        "INNER JOIN KeyInstances AS KI ON KI.keyinstance_id = TD.keyinstance_id "
+        "INNER JOIN Transactions AS T ON T.tx_hash = TD.tx_hash "
+        "WHERE T.block_height IS NOT NULL "
+        "ORDER BY TD.keyinstance_id, T.block_height, T.block_position IS NULL, T.block_position")
+    key_accounts: Dict[int, int] = {}
+    key_history: Dict[int, List[Tuple[bytes, int]]] = {}
+    for keyinstance_id, account_id, tx_hash, block_height in cursor.fetchall():
+        key_accounts[keyinstance_id] = account_id
+        key_history.setdefault(keyinstance_id, []).append((tx_hash, block_height))
+    cursor.close()
+
+    date_updated = int(time.time())
+    conn.executemany("INSERT INTO KeyHistory "
+        "(keyinstance_id, account_id, history, date_created, date_updated) "
+        "VALUES (?, ?, ?, ?, ?)",
+        [ (keyinstance_id, key_accounts[keyinstance_id],
+            b"".join(HISTORY_ENTRY_STRUCT.pack(*entry) for entry in entries),
+            date_updated, date_updated)
+        for keyinstance_id, entries in key_history.items() ])
+
+    conn.execute("UPDATE WalletData SET value=?, date_updated=? WHERE key=?",
+        [json.dumps(MIGRATION),date_updated,"migration"])
@@ -0,0 +1,34 @@
+import json
+try:
+    # Linux expects the latest package version of 3.31.1 (as of p)
+    import pysqlite3 as sqlite3
+except ModuleNotFoundError:
+    # MacOS expects the latest brew version of 3.32.1 (as of 2020-07-10).
+    # Windows builds use the official Python 3.7.9 builds and version of 3.31.1.
+    import sqlite3 # type: ignore
+import time
+
+MIGRATION = 28
+
+# These are the `TxFlags` masks used by the bulk flag-filtered transaction queries at the time of
+# this migration. They are duplicated here so that later changes to the flags do not alter what
+# this migration creates. SQLite will only use an expression index for a query that contains the
+# identical expression, so the queries embed these masks as literals.
+MASK_HAS_BYTEDATA = 1 << 12
+MASK_HAS_BYTEDATA_SETTLED = (1 << 12) | (1 << 21)
+MASK_STATE_UNCLEARED = (1 << 22) | (1 << 23) | (1 << 24)
+
+def execute(conn: sqlite3.Connection) -> None:
+    # Which transactions lack bytedata, and are still to be obtained.
+    conn.execute("CREATE INDEX IF NOT EXISTS idx_Transactions_bytedata "
+        f"ON Transactions((flags & {MASK_HAS_BYTEDATA}))")
+    # Which transactions have bytedata but are not settled, and are cached on wallet load.
+    conn.execute("CREATE INDEX IF NOT EXISTS idx_Transactions_bytedata_settled "
+        f"ON Transactions((flags & {MASK_HAS_BYTEDATA_SETTLED}))")
+    # Which transactions are in the transactions tab and not yet cleared or settled.
+    conn.execute("CREATE INDEX IF NOT EXISTS idx_Transactions_state_uncleared "
+        f"ON Transactions((flags & {MASK_STATE_UNCLEARED}))")
+
+    date_updated = int(time.time())
+    conn.execute("UPDATE WalletData SET value=?, date_updated=? WHERE key=?",
+        [json.dumps(MIGRATION),date_updated,"migration"])
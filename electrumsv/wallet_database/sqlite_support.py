@@ -1,3 +1,4 @@
+import asyncio
 from concurrent.futures import ThreadPoolExecutor
 from enum import Enum
 import queue
@@ -88,6 +89,20 @@ class WriteEntryType(NamedTuple):
 
 CompletionEntryType = Tuple[CompletionCallbackType, Optional[Exception]]
 
+
+class WriteDispatcherStatistics(NamedTuple):
+    queue_depth: int
+    batch_size_limit: int
+    batch_bytes_limit: int
+    last_batch_size: int
+    last_batch_bytes: int
+    last_commit_ms: int
+    average_commit_ms: float
+    total_batches: int
+    total_writes: int
+    failed_writes: int
+
+
 class SqliteWriteDispatcher:
     """
     This is a relatively simple write batcher for Sqlite that keeps all the writes on one thread,
@@ -96,11 +111,27 @@ class SqliteWriteDispatcher:
     is passed back to the invoker in the completion notification.
 
     Completion notifications are done in a thread so as to not block the write dispatcher.
+    Async coroutines can instead await the completion, see `AsynchronousWriter`.
 
-    TODO: Allow writes to be wrapped with async logic so that async coroutines can do writes
-    in their natural fashion.
+    The size of each batch adapts to how long the previous commits took. If a batch commits
+    within half of the time budget and it was limited by its size, the limits are doubled. If
+    it goes over the time budget, the limits are halved. A batch is limited both by the number
+    of write entries, and by the total of the size hints those entries were queued with.
+
+    If a batch fails, it is bisected and the halves are retried in order until the failing
+    write entry is isolated and reported to its completion callback. As all the work in the
+    failed batch was rolled back, the limits are halved as they are for a slow batch, and grow
+    back as later batches succeed.
     """
 
+    MINIMUM_BATCH_SIZE = 10
+    MAXIMUM_BATCH_SIZE = 5000
+    MINIMUM_BATCH_BYTES = 256 * 1024
+    MAXIMUM_BATCH_BYTES = 32 * 1024 * 1024
+    BATCH_TIME_BUDGET_MS = 100
+    # The weight of the latest commit in the average commit time.
+    COMMIT_AVERAGE_WEIGHT = 0.1
+
     def __init__(self, db_context: "DatabaseContext") -> None:
         self._db_context = db_context
         self._logger = logs.get_logger("sqlite-writer")
@@ -115,24 +146,34 @@ class SqliteWriteDispatcher:
         self._is_alive = True
         self._exit_when_empty = False
 
+        # Batches split from a failed batch, which need to be retried before anything else.
+        self._retry_batches: List[List[WriteEntryType]] = []
+
+        self._batch_size_limit = self.MINIMUM_BATCH_SIZE
+        self._batch_bytes_limit = self.MINIMUM_BATCH_BYTES
+        self._last_batch_size = 0
+        self._last_batch_bytes = 0
+        self._last_commit_ms = 0
+        self._average_commit_ms = 0.0
+        self._total_batches = 0
+        self._total_writes = 0
+        self._failed_writes = 0
+
         self._writer_thread.start()
 
     def _writer_thread_main(self) -> None:
         self._db: sqlite3.Connection = self._db_context.acquire_connection()
 
-        maximum_batch_size = 10
         write_entries: List[WriteEntryType] = []
-        write_entry_backlog: List[WriteEntryType] = []
         while self._is_alive:
             self._writer_loop_event.set()
 
-            if len(write_entry_backlog):
-                assert maximum_batch_size == 1
-                write_entries = [ write_entry_backlog.pop(0) ]
+            is_retry = len(self._retry_batches) > 0
+            if is_retry:
+                # Retried batches are applied as they are, they are not added to.
+                write_entries = self._retry_batches.pop(0)
             else:
-                # Block until we have at least one write action. If we already have write
-                # actions at this point, it is because we need to retry after a transaction
-                # was rolled back.
+                # Block until we have at least one write action.
                 try:
                     write_entry: WriteEntryType = self._writer_queue.get(timeout=0.1)
                 except queue.Empty:
@@ -141,9 +182,16 @@ class SqliteWriteDispatcher:
                     continue
                 write_entries = [ write_entry ]
 
-            # Gather the rest of the batch for this transaction.
-            while len(write_entries) < maximum_batch_size and not self._writer_queue.empty():
-                write_entries.append(self._writer_queue.get_nowait())
+                # Gather the rest of the batch for this transaction.
+                total_size_hint = write_entry.size_hint
+                while len(write_entries) < self._batch_size_limit and \
+                        total_size_hint < self._batch_bytes_limit:
+                    try:
+                        write_entry = self._writer_queue.get_nowait()
+                    except queue.Empty:
+                        break
+                    write_entries.append(write_entry)
+                    total_size_hint += write_entry.size_hint
 
             # Using the connection as a context manager, apply the batch as a transaction.
             time_start = time.time()
@@ -165,24 +213,72 @@ class SqliteWriteDispatcher:
                 self._logger.exception("Database write failure", exc_info=e)
                 # The transaction was rolled back.
                 if len(write_entries) > 1:
-                    self._logger.debug("Retrying with batch size of 1")
-                    # We're going to try and reapply the write actions one by one.
-                    maximum_batch_size = 1
-                    write_entry_backlog = write_entries
+                    # The limits are left as they are, as a bad entry says nothing about the
+                    # cost of a batch. Bisect the batch and retry each half in order, before
+                    # any later writes.
+                    middle_index = len(write_entries) // 2
+                    self._logger.debug("Retrying as batches of size %d and %d", middle_index,
+                        len(write_entries) - middle_index)
+                    self._retry_batches[0:0] = [ write_entries[:middle_index],
+                        write_entries[middle_index:] ]
                     continue
-                # We applied the batch actions one by one. If there was an error with this action
-                # then we've logged it, so we can discard it for lack of any other option.
-                if write_entries[0][1] is not None:
-                    completion_callbacks.append((write_entries[0][1], e))
+                # We have isolated the failing write action. We've logged it, so we can discard
+                # it for lack of any other option.
+                self._failed_writes += 1
+                if write_entries[0].completion_callback is not None:
+                    completion_callbacks = [ (write_entries[0].completion_callback, e) ]
+                else:
+                    completion_callbacks = []
             else:
-                if len(write_entries):
-                    time_ms = int((time.time() - time_start) * 1000)
-                    self._logger.debug("Invoked %d write callbacks (hinted at %d bytes) in %d ms",
-                        len(write_entries), total_size_hint, time_ms)
+                time_ms = int((time.time() - time_start) * 1000)
+                self._logger.debug("Invoked %d write callbacks (hinted at %d bytes) in %d ms",
+                    len(write_entries), total_size_hint, time_ms)
+                self._record_batch(len(write_entries), total_size_hint, time_ms, is_retry)
 
             for dispatchable_callback in completion_callbacks:
                 self._callback_thread_pool.submit(self._dispatch_callback, *dispatchable_callback)
 
+    def _record_batch(self, batch_size: int, batch_bytes: int, time_ms: int,
+            is_retry: bool) -> None:
+        self._last_batch_size = batch_size
+        self._last_batch_bytes = batch_bytes
+        self._last_commit_ms = time_ms
+        if self._total_batches == 0:
+            self._average_commit_ms = float(time_ms)
+        else:
+            self._average_commit_ms += \
+                (time_ms - self._average_commit_ms) * self.COMMIT_AVERAGE_WEIGHT
+        self._total_batches += 1
+        self._total_writes += batch_size
+
+        # Retried batches are shaped by the failure, not by the limits.
+        if is_retry:
+            return
+
+        if time_ms > self.BATCH_TIME_BUDGET_MS:
+            self._shrink_limits()
+        elif time_ms * 2 <= self.BATCH_TIME_BUDGET_MS:
+            # Only grow the limit that constrained this batch, if any did.
+            if batch_size >= self._batch_size_limit:
+                self._batch_size_limit = min(self.MAXIMUM_BATCH_SIZE,
+                    self._batch_size_limit * 2)
+            if batch_bytes >= self._batch_bytes_limit:
+                self._batch_bytes_limit = min(self.MAXIMUM_BATCH_BYTES,
+                    self._batch_bytes_limit * 2)
+
+    def _shrink_limits(self) -> None:
+        self._batch_size_limit = max(self.MINIMUM_BATCH_SIZE, self._batch_size_limit // 2)
+        self._batch_bytes_limit = max(self.MINIMUM_BATCH_BYTES, self._batch_bytes_limit // 2)
+
+    def get_queue_depth(self) -> int:
+        return self._writer_queue.qsize() + sum(len(b) for b in list(self._retry_batches))
+
+    def get_statistics(self) -> WriteDispatcherStatistics:
+        return WriteDispatcherStatistics(self.get_queue_depth(), self._batch_size_limit,
+            self._batch_bytes_limit, self._last_batch_size, self._last_batch_bytes,
+            self._last_commit_ms, self._average_commit_ms, self._total_batches,
+            self._total_writes, self._failed_writes)
+
     def _dispatch_callback(self, callback: CompletionCallbackType,
             exc_value: Optional[Exception]) -> None:
         try:
@@ -330,6 +426,19 @@ class DatabaseContext:
         self._write_dispatcher.put(WriteEntryType(write_callback, completion_callback,
             size_hint))
 
+    async def queue_write_async(self, write_callback: WriteCallbackType,
+            size_hint: int=0) -> None:
+        """
+        Queue the write and wait for it to be committed, or for the exception it raised to be
+        raised here.
+        """
+        async with AsynchronousWriter() as writer:
+            self.queue_write(write_callback, writer.get_callback(), size_hint)
+            await writer.succeeded()
+
+    def get_write_statistics(self) -> WriteDispatcherStatistics:
+        return self._write_dispatcher.get_statistics()
+
     def close(self) -> None:
         self._write_dispatcher.stop()
 
@@ -400,3 +509,48 @@ class SynchronousWriter:
 
     def __exit__(self, type, value, traceback):
         pass
+
+
+class _AsyncQueryCompleter:
+    def __init__(self) -> None:
+        self._loop = asyncio.get_event_loop()
+        self._future: "asyncio.Future[None]" = self._loop.create_future()
+        self._gave_callback = False
+
+    def get_callback(self) -> CompletionCallbackType:
+        assert not self._gave_callback, "Query completer cannot be reused"
+        def callback(exc_value: Optional[Exception]) -> None:
+            # This is called on a completion thread, so the future has to be resolved on the
+            # event loop it belongs to.
+            self._loop.call_soon_threadsafe(self._set_result, exc_value)
+        self._gave_callback = True
+        return callback
+
+    def _set_result(self, exc_value: Optional[Exception]) -> None:
+        # The waiting coroutine may have been cancelled.
+        if self._future.done():
+            return
+        if exc_value is None:
+            self._future.set_result(None)
+        else:
+            self._future.set_exception(exc_value)
+
+    async def succeeded(self) -> bool:
+        await self._future
+        return True
+
+
+class AsynchronousWriter:
+    """
+    The asynchronous equivalent of `SynchronousWriter`, for use within coroutines running on
+    an event loop. The completion callback resolves a future on that event loop, rather than
+    needing to hop through a thread to the calling context.
+    """
+    def __init__(self) -> None:
+        self._completer = _AsyncQueryCompleter()
+
+    async def __aenter__(self) -> _AsyncQueryCompleter:
+        return self._completer
+
+    async def __aexit__(self, type, value, traceback) -> None:
+        pass
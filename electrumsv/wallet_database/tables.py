@@ -7,6 +7,7 @@ except ModuleNotFoundError:
     # MacOS expects the latest brew version of 3.32.1 (as of 2020-07-10).
     # Windows builds use the official Python 3.7.9 builds and version of 3.31.1.
     import sqlite3 # type: ignore
+import struct
 import time
 from typing import Any, Dict, Iterable, NamedTuple, Optional, List, Sequence, Tuple, Type, TypeVar
 
@@ -28,7 +29,7 @@ from ..types import TxoKeyType
 __all__ = [
     "MissingRowError", "DataPackingError", "TransactionTable", "TransactionOutputTable",
     "TransactionDeltaTable", "MasterKeyTable", "KeyInstanceTable", "WalletDataTable",
-    "AccountTable",
+    "AccountTable", "KeyHistoryTable",
 ]
 
 
@@ -58,17 +59,22 @@ def byte_repr(value):
 
 
 T = TypeVar('T')
+FlagsType = TypeVar('FlagsType', bound=int)
 
-def flag_clause(column: str, flags: Optional[T], mask: Optional[T]) -> Tuple[str, List[T]]:
+def flag_clause(column: str, flags: Optional[FlagsType], mask: Optional[FlagsType]) \
+        -> Tuple[str, List[FlagsType]]:
+    # The mask is embedded in the query as a literal, so that SQLite can use any expression index
+    # on the same masked column. The flag columns are never negative, so "> 0" is "!= 0" and
+    # is also able to use those indexes.
     if flags is None:
         if mask is None:
             return "", []
-        return f"({column} & ?) != 0", [mask]
+        return f"({column} & {int(mask)}) > 0", []
 
     if mask is None:
-        return f"({column} & ?) != 0", [flags]
+        return f"({column} & {int(flags)}) > 0", []
 
-    return f"({column} & ?) == ?", [mask, flags]
+    return f"({column} & {int(mask)}) == ?", [flags]
 
 def collect_results(result_type: Type[T], cursor: sqlite3.Cursor, results: List[T]) -> None:
     rows = cursor.fetchall()
@@ -830,6 +836,34 @@ class TransactionOutputTable(BaseWalletStore):
             db.executemany(self.UPDATE_FLAGS_SQL, datas)
         self._db_context.queue_write(_write, completion_callback)
 
+    def create_key_usage(self, entries: Iterable[TransactionOutputRow],
+            flag_entries: Iterable[Tuple[int, bytes, int]],
+            delta_entries: Iterable["TransactionDeltaRow"],
+            completion_callback: Optional[CompletionCallbackType]=None) -> None:
+        """
+        Apply the outputs, output flag changes and relative transaction deltas that result from
+        processing the key usage of one or more transactions, as one write.
+
+        The outputs are created before the flags are updated, so that a flag update can apply
+        to an output created by an earlier transaction in the same batch.
+        """
+        timestamp = self._get_current_timestamp()
+        create_datas = [ (*t, timestamp, timestamp) for t in entries ]
+        flag_datas = [ (timestamp,) + entry for entry in flag_entries ]
+        delta_rows = list(delta_entries)
+        delta_update_datas = [ (timestamp, r.value_delta, r.tx_hash, r.keyinstance_id)
+            for r in delta_rows ]
+        delta_insert_datas = [ (*t, timestamp, timestamp) for t in delta_rows ]
+        def _write(db: sqlite3.Connection):
+            if len(create_datas):
+                db.executemany(self.CREATE_SQL, create_datas)
+            if len(flag_datas):
+                db.executemany(self.UPDATE_FLAGS_SQL, flag_datas)
+            if len(delta_rows):
+                db.executemany(TransactionDeltaTable.UPDATE_RELATIVE_SQL, delta_update_datas)
+                db.executemany(TransactionDeltaTable.CREATE_OR_IGNORE_SQL, delta_insert_datas)
+        self._db_context.queue_write(_write, completion_callback)
+
     def delete(self, entries: Iterable[Tuple[bytes, int]],
             completion_callback: Optional[CompletionCallbackType]=None) -> None:
         def _write(db: sqlite3.Connection):
@@ -1076,8 +1110,16 @@ class TransactionDeltaTable(BaseWalletStore):
             return read_rows_by_id(TransactionDeltaHistoryRow, self._db,
                 self.READ_HISTORY_DOMAIN_SQL, [ account_id ], keyinstance_ids)
 
-        query = self.READ_HISTORY_SQL
-        cursor = self._db.execute(query, [account_id])
+        return self.read_history_with_connection(self._db, account_id)
+
+    @classmethod
+    def read_history_with_connection(cls, db: sqlite3.Connection, account_id: int) \
+            -> List[TransactionDeltaHistoryRow]:
+        """
+        Read the history of the account using the given connection. This allows the history to
+        be read by a queued write, in sequence with the writes that change it.
+        """
+        cursor = db.execute(cls.READ_HISTORY_SQL, [account_id])
         rows = cursor.fetchall()
         cursor.close()
         return [ TransactionDeltaHistoryRow(*t) for t in rows ]
@@ -1136,6 +1178,66 @@ class TransactionDeltaTable(BaseWalletStore):
         self._db_context.queue_write(_write, completion_callback)
 
 
+KeyHistoryEntry = Tuple[bytes, int]
+
+class KeyHistoryRow(NamedTuple):
+    keyinstance_id: int
+    account_id: int
+    history: List[KeyHistoryEntry]
+
+
+# The history for a key is stored as the concatenation of packed `(tx_hash, height)` entries.
+KEY_HISTORY_ENTRY_STRUCT = struct.Struct("<32si")
+
+def pack_key_history(history: Iterable[KeyHistoryEntry]) -> bytes:
+    pack = KEY_HISTORY_ENTRY_STRUCT.pack
+    return b"".join(pack(tx_hash, height) for tx_hash, height in history)
+
+def unpack_key_history(data: bytes) -> List[KeyHistoryEntry]:
+    if len(data) % KEY_HISTORY_ENTRY_STRUCT.size:
+        raise DataPackingError(f"Key history data length {len(data)} is not a multiple "
+            f"of {KEY_HISTORY_ENTRY_STRUCT.size}")
+    return list(KEY_HISTORY_ENTRY_STRUCT.iter_unpack(data))
+
+
+class KeyHistoryTable(BaseWalletStore):
+    LOGGER_NAME = "db-table-keyhistory"
+
+    READ_SQL = "SELECT keyinstance_id, account_id, history FROM KeyHistory"
+    READ_ACCOUNT_SQL = READ_SQL +" WHERE account_id=?"
+    UPSERT_SQL = ("INSERT INTO KeyHistory "
+        "(keyinstance_id, account_id, history, date_created, date_updated) "
+        "VALUES (?, ?, ?, ?, ?) ON CONFLICT(keyinstance_id) DO UPDATE "
+        "SET history=excluded.history, date_updated=excluded.date_updated")
+    DELETE_SQL = "DELETE FROM KeyHistory WHERE keyinstance_id=?"
+
+    def read(self, account_id: Optional[int]=None) -> List[KeyHistoryRow]:
+        if account_id is None:
+            cursor = self._db.execute(self.READ_SQL)
+        else:
+            cursor = self._db.execute(self.READ_ACCOUNT_SQL, [ account_id ])
+        rows = cursor.fetchall()
+        cursor.close()
+        return [ KeyHistoryRow(t[0], t[1], unpack_key_history(t[2])) for t in rows ]
+
+    def upsert(self, entries: Iterable[KeyHistoryRow], date_updated: Optional[int]=None,
+            completion_callback: Optional[CompletionCallbackType]=None) -> None:
+        if date_updated is None:
+            date_updated = self._get_current_timestamp()
+        datas = [ (r.keyinstance_id, r.account_id, pack_key_history(r.history), date_updated,
+            date_updated) for r in entries ]
+        def _write(db: sqlite3.Connection):
+            db.executemany(self.UPSERT_SQL, datas)
+        self._db_context.queue_write(_write, completion_callback)
+
+    def delete(self, keyinstance_ids: Iterable[int],
+            completion_callback: Optional[CompletionCallbackType]=None) -> None:
+        datas = [ (keyinstance_id,) for keyinstance_id in keyinstance_ids ]
+        def _write(db: sqlite3.Connection):
+            db.executemany(self.DELETE_SQL, datas)
+        self._db_context.queue_write(_write, completion_callback)
+
+
 class PaymentRequestRow(NamedTuple):
     paymentrequest_id: int
     keyinstance_id: int